@@ -7,17 +7,28 @@ import argparse
 import configparser
 import difflib
 import distutils.version
+import functools
 import glob
 import os
 import re
-import shutil
 import subprocess
 import sys
-
-from util.buildversions import BuildVersions
+import tempfile
+import zipfile
+
+from util import download
+from util import driverinput
+from util import newbuilds
+from util.buildcache import BuildCache
+from util.buildversions import SCHEMA_KEY, BuildVersions
+from util.pipeline import Pipeline
+from util.poller import Poller
+from util.sourcezip import SourceArchive
 from util.utils import fail
 
 INTERNAL_URL = None
+SPICE_URL = "https://www.spice-space.org/download/windows"
+PUBLISHED_URL = "https://fedorapeople.org/groups/virt/virtio-win/direct-downloads/virtio-win-pkg-scripts-input/latest-build"  # pylint: disable=line-too-long
 
 
 ###################
@@ -26,7 +37,7 @@ INTERNAL_URL = None
 
 def geturl(url):
     url = url.format(internalurl=INTERNAL_URL)
-    return subprocess.check_output("wget -qO- %s" % url, shell=True, text=True)
+    return download.get_text(url)
 
 
 def find_links(url, extension):
@@ -74,7 +85,7 @@ def _check_virtio_win_prewhql():
 
 
 def _check_qxl():
-    pkgurl = "https://www.spice-space.org/download/windows/qxl/"
+    pkgurl = SPICE_URL + "/qxl/"
     regex = r'href="qxl-([\d\.-]+)/"'
     version = _find_latest_version_dir(pkgurl, regex)
     url = pkgurl + "qxl-" + version + "/"
@@ -82,7 +93,7 @@ def _check_qxl():
 
 
 def _check_qxlwddm():
-    pkgurl = "https://www.spice-space.org/download/windows/qxl-wddm-dod/"
+    pkgurl = SPICE_URL + "/qxl-wddm-dod/"
     regex = r'href="qxl-wddm-dod-([\d\.-]+)/"'
     version = _find_latest_version_dir(pkgurl, regex)
     url = pkgurl + "qxl-wddm-dod-" + version + "/"
@@ -190,54 +201,64 @@ def _get_vdagent_urls(baseurl, version):
     return ret
 
 
-def find_latest_buildversions():
+PACKAGES = ["mingw-qemu-ga-win", "qxl", "qxlwddm", "virtio-win-prewhql",
+            "spice-vdagent-win"]
+
+
+def check_package(packagename):
     """
-    Check for newest versioned baseurls for each project, then check
-    for all the zip/rpm content below those that match our known
-    whitelist/blacklists
+    Check for the newest versioned baseurl for packagename, and the
+    zip/rpm content below it that matches our known whitelist/blacklists
 
-    Return a dict with mapping like
+    Return a dict like {"version": $version, "urls": [...]}
+    """
+    if packagename == "mingw-qemu-ga-win":
+        baseurl, version = _check_mingw_qemu_ga_win()
+        urls = _get_qemuga_urls(baseurl, version)
+    if packagename == "qxl":
+        baseurl, version = _check_qxl()
+        urls = _get_qxl_urls(baseurl, version)
+    if packagename == "qxlwddm":
+        baseurl, version = _check_qxlwddm()
+        urls = _get_qxlwddm_urls(baseurl, version)
+    if packagename == "virtio-win-prewhql":
+        baseurl, version = _check_virtio_win_prewhql()
+        urls = _get_virtio_urls(baseurl, version)
+    if packagename == "spice-vdagent-win":
+        baseurl, version = _check_spice_vdagent()
+        urls = _get_vdagent_urls(baseurl, version)
+
+    return {"version": version, "urls": urls}
+
+
+def find_latest_buildversions():
+    """
+    Check all PACKAGES. Return a dict with mapping like
 
-    { $packagename : {
-        "url": $baseurl, "version": $version, "files": [...]},
-      ... }
+    { $packagename : {"version": $version, "urls": [...]}, ... }
     """
-    buildversions_data = {}
-
-    def _check(packagename):
-        if packagename == "mingw-qemu-ga-win":
-            baseurl, version = _check_mingw_qemu_ga_win()
-            urls = _get_qemuga_urls(baseurl, version)
-        if packagename == "qxl":
-            baseurl, version = _check_qxl()
-            urls = _get_qxl_urls(baseurl, version)
-        if packagename == "qxlwddm":
-            baseurl, version = _check_qxlwddm()
-            urls = _get_qxlwddm_urls(baseurl, version)
-        if packagename == "virtio-win-prewhql":
-            baseurl, version = _check_virtio_win_prewhql()
-            urls = _get_virtio_urls(baseurl, version)
-        if packagename == "spice-vdagent-win":
-            baseurl, version = _check_spice_vdagent()
-            urls = _get_vdagent_urls(baseurl, version)
-
-        buildversions_data[packagename] = {}
-        buildversions_data[packagename]["version"] = version
-        buildversions_data[packagename]["urls"] = urls
-
-    _check("mingw-qemu-ga-win")
-    _check("qxl")
-    _check("qxlwddm")
-    _check("virtio-win-prewhql")
-    _check("spice-vdagent-win")
-
-    return buildversions_data
+    return {name: check_package(name) for name in PACKAGES}
 
 
 ###################
 # main() handling #
 ###################
 
+def set_urls(options):
+    """
+    Set the base URLs from the config file, or the command line
+    overrides
+    """
+    global SPICE_URL, PUBLISHED_URL
+    SPICE_URL = (options.spice_url or SPICE_URL).rstrip("/")
+    PUBLISHED_URL = (options.published_url or PUBLISHED_URL).rstrip("/")
+    if options.internal_url:
+        global INTERNAL_URL
+        INTERNAL_URL = options.internal_url.rstrip("/")
+        return
+    set_internal_url()
+
+
 def set_internal_url():
     config_path = os.path.expanduser(
             "~/.config/virtio-win-pkg-scripts/fetch-latest-builds.ini")
@@ -255,31 +276,110 @@ def download_published_buildversions_json():
     Grab buildversions.json for the latest virtio-win build from the
     fedorapeople site.
     """
-    url = "https://fedorapeople.org/groups/virt/virtio-win/direct-downloads/virtio-win-pkg-scripts-input/latest-build/buildversions.json"  # pylint: disable=line-too-long
+    url = PUBLISHED_URL + "/buildversions.json"
     return geturl(url)
 
 
-def download_published_input():
+def download_published_input(destdir):
     """
     Use wget to grab all the latest-build/ builds and stuff them in
-    NEW_BUILDS_DIR
+    destdir
     """
-    url = "https://fedorapeople.org/groups/virt/virtio-win/direct-downloads/virtio-win-pkg-scripts-input/latest-build/"  # pylint: disable=line-too-long
+    url = PUBLISHED_URL + "/"
     cmd = ["wget", "-r", "--no-parent", "--no-directories"]
-    cmd += ["--directory-prefix=%s" % BuildVersions.NEW_BUILDS_DIR]
+    cmd += ["--directory-prefix=%s" % destdir]
     cmd += ["--no-verbose"]
     cmd += [url]
     subprocess.check_call(cmd)
     subprocess.check_call(
-        ["rm"] + glob.glob("%s/*html*" % BuildVersions.NEW_BUILDS_DIR))
+        ["rm"] + glob.glob("%s/*html*" % destdir))
 
 
-def check_new_builds_is_same(buildversions_data):
+###################
+# Download stages #
+###################
+
+# Each stage takes its declared pipeline inputs as keyword arguments
+# and returns a dict of its declared outputs. See util/pipeline.py
+
+def _stage_download(url, path, connections):
+    print("Downloading %s" % url)
+    url = url.format(internalurl=INTERNAL_URL)
+    download.download(url, path, connections=connections)
+    return {"download:" + path: path}
+
+
+def _stage_index_zip(path, **dummy):
+    """
+    Read the zip central directory, so a truncated download fails now.
+    The member index of -sources.zip files is cached for
+    make-fedora-rpm.py
+    """
+    if path.endswith("-sources.zip"):
+        SourceArchive(path, driverinput.SOURCEZIP_CACHE_DIR)
+    else:
+        with zipfile.ZipFile(path) as zf:
+            zf.infolist()
+    return {"index:" + path: path}
+
+
+def _stage_driver_dir(cache, zips, **dummy):
+    """
+    Build the driver dir into the build cache, where make-fedora-rpm.py
+    will find it
+    """
+    with tempfile.TemporaryDirectory(prefix="driver-dir-",
+            dir=BuildVersions.TOP_DIR) as tmpdir:
+        driverinput.make_driver_dir(cache, zips,
+            os.path.join(tmpdir, "output"))
+    return {"driver_dir": True}
+
+
+def _build_download_pipeline(buildversions, destdir, jobs, prepare,
+        connections):
+    """
+    Download every build url to destdir, driver build zips first. With
+    prepare=True, each zip is indexed as soon as it is downloaded, and
+    the driver dir is built as soon as all driver build zips are in,
+    while the large source archives are still downloading.
+    """
+    pipeline = Pipeline(jobs=jobs)
+    urls = sorted(buildversions.urls(), key=lambda u:
+        not driverinput.is_driver_build_zip(os.path.basename(u)))
+
+    driver_zips = []
+    for url in urls:
+        path = os.path.join(destdir, os.path.basename(url))
+        pipeline.add_stage("download %s" % os.path.basename(url),
+            functools.partial(_stage_download, url, path, connections),
+            outputs=["download:" + path])
+        if not prepare or not path.endswith(".zip"):
+            continue
+
+        pipeline.add_stage("index %s" % os.path.basename(url),
+            functools.partial(_stage_index_zip, path),
+            inputs=["download:" + path],
+            outputs=["index:" + path])
+        if driverinput.is_driver_build_zip(path):
+            driver_zips.append(path)
+
+    if prepare and driver_zips:
+        pipeline.add_artifact("cache",
+            BuildCache(driverinput.DEFAULT_CACHE_DIR))
+        pipeline.add_stage("driver-dir",
+            functools.partial(_stage_driver_dir, zips=driver_zips),
+            inputs=["cache"] + ["index:" + p for p in driver_zips],
+            outputs=["driver_dir"])
+    return pipeline
+
+
+def check_new_builds_is_same(buildversions):
     if not os.path.exists(BuildVersions.NEW_BUILDS_JSON):
         return False
 
-    orig = open(BuildVersions.NEW_BUILDS_JSON).read()
-    new = BuildVersions.dump(buildversions_data)
+    # Reserialized, so files from before SCHEMA_KEY compare equal
+    orig = BuildVersions().to_json()
+    new = buildversions.to_json()
     diff = "".join(difflib.unified_diff(
             orig.splitlines(1), new.splitlines(1)))
     if diff:
@@ -301,58 +401,137 @@ def parse_args():
     parser.add_argument("--rebuild", action="store_true",
         help="Redownload the input used to build the most recent "
              "published RPM.")
+    parser.add_argument("--prepare", action="store_true",
+        help="Check each downloaded archive as soon as it arrives, and "
+             "build the make-fedora-rpm.py driver dir into the build "
+             "cache while the remaining builds download.")
+    parser.add_argument("--jobs", "-j", type=int, default=4,
+        help="Maximum number of concurrent downloads and prepare steps. "
+             "Default=%(default)s")
+    parser.add_argument("--connections", type=int,
+        default=download.DEFAULT_CONNECTIONS,
+        help="Connections used to download each large file in parallel "
+             "byte ranges, 1 to disable. Default=%(default)s")
+
+    parser.add_argument("--internal-url",
+        help="Internal build system URL, overriding the config file")
+    parser.add_argument("--spice-url",
+        help="Base URL of the qxl and qxl-wddm-dod downloads. "
+             "Default=%s" % SPICE_URL)
+    parser.add_argument("--published-url",
+        help="URL of the published latest-build input. "
+             "Default=%s" % PUBLISHED_URL)
+    parser.add_argument("--daemon", action="store_true",
+        help="Keep running, polling for new builds every --interval "
+             "seconds, and download them as soon as they show up.")
+    parser.add_argument("--interval", type=int, default=600,
+        help="--daemon poll interval per package, in seconds. "
+             "Default=%(default)s")
+    parser.add_argument("--hook", metavar="COMMAND",
+        help="--daemon shell command to run after new builds are "
+             "downloaded, like starting a respin.")
 
     return parser.parse_args()
 
 
+def download_new_builds(buildversions, options):
+    """
+    Download buildversions into a staging dir, and only replace
+    NEW_BUILDS_DIR once everything is in place. Builds reading the
+    current content can keep running
+    """
+    staging = newbuilds.create_staging()
+    try:
+        # Reserialized, so a published file from before SCHEMA_KEY
+        # doesn't show up as a diff
+        public_buildversions_str = BuildVersions.from_json(
+            download_published_buildversions_json()).to_json()
+
+        print()
+        print("New builds found. Downloading them...")
+        print()
+
+        # Download the latest bits
+        pipeline = _build_download_pipeline(buildversions, staging,
+            options.jobs, options.prepare, options.connections)
+        pipeline.run()
+        pipeline.print_summary()
+
+        # Write the json content, and make it the NEW_BUILDS_DIR content
+        buildversions.write(
+            os.path.join(staging, BuildVersions.JSON_BASENAME))
+        newbuilds.publish(staging)
+    except BaseException:
+        # fail() raises SystemExit. Don't leave a locked partial staging
+        # dir behind, prune() would never delete it
+        newbuilds.discard(staging)
+        raise
+    buildversions_str = buildversions.to_json()
+
+    print()
+    diff = "".join(difflib.unified_diff(
+            public_buildversions_str.splitlines(1),
+            buildversions_str.splitlines(1),
+            fromfile="orig buildversions.json",
+            tofile="published buildversions.json"))
+    print("buildversions diff from latest-build:\n%s" % diff)
+
+
+def run_daemon(options):
+    """
+    Poll every package on its own schedule, and download new builds
+    whenever the combined find_latest_buildversions() output changes.
+    The index pages stay cached between polls, for revalidation
+    """
+    initial = None
+    if os.path.exists(BuildVersions.NEW_BUILDS_JSON):
+        initial = BuildVersions().to_data()
+        # The poller results are only the find_latest_buildversions()
+        # components
+        del initial[SCHEMA_KEY]
+
+    def _on_change(data):
+        download_new_builds(BuildVersions.from_data(data), options)
+        if options.hook:
+            print("Running hook: %s" % options.hook)
+            ret = subprocess.call(options.hook, shell=True)
+            if ret != 0:
+                print("Hook exited with status %d" % ret)
+
+    checks = {name: functools.partial(check_package, name)
+              for name in PACKAGES}
+    print("Polling %s every ~%ds" % (", ".join(PACKAGES), options.interval))
+    Poller(checks, _on_change, options.interval, initial=initial).run()
+
+
 def main():
     options = parse_args()
 
-    set_internal_url()
+    set_urls(options)
+
+    if options.daemon:
+        return run_daemon(options)
 
     if not options.rebuild:
-        buildversions_data = find_latest_buildversions()
+        buildversions = BuildVersions.from_data(find_latest_buildversions())
 
         # If we already have the latest builds downloaded, just exit
         if (not options.redownload and
-            check_new_builds_is_same(buildversions_data)):
+            check_new_builds_is_same(buildversions)):
             return 0
 
-    if os.path.exists(BuildVersions.NEW_BUILDS_DIR):
-        shutil.rmtree(BuildVersions.NEW_BUILDS_DIR)
-    os.mkdir(BuildVersions.NEW_BUILDS_DIR)
-
     if options.rebuild:
-        download_published_input()
+        # Stage the download like download_new_builds() does
+        staging = newbuilds.create_staging()
+        try:
+            download_published_input(staging)
+            newbuilds.publish(staging)
+        except BaseException:
+            newbuilds.discard(staging)
+            raise
         return
 
-    public_buildversions_str = download_published_buildversions_json()
-
-    print()
-    print("New builds found. Downloading them...")
-    print()
-
-    # Download the latest bits
-    for data in buildversions_data.values():
-        for url in data["urls"]:
-            print("Downloading %s" % url)
-            url = url.format(internalurl=INTERNAL_URL)
-            subprocess.check_call("cd %s && wget -q %s" %
-                    (BuildVersions.NEW_BUILDS_DIR, url),
-                    shell=True)
-
-    # Write the json content to NEW_BUILDS_DIR
-    BuildVersions.write(buildversions_data)
-    buildversions_str = BuildVersions.dump(buildversions_data)
-
-    print()
-    diff = "".join(difflib.unified_diff(
-            public_buildversions_str.splitlines(1),
-            buildversions_str.splitlines(1),
-            fromfile="orig buildversions.json",
-            tofile="published buildversions.json"))
-    print("buildversions diff from latest-build:\n%s" % diff)
-
+    download_new_builds(buildversions, options)
     return 1
 
 
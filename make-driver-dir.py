@@ -6,14 +6,17 @@
 # See the COPYING file in the top-level directory.
 
 import argparse
-import glob
 import os
 import re
-import shutil
 import sys
 import textwrap
+import time
 
 from util import filemap
+from util import instrument
+from util.drivertree import DriverInputTree
+from util.fileutils import format_rate
+from util.sourcemap import MANIFEST_PATH, write_manifest
 from util.utils import fail
 
 
@@ -21,27 +24,43 @@ from util.utils import fail
 # Functional helpers #
 ######################
 
-def copy_license(input_dir, output_dir):
-    srcfile = os.path.join(input_dir, "LICENSE")
-    destfile = os.path.join(output_dir, "virtio-win_license.txt")
-    shutil.copy(srcfile, destfile)
+def _copy_and_link(tree, srcfile, destpaths):
+    """
+    Extract srcfile once, to the first of destpaths, and hardlink the
+    others to it. Returns the bytes extracted
+    """
+    for path in destpaths:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    nbytes = tree.copy(srcfile, destpaths[0])
+    for path in destpaths[1:]:
+        os.link(destpaths[0], path)
+    return nbytes
+
+
+def copy_license(tree, outputs, sourcemaps):
+    srcfile = "LICENSE"
+    destfile = "virtio-win_license.txt"
+    _copy_and_link(tree, srcfile,
+        [os.path.join(outdir, destfile) for outdir in outputs.values()])
+    for variant in outputs:
+        sourcemaps[variant].append((destfile, srcfile, tree.origin(srcfile)))
     return [srcfile]
 
 
-def _update_copymap_for_driver(input_dir, ostuple, drivername, copymap):
-    destdirs = filemap.DRIVER_OS_MAP[drivername][ostuple]
+def _update_copymap_for_driver(tree, ostuple, drivername, copymap, variants):
     missing_patterns = []
-
-    for destdir in destdirs:
-        dest_os = destdir.split("/")[0]
-
-        filelist = filemap.FILELISTS.get(drivername + ":" + dest_os, None)
-        if filelist is None:
-            filelist = filemap.FILELISTS.get(drivername)
-
+    # Files only headed for destinations the variants drop are still
+    # matched, so check_remaining_files() knows about them, but get no
+    # destination and are never extracted
+    kept = {}
+    for variant in variants:
+        for destdir, dummy in filemap.resolve(drivername, ostuple, variant):
+            kept.setdefault(destdir, []).append(variant)
+
+    for destdir, filelist in filemap.resolve(drivername, ostuple):
         for pattern in filelist:
-            files = glob.glob(os.path.abspath(
-                os.path.join(input_dir, ostuple, pattern)))
+            files = tree.glob(os.path.join(ostuple, pattern))
             if not files:
                 strpattern = os.path.join(ostuple, pattern)
                 if strpattern not in missing_patterns:
@@ -51,22 +70,21 @@ def _update_copymap_for_driver(input_dir, ostuple, drivername, copymap):
             for f in files:
                 if f not in copymap:
                     copymap[f] = []
-                copymap[f].append(os.path.join(drivername, destdir))
+                for variant in kept.get(destdir, []):
+                    copymap[f].append(
+                        (variant, os.path.join(drivername, destdir)))
 
     return missing_patterns
 
 
-def copy_virtio_drivers(input_dir, output_dir):
+def copy_virtio_drivers(tree, outputs, sourcemaps):
+    """
+    Copy the driver files for every variant in outputs, {variant:
+    output_dir}. The input is only matched once, and each file is only
+    extracted once, other destinations and variants get hardlinks.
+    """
     # Create a flat list of every leaf directory in the virtio-win directory
-    alldirs = []
-    for dirpath, dirnames, files in os.walk(input_dir):
-        dummy = files
-        if dirnames:
-            continue
-
-        ostuple = dirpath[len(input_dir) + 1:]
-        if ostuple not in alldirs:
-            alldirs.append(ostuple)
+    alldirs = tree.leaf_dirs()
 
     drivers = list(filemap.DRIVER_OS_MAP.keys())[:]
     copymap = {}
@@ -80,12 +98,12 @@ def copy_virtio_drivers(input_dir, output_dir):
                 continue
             if os.path.normpath(ostuple) not in alldirs and ostuple != "./":
                 fail("driver=%s ostuple=%s not found in input=%s" %
-                     (drivername, ostuple, input_dir))
+                     (drivername, ostuple, tree))
 
             # We know that the ostuple dir contains bits for this driver,
             # figure out what files we want to copy.
-            ret = _update_copymap_for_driver(input_dir,
-                ostuple, drivername, copymap)
+            ret = _update_copymap_for_driver(tree,
+                ostuple, drivername, copymap, list(outputs))
             missing_patterns.extend(ret)
 
     if missing_patterns:
@@ -95,23 +113,41 @@ def copy_virtio_drivers(input_dir, output_dir):
             "virtio-win-prewhql archive, but it wasn't found. This means the "
             "build output changed. Assuming this file was intentionally "
             "removed, you'll need to update the file whitelists in "
-            "filemap.py to accurately reflect the current new file layout.")
+            "filemap.json to accurately reflect the current new file layout.")
         msg += "\n\n"
         fail(msg)
 
-    # Actually copy the files, and track the ones we've seen
+    # Actually copy the files, and track the ones we've seen. Files
+    # are only extracted from the input archives here, straight to
+    # their destinations
+    start = time.monotonic()
+    nbytes = 0
     for srcfile, dests in list(copymap.items()):
-        for d in dests:
-            d = os.path.join(output_dir, d)
-            if not os.path.exists(d):
-                os.makedirs(d)
-            shutil.copy2(srcfile, d)
-
-    # The keys here are all a list of files we actually copied
+        if not dests:
+            continue
+        origin = tree.origin(srcfile)
+        destpaths = []
+        for variant, d in dests:
+            destfile = os.path.normpath(
+                os.path.join(d, os.path.basename(srcfile)))
+            sourcemaps[variant].append((destfile, srcfile, origin))
+            destpaths.append(os.path.join(outputs[variant], destfile))
+        nbytes += _copy_and_link(tree, srcfile, destpaths)
+    print("Copied driver files: %s" %
+          format_rate(nbytes, time.monotonic() - start))
+    for variant in outputs:
+        ndropped = len([f for f, dests in copymap.items()
+                        if variant not in [v for v, dummy in dests]])
+        if ndropped:
+            print("Skipped %d input files dropped by variant=%s" %
+                  (ndropped, variant))
+
+    # The keys here are all a list of files we actually copied, or
+    # deliberately skipped for all variants
     return list(copymap.keys())
 
 
-def check_remaining_files(input_dir, seenfiles):
+def check_remaining_files(tree, seenfiles):
     # Expected files that we want to skip. The reason we are so strict here
     # is to make sure that we don't forget to ship important files that appear
     # in new virtio-win builds. If a new file appears, we probably need to ask
@@ -145,7 +181,7 @@ def check_remaining_files(input_dir, seenfiles):
         # for every windows platform that supports it. However, depending
         # on the driver, functionally identical binaries might be
         # generated. In those cases, we ship only one build of the driver
-        # for every windows version it will work on (see filemap.py
+        # for every windows version it will work on (see filemap.json
         # DRIVER_OS_MAP)
         #
         # This also simplifies the WHQL submission process, one submission
@@ -178,17 +214,12 @@ def check_remaining_files(input_dir, seenfiles):
          "/Win10/x86/viomem.pdb",
     ]
 
-    remaining = []
-    for dirpath, dirnames, files in os.walk(input_dir):
-        dummy = dirnames
-        for f in files:
-            remaining.append(os.path.join(dirpath, f))
-
-    notseen = [f for f in remaining if f not in seenfiles]
+    seenfiles = set(seenfiles)
+    notseen = ["/" + f for f in tree.files() if f not in seenfiles]
     seenpatterns = []
     for pattern in whitelist:
         for f in notseen[:]:
-            if not re.match(pattern, f[len(input_dir):]):
+            if not re.match(pattern, f):
                 continue
             notseen.remove(f)
             if pattern not in seenpatterns:
@@ -196,12 +227,12 @@ def check_remaining_files(input_dir, seenfiles):
 
     if notseen:
         msg = ("\nUnhandled virtio-win files:\n    %s\n\n" %
-                "\n    ".join([f[len(input_dir):] for f in sorted(notseen)]))
+                "\n    ".join(sorted(notseen)))
         msg += textwrap.fill("This means the above files were not tracked "
-            "in filemap.py _and_ not tracked in the internal whitelist "
+            "in filemap.json _and_ not tracked in the internal whitelist "
             "in this script. This probably means that there is new build "
             "output. You need to determine if it's something we should "
-            "be shipping (add it to filemap.py) or something we should "
+            "be shipping (add it to filemap.json) or something we should "
             "ignore (add it to the whitelist).")
         fail(msg)
 
@@ -223,6 +254,18 @@ def check_remaining_files(input_dir, seenfiles):
 # main() handling #
 ###################
 
+def _layer_arg(kind):
+    """
+    argparse type for [SUBDIR=]PATH input layers
+    """
+    def _parse(value):
+        prefix = ""
+        if "=" in value:
+            prefix, value = value.split("=", 1)
+        return (kind, prefix, os.path.abspath(os.path.expanduser(value)))
+    return _parse
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Copy built windows drivers to --output_dir "
@@ -230,15 +273,53 @@ def parse_args():
                     "make-virtio-win-rpm-archive.py. "
                     "See README.md for details.")
 
-    parser.add_argument("input_dir", help="Directory containing "
+    parser.add_argument("input_dir", nargs="?", help="Directory containing "
         "virtio-win and qxl-win build output")
+    parser.add_argument("--input-zip", dest="layers", action="append",
+        type=_layer_arg("zip"), default=[], metavar="[SUBDIR=]ZIP",
+        help="Build output zip to use as input, without extracting it. "
+             "Optionally mapped below SUBDIR of the input tree. "
+             "Can be specified multiple times.")
+    parser.add_argument("--input-overlay", dest="layers", action="append",
+        type=_layer_arg("dir"), default=[], metavar="[SUBDIR=]DIR",
+        help="Directory to lay over the input tree, optionally below "
+             "SUBDIR. Files replace same named files from earlier "
+             "input_dir, --input-zip or --input-overlay arguments. "
+             "Can be specified multiple times.")
 
     default_output_dir = os.path.join(os.getcwd(), "drivers_output")
     parser.add_argument("--output-dir", "--outdir",
         help="Directory to output the organized drivers. "
         "Default=%s" % default_output_dir, default=default_output_dir)
-
-    return parser.parse_args()
+    parser.add_argument("--variant", dest="variants", action="append",
+        choices=sorted(filemap.VARIANTS), default=[],
+        help="Build variant. OS dirs and drivers it drops, see "
+        "'variants' in util/filemap.json, are never extracted or copied. "
+        "Can be specified multiple times, to build every variant from "
+        "one input scan into $output_dir/$variant. "
+        "Default=%s" % filemap.DEFAULT_VARIANT)
+
+    options = parser.parse_args()
+    if options.input_dir:
+        options.layers.insert(0,
+            _layer_arg("dir")(options.input_dir))
+    if not options.layers:
+        parser.error("input_dir or at least one --input-zip is required")
+    if not options.variants:
+        options.variants = [filemap.DEFAULT_VARIANT]
+    if len(set(options.variants)) != len(options.variants):
+        parser.error("--variant specified twice")
+    return options
+
+
+def build_input_tree(layers):
+    tree = DriverInputTree()
+    for kind, prefix, path in layers:
+        if kind == "zip":
+            tree.add_zip(path, prefix)
+        else:
+            tree.add_dir(path, prefix)
+    return tree
 
 
 def main():
@@ -250,17 +331,36 @@ def main():
     if os.listdir(output_dir):
         fail("%s is not empty." % output_dir)
 
-    options.input_dir = os.path.abspath(os.path.expanduser(options.input_dir))
+    errors = filemap.check_consistency()
+    if errors:
+        fail("filemap.json is inconsistent, see util/check-filemap.py:\n"
+             "    %s" % "\n    ".join(errors))
+
+    with instrument.span("index input"):
+        tree = build_input_tree(options.layers)
+
+    # With several variants, each gets its own subdir
+    outputs = {options.variants[0]: output_dir}
+    if len(options.variants) > 1:
+        outputs = dict((variant, os.path.join(output_dir, variant))
+                       for variant in options.variants)
+    sourcemaps = dict((variant, []) for variant in outputs)
 
     # Actually move the files
     seenfiles = []
-    seenfiles += copy_virtio_drivers(options.input_dir, output_dir)
-    seenfiles += copy_license(options.input_dir, output_dir)
+    with instrument.span("copy drivers"):
+        seenfiles += copy_virtio_drivers(tree, outputs, sourcemaps)
+        seenfiles += copy_license(tree, outputs, sourcemaps)
 
     # Verify that there is nothing left over that we missed
-    check_remaining_files(options.input_dir, seenfiles)
-
-    print("Generated %s" % output_dir)
+    check_remaining_files(tree, seenfiles)
+
+    for variant, variant_dir in outputs.items():
+        # Record where every shipped file came from, see
+        # util/driver-source.py
+        write_manifest(os.path.join(variant_dir, MANIFEST_PATH),
+                       sourcemaps[variant])
+        print("Generated %s" % variant_dir)
     return 0
 
 
@@ -6,41 +6,55 @@
 import argparse
 import datetime
 import difflib
+import fcntl
 import glob
 import os
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import zipfile
 
+from util import driverinput
+from util import instrument
+from util import newbuilds
+from util.buildcache import BuildCache, script_files
 from util.buildversions import BuildVersions
-from util.utils import yes_or_no, shellcomm
+from util.pipeline import Pipeline
+from util.rpmfile import RPMFile
+from util.sourcezip import SourceArchive
+from util.utils import fail, yes_or_no, shellcomm
 
 
 TOP_DIR = BuildVersions.TOP_DIR
 NEW_BUILDS_DIR = BuildVersions.NEW_BUILDS_DIR
-TOP_TEMP_DIR = None
+DEFAULT_CACHE_DIR = driverinput.DEFAULT_CACHE_DIR
 
 
-os.chdir(TOP_DIR)
-
+###################
+# Workspace class #
+###################
 
-##################
-# util functions #
-##################
+class Workspace(object):
+    """
+    Private tmp-* dir for one run. Every stage creates its dirs in here,
+    so several runs can share a build host and TOP_DIR.
+    """
 
-def _tempdir(dirname):
-    global TOP_TEMP_DIR
-    if TOP_TEMP_DIR is None:
+    def __init__(self, basedir):
         datestr = re.sub(" |:", "_",
                 str(datetime.datetime.today()).split(".")[0])
-        TOP_TEMP_DIR = os.path.join(TOP_DIR, "tmp-" + datestr)
-        os.mkdir(TOP_TEMP_DIR)
-        print("Using tmpdir ./%s" % os.path.basename(TOP_TEMP_DIR))
+        self.path = tempfile.mkdtemp(prefix="tmp-%s-" % datestr,
+                                     dir=basedir)
+        # mkdtemp() creates it private
+        os.chmod(self.path, 0o755)
+        print("Using tmpdir %s" % self.path)
 
-    ret = os.path.join(TOP_TEMP_DIR, dirname)
-    os.mkdir(ret)
-    return ret
+    def mkdir(self, dirname):
+        ret = os.path.join(self.path, dirname)
+        os.mkdir(ret)
+        return ret
 
 
 #########################
@@ -56,8 +70,10 @@ class Spec(object):
         self.basename = "virtio-win.spec"
         self._specpath = os.path.join(TOP_DIR, self.basename)
         self._clogpath = os.path.join(TOP_DIR, "data", "rpm_changelog")
-        self.newcontent = open(self._specpath).read()
-        self.newclog = open(self._clogpath).read()
+        self._origcontent = open(self._specpath).read()
+        self._origclog = open(self._clogpath).read()
+        self.newcontent = self._origcontent
+        self.newclog = self._origclog
         self._origfullcontent = self.get_final_content()
 
         self.newvirtio = buildversions.virtio_prewhql_str
@@ -149,55 +165,46 @@ class Spec(object):
             fromfile="Orig spec",
             tofile="New spec"))
 
-    def write_changes(self, rpm_src_dir):
-        open(self._specpath, "w").write(self.newcontent)
-        open(self._clogpath, "w").write(self.newclog)
+    def write_changes(self, workspace, rpm_src_dir):
+        """
+        Write the new spec and changelog to the workspace, and the
+        combined spec to rpm_src_dir. See save_to_checkout()
+        """
+        open(os.path.join(workspace.path, self.basename), "w").write(
+            self.newcontent)
+        open(os.path.join(workspace.path, "rpm_changelog"), "w").write(
+            self.newclog)
         newspecpath = os.path.join(rpm_src_dir, self.basename)
         open(newspecpath, "w").write(self.get_final_content())
 
+    def save_to_checkout(self, workspace):
+        """
+        Copy the workspace spec and changelog over the TOP_DIR ones.
+        Fails if another run changed those since we read them
+        """
+        with open(self._specpath) as lockfp:
+            fcntl.flock(lockfp, fcntl.LOCK_EX)
+            if (open(self._specpath).read() != self._origcontent or
+                    open(self._clogpath).read() != self._origclog):
+                fail("%s or %s changed during this run. Merge the changes "
+                     "from %s by hand." %
+                     (self._specpath, self._clogpath, workspace.path))
+            for srcname, dstpath in [(self.basename, self._specpath),
+                                     ("rpm_changelog", self._clogpath)]:
+                tmp = dstpath + ".tmp-%d" % os.getpid()
+                shutil.copyfile(os.path.join(workspace.path, srcname), tmp)
+                os.replace(tmp, dstpath)
+
 
 ######################
 # Functional helpers #
 ######################
 
-def _prep_driver_dir_input(driver_input_dir):
+def _driver_build_zips():
     """
-    Extract NEW_BUILDS_DIR/ content, apply some fix ups, so
-    we can run make-driver-dir.py against it
+    Return the NEW_BUILDS_DIR zip files containing driver build output
     """
-    # Extract virtio/qxl/... build archives
-    for zipfile in glob.glob(os.path.join(NEW_BUILDS_DIR, "*.zip")):
-        if zipfile.endswith("-sources.zip"):
-            continue
-
-        zipbasename = os.path.basename(zipfile)
-        is_qxl_old = bool(re.match(r"^qxl_.*$", zipbasename))
-        is_qxl_dod = bool(re.match(
-            r"^spice-qxl-wddm-dod.zip$", zipbasename))
-
-        # Unpack qxl_* to $dir/qxl/
-        # Unpack latest qxlwddm to $dir/spice-qxl-wddm-dod/
-        # Unpack 8.1 compat qxlwddm to $dir/, which because of the
-        #   .zip layout becomes $dir/spice-qxl-wddm-dod-8.1-compatible/
-
-        unzipdest = driver_input_dir
-        if is_qxl_old:
-            unzipdest = os.path.join(driver_input_dir, "qxl")
-        elif is_qxl_dod:
-            unzipdest = os.path.join(driver_input_dir, "spice-qxl-wddm-dod")
-        shellcomm("unzip %s -d %s" % (zipfile, unzipdest))
-
-
-    # Copy static data/old-drivers/ content into place
-    shellcomm("cp -r data/old-drivers/xp-viostor/* %s" % driver_input_dir)
-    shellcomm("cp -r data/old-drivers/xp-qxl/* %s/qxl" % driver_input_dir)
-
-    shellcomm("cp -r data/old-drivers/Win8.1 %s" % driver_input_dir)
-    shellcomm("cp -r data/old-drivers/Win8 %s" % driver_input_dir)
-    shellcomm("cp -r data/old-drivers/Win7 %s" % driver_input_dir)
-    shellcomm("cp -r data/old-drivers/Wlh %s" % driver_input_dir)
-    shellcomm("cp -r data/old-drivers/Wnet %s" % driver_input_dir)
-    shellcomm("cp -r data/old-drivers/Wxp %s" % driver_input_dir)
+    return driverinput.driver_build_zips(NEW_BUILDS_DIR)
 
 
 def _prep_spice_vdagent_msi(msi_dst_dir):
@@ -209,13 +216,21 @@ def _prep_spice_vdagent_msi(msi_dst_dir):
         if (re.search("spice-vdagent-", msifile)):
             shellcomm("cp -r %s %s" % (msifile, msi_dst_dir))
 
-def _prep_qxldod_msi(driver_input_dir, msi_dst_dir):
+def _prep_qxldod_msi(msi_dst_dir):
     """
+    Find and extract the QxlWddmDod_*.msi files from the qxlwddm build
+    archive, to be used later on by make-installer.py
     """
-    msi_dir = os.path.join(driver_input_dir, "spice-qxl-wddm-dod/w10/")
-    for msifile in glob.glob(os.path.join(msi_dir, "*.msi")):
-        if (re.search("QxlWddmDod_", msifile)):
-            shellcomm("cp -r %s %s" % (msifile, msi_dst_dir))
+    for zippath in _driver_build_zips():
+        with zipfile.ZipFile(zippath) as zf:
+            for name in zf.namelist():
+                if not re.search(r"(^|/)w10/QxlWddmDod_[^/]*\.msi$", name):
+                    continue
+                dstpath = os.path.join(msi_dst_dir, os.path.basename(name))
+                print("+ extract %s:%s to %s" % (
+                    os.path.basename(zippath), name, msi_dst_dir))
+                with zf.open(name) as src, open(dstpath, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
 
 
 def _find_msi(msi_dir, msi_name, msi_arch):
@@ -241,33 +256,64 @@ def _prep_win_fsp_msi(msi_dst_dir):
 # main() helpers #
 ##################
 
-def _prep_rpm_src_dir(buildversions, rpm_src_dir):
+def _prep_rpm_src_dir(workspace, buildversions, rpm_src_dir):
     """
     Do our fedora specific RPM buildroot preparation, like renaming
     some content to match the spec file, and moving NEW_BUILDS_DIR content
     into place.
+
+    Returns the directory containing the extracted qemu-ga .msi files
     """
     # Copy source archives to the RPM builddir
     shellcomm("cp %s/*-sources.zip %s" % (NEW_BUILDS_DIR, rpm_src_dir))
     shellcomm("cp %s/*.rpm %s" % (NEW_BUILDS_DIR, rpm_src_dir))
 
-    # Extract the qemu-ga-win RPM to a tempdir, rename the .msi files
-    # and zip them up into the form virtio-win.spec is expecting.
-    # Yeah this is rediculous...
-    qemu_ga_extractdir = _tempdir('mingw-qemu-ga-rpm-extracted')
-    os.chdir(qemu_ga_extractdir)
-    shellcomm("rpm2cpio %s/qemu-ga-win*.noarch.rpm | cpio -idmv" %
-        NEW_BUILDS_DIR)
-    shellcomm("find . -name qemu-ga-x86_64.msi "
-        r"-exec mv '{}' qemu-ga-x64.msi \;")
-    shellcomm("find . -name qemu-ga-i386.msi "
-        r"-exec mv '{}' qemu-ga-x86.msi \;")
-    shellcomm(r"mkdir {qemuga} && cp *.msi {qemuga} && "
-        "zip -9 -r {rpmdir}/{qemuga}-installers.zip {qemuga} && "
-        "rm -rf {qemuga}".format(
-            qemuga=buildversions.qemu_ga_str,
-            rpmdir=rpm_src_dir))
-    os.chdir(TOP_DIR)
+    # Pull the qemu-ga .msi files out of the qemu-ga-win RPM, rename
+    # them, and zip them up into the form virtio-win.spec is expecting.
+    # The payload is streamed, only the .msi files are written out
+    qemu_ga_msi_dir = workspace.mkdir('mingw-qemu-ga-rpm-extracted')
+    _extract_qemu_ga_msis(buildversions, qemu_ga_msi_dir, rpm_src_dir)
+    return qemu_ga_msi_dir
+
+
+def _extract_qemu_ga_msis(buildversions, msi_dir, rpm_src_dir):
+    renames = {
+        "qemu-ga-x86_64.msi": "qemu-ga-x64.msi",
+        "qemu-ga-i386.msi": "qemu-ga-x86.msi",
+    }
+    rpmpath = glob.glob(os.path.join(NEW_BUILDS_DIR,
+        "qemu-ga-win*.noarch.rpm"))[0]
+    zippath = os.path.join(rpm_src_dir,
+        "%s-installers.zip" % buildversions.qemu_ga_str)
+    print("+ extract %s from %s to %s" % (
+        ", ".join(sorted(renames)), rpmpath, zippath))
+
+    found = []
+    with zipfile.ZipFile(zippath, "w", zipfile.ZIP_DEFLATED,
+            compresslevel=9) as zf:
+        for name, dummy, dummy, reader in RPMFile(rpmpath).payload_members():
+            newname = renames.get(os.path.basename(name))
+            if not newname:
+                continue
+            found.append(os.path.basename(name))
+
+            arcname = "%s/%s" % (buildversions.qemu_ga_str, newname)
+            with open(os.path.join(msi_dir, newname), "wb") as dst, \
+                    zf.open(arcname, "w") as zipdst:
+                while True:
+                    buf = reader.read(1024 * 1024)
+                    if not buf:
+                        break
+                    dst.write(buf)
+                    zipdst.write(buf)
+
+            # No need to decompress the rest of the payload
+            if len(found) == len(renames):
+                break
+
+    missing = [n for n in renames if n not in found]
+    if missing:
+        fail("Didn't find %s in %s" % (missing, rpmpath))
 
 
 def _prompt_for_rpm_changelog(buildversions, spec):
@@ -282,18 +328,17 @@ def _prompt_for_rpm_changelog(buildversions, spec):
         return _tmp
 
     # Save package changelogs to temporary files
-    voutput = subprocess.check_output(
-        "unzip -p %s/%s-sources.zip "
-        "internal-kvm-guest-drivers-windows/status.txt | cat" %
-        (NEW_BUILDS_DIR, buildversions.virtio_prewhql_str),
-        shell=True, text=True)
+    cachedir = driverinput.SOURCEZIP_CACHE_DIR
+    virtio_sources = SourceArchive(os.path.join(NEW_BUILDS_DIR,
+        "%s-sources.zip" % buildversions.virtio_prewhql_str), cachedir)
+    voutput = virtio_sources.read_text(
+        "internal-kvm-guest-drivers-windows/status.txt", default="")
     vtmp = _editable_tempfile("virtio-clog", voutput)
 
-    qoutput = subprocess.check_output(
-        "unzip -p %s/%s-sources.zip "
-        "spice-qxl-wddm-dod/Changelog | cat" %
-        (NEW_BUILDS_DIR, buildversions.qxlwddm_str),
-        shell=True, text=True)
+    qxlwddm_sources = SourceArchive(os.path.join(NEW_BUILDS_DIR,
+        "%s-sources.zip" % buildversions.qxlwddm_str), cachedir)
+    qoutput = qxlwddm_sources.read_text(
+        "spice-qxl-wddm-dod/Changelog", default="")
     qtmp = _editable_tempfile("qxldod-clog", qoutput)
 
     # Confirm with the user that everything looks good
@@ -332,6 +377,163 @@ def _rpmbuild(spec, rpm_src_dir, rpm_build_dir, rpm_output_dir):
             spec=spec.basename))
 
 
+###################
+# Pipeline stages #
+###################
+
+# Each stage takes its declared pipeline inputs as keyword arguments
+# and returns a dict of its declared outputs. See util/pipeline.py
+
+def _stage_rpm_src(workspace, buildversions):
+    rpm_src_dir = workspace.mkdir('rpmbuild-src')
+    qemu_ga_msi_dir = _prep_rpm_src_dir(workspace, buildversions,
+                                        rpm_src_dir)
+    return {"rpm_src_dir": rpm_src_dir, "qemu_ga_msi_dir": qemu_ga_msi_dir}
+
+
+def _stage_driver_dir(workspace, cache):
+    # Build the driver dir/iso dir layout
+    driver_output_dir = workspace.mkdir("make-driver-dir-output")
+    driverinput.make_driver_dir(cache, _driver_build_zips(),
+        driver_output_dir)
+    return {"driver_output_dir": driver_output_dir}
+
+
+def _stage_spice_msi(workspace):
+    spice_dir = workspace.mkdir("spice-extracted")
+    winfsp_dir = workspace.mkdir("make-winfsp-output")
+    _prep_spice_vdagent_msi(spice_dir)
+    _prep_win_fsp_msi(winfsp_dir)
+    return {"spice_msi_dir": spice_dir, "winfsp_msi_dir": winfsp_dir}
+
+
+def _stage_qxldod_msi(workspace):
+    qxldod_dir = workspace.mkdir("qxldod-extracted")
+    _prep_qxldod_msi(qxldod_dir)
+    return {"qxldod_msi_dir": qxldod_dir}
+
+
+def _installer_submodule_commit():
+    """
+    Return the virtio-win-guest-tools-installer commit recorded in our
+    git tree, or None if it can't be determined
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "-C", TOP_DIR, "rev-parse",
+             "HEAD:virtio-win-guest-tools-installer"],
+            text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _stage_installer(workspace, cache, spec, driver_output_dir, rpm_src_dir,
+        spice_msi_dir, qxldod_msi_dir, qemu_ga_msi_dir, winfsp_msi_dir):
+    # Build the driver installer
+    installer_output_dir = workspace.mkdir("make-installer-output")
+
+    spice_vdagent_x64_msi = _find_msi(spice_msi_dir, 'spice-vdagent-', 'x64')
+    spice_vdagent_x86_msi = _find_msi(spice_msi_dir, 'spice-vdagent-', 'x86')
+
+    spice_driver_x64_msi = _find_msi(qxldod_msi_dir, 'QxlWddmDod_', 'x64')
+    spice_driver_x86_msi = _find_msi(qxldod_msi_dir, 'QxlWddmDod_', 'x86')
+
+    qemu_ga_agent_x64_msi = _find_msi(qemu_ga_msi_dir, 'qemu-ga-', 'x64')
+    qemu_ga_agent_x86_msi = _find_msi(qemu_ga_msi_dir, 'qemu-ga-', 'x86')
+
+    win_fsp_msi = _find_msi(winfsp_msi_dir, 'winfsp-', '')
+    msis = [spice_vdagent_x64_msi, spice_vdagent_x86_msi,
+            spice_driver_x64_msi, spice_driver_x86_msi,
+            qemu_ga_agent_x64_msi, qemu_ga_agent_x86_msi,
+            win_fsp_msi]
+
+    # Without knowing the installer sources version, we can't cache
+    submodule_commit = _installer_submodule_commit()
+    key = None
+    if submodule_commit:
+        key = cache.key("installer",
+            files=[m for m in msis if m] +
+                  script_files(os.path.join(TOP_DIR, "make-installer.py")),
+            trees=[driver_output_dir],
+            extra=[spec.newversion, submodule_commit])
+
+    if not key or not cache.restore("installer", key, installer_output_dir):
+        shellcomm("%s/make-installer.py %s %s %s %s %s %s %s %s %s "
+                "--output-dir %s --work-dir %s" %
+                (TOP_DIR, spec.newversion, driver_output_dir,
+                 spice_vdagent_x64_msi, spice_vdagent_x86_msi,
+                 spice_driver_x64_msi, spice_driver_x86_msi,
+                 qemu_ga_agent_x64_msi, qemu_ga_agent_x86_msi,
+                 win_fsp_msi, installer_output_dir,
+                 workspace.mkdir("make-installer-work")))
+        if key:
+            cache.store("installer", key, installer_output_dir)
+
+    shellcomm("cp %s/* %s" % (installer_output_dir, rpm_src_dir))
+    return {"installer_output_dir": installer_output_dir}
+
+
+def _stage_rpm_archive(workspace, cache, buildversions, driver_output_dir,
+        rpm_src_dir):
+    # Generate RPM input archive + iso
+    archive_output_dir = workspace.mkdir("rpm-archive-output")
+    nvr = buildversions.virtio_rpm_str
+    key = cache.key("rpm-archive",
+        files=script_files(
+                  os.path.join(TOP_DIR, "make-virtio-win-rpm-archive.py")) +
+              [os.path.join(TOP_DIR, "util", "filemap.json")] +
+              glob.glob(os.path.join(TOP_DIR, "data", "virtio-win*.xml")),
+        trees=[driver_output_dir],
+        extra=[nvr])
+
+    if not cache.restore("rpm-archive", key, archive_output_dir):
+        shellcomm("%s/make-virtio-win-rpm-archive.py %s %s --output-dir %s" %
+            (TOP_DIR, nvr, driver_output_dir, archive_output_dir))
+        cache.store("rpm-archive", key, archive_output_dir)
+
+    archive = "%s-bin-for-rpm.tar.gz" % nvr
+    shellcomm("cp %s/%s %s" % (archive_output_dir, archive, rpm_src_dir))
+    return {"rpm_archive": os.path.join(rpm_src_dir, archive)}
+
+
+def _build_pipeline(workspace, buildversions, spec, cache, jobs):
+    """
+    Describe the steps needed to produce all rpmbuild input. Independent
+    steps, like the RPM sources prep and driver dir generation, run
+    concurrently. The driver dir, installer and RPM archive stages reuse
+    cached output if their input didn't change.
+    """
+    pipeline = Pipeline(jobs=jobs)
+    pipeline.add_artifact("workspace", workspace)
+    pipeline.add_artifact("buildversions", buildversions)
+    pipeline.add_artifact("spec", spec)
+    pipeline.add_artifact("cache", cache)
+
+    pipeline.add_stage("rpm-src", _stage_rpm_src,
+        inputs=["workspace", "buildversions"],
+        outputs=["rpm_src_dir", "qemu_ga_msi_dir"])
+    pipeline.add_stage("driver-dir", _stage_driver_dir,
+        inputs=["workspace", "cache"],
+        outputs=["driver_output_dir"])
+    pipeline.add_stage("spice-msi", _stage_spice_msi,
+        inputs=["workspace"],
+        outputs=["spice_msi_dir", "winfsp_msi_dir"])
+    pipeline.add_stage("qxldod-msi", _stage_qxldod_msi,
+        inputs=["workspace"],
+        outputs=["qxldod_msi_dir"])
+    pipeline.add_stage("installer", _stage_installer,
+        inputs=["workspace", "cache", "spec", "driver_output_dir",
+                "rpm_src_dir",
+                "spice_msi_dir", "qxldod_msi_dir", "qemu_ga_msi_dir",
+                "winfsp_msi_dir"],
+        outputs=["installer_output_dir"])
+    pipeline.add_stage("rpm-archive", _stage_rpm_archive,
+        inputs=["workspace", "cache", "buildversions", "driver_output_dir",
+                "rpm_src_dir"],
+        outputs=["rpm_archive"])
+    return pipeline
+
+
 ###################
 # main() handling #
 ###################
@@ -343,80 +545,70 @@ def parse_args():
 
     parser.add_argument("--rpm-only", action="store_true",
         help="Only build RPM and exit.")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+        help="Maximum number of pipeline stages to run concurrently. "
+             "Default=%(default)s")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+        help="Directory to cache driver dir, installer and RPM archive "
+             "output across runs. Default=%(default)s")
+    parser.add_argument("--no-cache", action="store_true",
+        help="Rebuild everything, don't read or write the build cache.")
+    parser.add_argument("--work-dir", default=TOP_DIR,
+        help="Directory to create this run's private tmp-* workspace in. "
+             "Default=%(default)s")
+    parser.add_argument("--trace", metavar="FILE",
+        help="Write a Chrome trace JSON of time, CPU, memory and I/O "
+             "per stage and command to FILE, and print a summary.")
 
     return parser.parse_args()
 
 
 def main():
     options = parse_args()
+    if options.trace:
+        instrument.enable(options.trace)
 
-    # Parse new package versions
-    buildversions = BuildVersions()
-
-    # Do some RPM buildroot prep
-    rpm_src_dir = _tempdir('rpmbuild-src')
-    _prep_rpm_src_dir(buildversions, rpm_src_dir)
-
-    # Call public scripts to generate the virtio .zip
-    driver_input_dir = _tempdir("make-driver-dir-input")
-    _prep_driver_dir_input(driver_input_dir)
-
-    # Build the driver dir/iso dir layout
-    driver_output_dir = _tempdir("make-driver-dir-output")
-    shellcomm("./make-driver-dir.py %s --output-dir %s" %
-        (driver_input_dir, driver_output_dir))
+    # Use the current NEW_BUILDS_DIR content for the whole run, even if
+    # fetch-latest-builds.py replaces it meanwhile
+    global NEW_BUILDS_DIR
+    NEW_BUILDS_DIR = newbuilds.pin()
 
+    # Parse new package versions
+    buildversions = BuildVersions(
+        os.path.join(NEW_BUILDS_DIR, BuildVersions.JSON_BASENAME))
     spec = Spec(buildversions)
 
-    # Build the driver installer
-    installer_output_dir = _tempdir("make-installer-output")
-    spice_dir = _tempdir("spice-extracted")
-    winfsp_dir = _tempdir("make-winfsp-output")
-    _prep_spice_vdagent_msi(spice_dir)
-    _prep_qxldod_msi(driver_input_dir, spice_dir)
-    _prep_win_fsp_msi(winfsp_dir)
-
-    spice_vdagent_x64_msi = _find_msi(spice_dir, 'spice-vdagent-', 'x64')
-    spice_vdagent_x86_msi = _find_msi(spice_dir, 'spice-vdagent-', 'x86')
-
-    spice_driver_x64_msi = _find_msi(spice_dir, 'QxlWddmDod_', 'x64')
-    spice_driver_x86_msi = _find_msi(spice_dir, 'QxlWddmDod_', 'x86')
-
-    qemu_ga_agent_dir = os.path.join(TOP_TEMP_DIR, "mingw-qemu-ga-rpm-extracted")
-    qemu_ga_agent_x64_msi = _find_msi(qemu_ga_agent_dir, 'qemu-ga-', 'x64')
-    qemu_ga_agent_x86_msi = _find_msi(qemu_ga_agent_dir, 'qemu-ga-', 'x86')
-
-    win_fsp_msi = _find_msi(winfsp_dir, 'winfsp-', '')
-
-    shellcomm("./make-installer.py %s %s %s %s %s %s %s %s %s --output-dir %s" %
-            (spec.newversion, driver_output_dir,
-             spice_vdagent_x64_msi, spice_vdagent_x86_msi,
-             spice_driver_x64_msi, spice_driver_x86_msi,
-             qemu_ga_agent_x64_msi, qemu_ga_agent_x86_msi,
-             win_fsp_msi, installer_output_dir))
-    shellcomm("cp %s/* %s" % (installer_output_dir, rpm_src_dir))
-
-    # Generate RPM input archive + iso
-    shellcomm("./make-virtio-win-rpm-archive.py %s %s" %
-        (buildversions.virtio_rpm_str, driver_output_dir))
-    shellcomm("mv *.tar.gz %s" % rpm_src_dir)
+    # Do all the RPM buildroot prep, driver dir generation, installer
+    # building, and RPM input archive generation
+    workspace = Workspace(options.work_dir)
+    cache = BuildCache(options.cache_dir, enabled=not options.no_cache)
+    pipeline = _build_pipeline(workspace, buildversions, spec, cache,
+                               options.jobs)
+    pipeline.run()
+    pipeline.print_summary()
+    rpm_src_dir = pipeline.artifacts["rpm_src_dir"]
 
     # Alter and save spec + changelog
     _prompt_for_rpm_changelog(buildversions, spec)
-    spec.write_changes(rpm_src_dir)
+    spec.write_changes(workspace, rpm_src_dir)
 
     # Call rpmbuild
-    rpm_build_dir = _tempdir('rpmbuild-buildroot')
-    rpm_output_dir = _tempdir('rpmbuild-output')
+    rpm_build_dir = workspace.mkdir('rpmbuild-buildroot')
+    rpm_output_dir = workspace.mkdir('rpmbuild-output')
     _rpmbuild(spec, rpm_src_dir, rpm_build_dir, rpm_output_dir)
 
+    # Only now update the checkout spec and changelog, make-repo.py
+    # publishes the changelog from there
+    spec.save_to_checkout(workspace)
+
     if options.rpm_only:
         print("RPMs can be found in: %s" % rpm_output_dir)
         return 0
 
     # Trigger make-repo.py
-    cmd = ("./make-repo.py --rpm-output %s --rpm-buildroot %s" %
-        (rpm_output_dir, rpm_build_dir))
+    cmd = ("%s/make-repo.py --rpm-output %s --rpm-buildroot %s "
+        "--new-builds-dir %s" %
+        (TOP_DIR, rpm_output_dir, rpm_build_dir, NEW_BUILDS_DIR))
     print("\n\n")
     print(cmd)
     if yes_or_no("Run that make-repo.py command? (y/n): "):
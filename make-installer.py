@@ -1,12 +1,59 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import fcntl
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 from util.utils import fail, shellcomm
 
 
+TOP_DIR = os.path.dirname(os.path.abspath(__file__))
+SUBMODULE_DIR = os.path.join(TOP_DIR, "virtio-win-guest-tools-installer")
+
+
+####################
+# Internal helpers #
+####################
+
+def _tracked_files(topdir):
+    """
+    Return the git tracked files in topdir, relative to it
+    """
+    out = subprocess.check_output(
+        ["git", "-C", topdir, "ls-files", "-z", "--recurse-submodules"])
+    return [f for f in out.decode().split("\0") if f]
+
+
+def _copy_installer_sources(destdir):
+    """
+    Copy the tracked submodule files to destdir. This is what
+    `git clean -xdf` would leave in the checkout, without touching it,
+    so concurrent runs can each build in their own copy
+    """
+    # Serialize with other runs updating the checkout
+    lockfd = os.open(TOP_DIR, os.O_RDONLY)
+    try:
+        fcntl.flock(lockfd, fcntl.LOCK_EX)
+        shellcomm("git -C %s submodule update --init" % TOP_DIR)
+
+        print("+ copy %s tracked files to %s" % (SUBMODULE_DIR, destdir))
+        for relpath in _tracked_files(SUBMODULE_DIR):
+            src = os.path.join(SUBMODULE_DIR, relpath)
+            dst = os.path.join(destdir, relpath)
+            if not os.path.lexists(src) or os.path.isdir(src):
+                # Deleted in the checkout, or an empty nested submodule
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(src, dst, follow_symlinks=False)
+    finally:
+        os.close(lockfd)
+
+
 ###################
 # main() handling #
 ###################
@@ -44,6 +91,9 @@ Example: %(prog)s /path/to/built/drivers
     parser.add_argument("--output-dir", "--outdir",
         help="Directory to output the organized drivers"
         "Default=%s" % default_output_dir, default=default_output_dir)
+    parser.add_argument("--work-dir",
+        help="Empty directory to copy the installer sources to and build "
+        "them in. Default is a temporary directory, deleted on exit.")
 
     return parser.parse_args()
 
@@ -51,14 +101,21 @@ Example: %(prog)s /path/to/built/drivers
 def main():
     options = parse_args()
 
-    output_dir = options.output_dir
+    output_dir = os.path.abspath(options.output_dir)
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
     if os.listdir(output_dir):
         fail("%s is not empty." % output_dir)
 
-    shellcomm("git submodule init")
-    shellcomm("git submodule update")
+    workdir = options.work_dir
+    if not workdir:
+        workdir = tempfile.mkdtemp(prefix="virtio-win-installer-")
+        atexit.register(lambda: shutil.rmtree(workdir))
+    workdir = os.path.abspath(workdir)
+    if not os.path.exists(workdir):
+        os.mkdir(workdir)
+    if os.listdir(workdir):
+        fail("%s is not empty." % workdir)
 
     driverdir = os.path.abspath(options.driverdir)
     vdagent_x64_msi = os.path.abspath(options.vdagent_x64_msi)
@@ -68,15 +125,16 @@ def main():
     ga_x64_msi = os.path.abspath(options.ga_x64_msi)
     ga_x86_msi = os.path.abspath(options.ga_x86_msi)
     win_fsp_msi = os.path.abspath(options.win_fsp_msi)
-    os.chdir("virtio-win-guest-tools-installer")
 
-    shellcomm("git clean -xdf")
+    _copy_installer_sources(workdir)
 
-    shellcomm("./automation/build-artifacts.sh %s %s %s %s %s %s %s %s" %
-            (driverdir, vdagent_x64_msi, vdagent_x86_msi, qxlwddm_x64_msi,
-             qxlwddm_x86_msi, ga_x64_msi, ga_x86_msi, options.nvr))
+    shellcomm("cd %s && ./automation/build-artifacts.sh "
+            "%s %s %s %s %s %s %s %s" %
+            (workdir, driverdir, vdagent_x64_msi, vdagent_x86_msi,
+             qxlwddm_x64_msi, qxlwddm_x86_msi, ga_x64_msi, ga_x86_msi,
+             options.nvr))
 
-    shellcomm("mv ./exported-artifacts/* %s" % output_dir)
+    shellcomm("mv %s/exported-artifacts/* %s" % (workdir, output_dir))
 
     return 0
 
@@ -2,15 +2,24 @@
 
 import argparse
 import glob
+import json
 import os
 import re
 import shutil
 import sys
+import tempfile
 
-from util.buildversions import BuildVersions
+from util import publish
+from util import newbuilds
+from util.fileutils import file_digest, transfer, write_checksums
+from util.rpmfile import RPMFile, RPMTAG_NAME
+from util.runner import CommandRunner
 from util.utils import fail, shellcomm, yes_or_no
 
 
+TOP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
 # List of stable versions. Keep the newest version first.
 #
 # Note, if you update this, --repo-only doesn't currently handle
@@ -129,6 +138,24 @@ class LocalRepo():
         self.virtio_basedir = os.path.join(
                 "archive-virtio", self.virtio_release_str)
 
+        # {dirpath: {filename: sha256}} of everything we add, used
+        # to write per release SHA256SUMS files
+        self._digests = {}
+        self._rpm_digests = {}
+
+    def _add_file(self, srcpath, dstdir):
+        digest = transfer(srcpath, dstdir)
+        self._digests.setdefault(dstdir, {})[
+            os.path.basename(srcpath)] = digest
+        return digest
+
+    def write_checksums(self):
+        """
+        Write SHA256SUMS into every release dir we added content to
+        """
+        for dirpath, digests in self._digests.items():
+            write_checksums(dirpath, digests)
+
     def add_rpms(self, src_rpmpath, src_srpmpath):
         """
         Add the build RPM to the local tree
@@ -136,7 +163,7 @@ class LocalRepo():
         def addpath(srcpath, repodir):
             dstpath = os.path.join(self.LOCAL_REPO_DIR, repodir,
                     os.path.basename(srcpath))
-            shellcomm("cp %s %s" % (srcpath, dstpath))
+            self._rpm_digests[dstpath] = transfer(srcpath, dstpath)
             return dstpath
 
         dst_rpmpath = addpath(src_rpmpath, "rpms")
@@ -156,7 +183,7 @@ class LocalRepo():
 
         os.mkdir(qemugadir)
         for path in paths:
-            shellcomm("cp %s %s" % (path, qemugadir))
+            self._add_file(path, qemugadir)
 
     def add_virtiogt(self, paths):
         """
@@ -165,7 +192,7 @@ class LocalRepo():
         virtiodir = os.path.join(
                 self.LOCAL_DIRECT_DIR, self.virtio_basedir)
         for path in paths:
-            shellcomm("cp %s %s" % (path, virtiodir))
+            self._add_file(path, virtiodir)
 
     def add_virtiowin_media(self, isopath, rpmpath, srpmpath):
         """
@@ -194,11 +221,14 @@ class LocalRepo():
             _add_relative_link(virtiodir,
                 os.path.relpath(path, virtiodir),
                 os.path.basename(path))
+            digest = (self._rpm_digests.get(path) or file_digest(path))
+            self._digests.setdefault(virtiodir, {})[
+                os.path.basename(path)] = digest
             add_stable_path(path, stablename)
 
         add_rpm(rpmpath, "virtio-win.noarch.rpm")
         add_rpm(srpmpath, "virtio-win.src.rpm")
-        shellcomm("cp %s %s" % (isopath, virtiodir))
+        self._add_file(isopath, virtiodir)
         add_stable_path(isopath, "virtio-win.iso")
 
         # Write .htaccess, redirecting symlinks to versioned files, so
@@ -222,7 +252,7 @@ class LocalRepo():
         open(os.path.join(
             self.LOCAL_DIRECT_DIR, ".htaccess"), "w").write(htaccess)
 
-    def add_pkg_build_input(self, buildversions):
+    def add_pkg_build_input(self, new_builds_dir):
         """
         Upload the NEW_BUILDS_DIR content we used, so people can
         reproduce the build if they need to
@@ -234,14 +264,14 @@ class LocalRepo():
             print("%s exists, not changing content." % pkg_input_dir)
         else:
             os.mkdir(pkg_input_dir)
-            for filename in glob.glob(buildversions.NEW_BUILDS_DIR + "/*"):
-                shellcomm("cp %s %s" % (filename, pkg_input_dir))
+            for filename in glob.glob(new_builds_dir + "/*"):
+                self._add_file(filename, pkg_input_dir)
 
         _add_relative_link(pkg_input_topdir,
                 os.path.basename(pkg_input_dir), "latest-build")
 
 
-def _populate_local_tree(buildversions, rpm_output, rpm_buildroot):
+def _populate_local_tree(new_builds_dir, rpm_output, rpm_buildroot):
     """
     Copy all the built bits into our local repo tree to get it
     ready for syncing: iso, unpacked qemu-ga msis, etc.
@@ -296,32 +326,193 @@ def _populate_local_tree(buildversions, rpm_output, rpm_buildroot):
     localrepo.add_htaccess_stable_links()
 
     # Copy build input content to the tree
-    localrepo.add_pkg_build_input(buildversions)
+    localrepo.add_pkg_build_input(new_builds_dir)
+
+    # Record checksums of everything we added
+    localrepo.write_checksums()
+
+
+#################
+# Release index #
+#################
+
+# Published at direct-downloads/RELEASE_INDEX, so clients can resolve
+# latest/stable and verify downloads with one small request
+RELEASE_INDEX = "releases.json"
+RELEASE_INDEX_VERSION = 1
+
+
+def _read_checksums(dirpath):
+    path = os.path.join(dirpath, "SHA256SUMS")
+    if not os.path.exists(path):
+        return {}
+    ret = {}
+    for line in open(path):
+        if line.strip():
+            digest, name = line.rstrip("\n").split("  ", 1)
+            ret[name] = digest
+    return ret
+
+
+def _index_release_dir(dirpath):
+    """
+    Return index data for a single archive-* release dir. Unversioned
+    alias symlinks like virtio-win.iso are listed separately.
+    """
+    checksums = _read_checksums(dirpath)
+    files = {}
+    aliases = {}
+    for name in sorted(os.listdir(dirpath)):
+        path = os.path.join(dirpath, name)
+        if name.startswith(".") or name == "SHA256SUMS":
+            continue
+        if os.path.islink(path) and "/" not in os.readlink(path):
+            aliases[name] = os.readlink(path)
+            continue
+        if not os.path.isfile(path):
+            continue
+        files[name] = {
+            "size": os.path.getsize(path),
+            "sha256": checksums.get(name) or file_digest(path),
+        }
+    return {"files": files, "aliases": aliases}
+
+
+def _update_release_index():
+    """
+    Add any new archive-virtio and archive-qemu-ga releases to the
+    direct-downloads release index, and refresh latest/stable pointers.
+    Releases already in the index are never rescanned.
+    """
+    topdir = LocalRepo.LOCAL_DIRECT_DIR
+    path = os.path.join(topdir, RELEASE_INDEX)
+    index = {}
+    if os.path.exists(path):
+        index = json.load(open(path))
+    if index.get("version") != RELEASE_INDEX_VERSION:
+        index = {"version": RELEASE_INDEX_VERSION}
+
+    for archivedir in ["archive-virtio", "archive-qemu-ga"]:
+        releases = index.setdefault(archivedir, {})
+        for release in sorted(os.listdir(os.path.join(topdir, archivedir))):
+            releasedir = os.path.join(topdir, archivedir, release)
+            if release in releases or not os.path.isdir(releasedir):
+                continue
+            print("Adding %s/%s to %s" % (archivedir, release, RELEASE_INDEX))
+            releases[release] = _index_release_dir(releasedir)
+
+    pointers = {}
+    for linkname in ["latest-virtio", "latest-qemu-ga", "stable-virtio"]:
+        linkpath = os.path.join(topdir, linkname)
+        if os.path.islink(linkpath):
+            pointers[linkname] = os.readlink(linkpath)
+    index["links"] = pointers
+
+    tmp = path + ".tmp"
+    open(tmp, "w").write(json.dumps(index, sort_keys=True, indent=1))
+    os.replace(tmp, path)
 
 
 ########################
 # Repo generate + push #
 ########################
 
-def _add_misc_data():
+class PublishedIndex():
+    """
+    Local index of every RPM published in LOCAL_REPO_DIR, stored as
+    LOCAL_REPO_DIR/.published-index.json. It lets us find newly added
+    packages and only update symlinks and metadata for those, instead
+    of reprocessing every RPM ever published on each run.
+    """
+    BASENAME = ".published-index.json"
+
+    def __init__(self, repodir):
+        self.repodir = repodir
+        self.path = os.path.join(repodir, self.BASENAME)
+        self.rpms = {}
+        self.stable = []
+        if os.path.exists(self.path):
+            data = json.load(open(self.path))
+            self.rpms = data.get("rpms", {})
+            self.stable = data.get("stable", [])
+
+    def save(self):
+        data = {"rpms": self.rpms, "stable": self.stable}
+        tmp = self.path + ".tmp"
+        open(tmp, "w").write(json.dumps(data, sort_keys=True, indent=1))
+        os.replace(tmp, self.path)
+
+    def scan(self):
+        """
+        Index any RPMs not seen before, drop entries for RPMs that
+        disappeared. Returns the list of newly added repodir relative
+        paths.
+        """
+        found = set()
+        added = []
+        for subdir in ["rpms", "srpms"]:
+            for fullpath in glob.glob(
+                    os.path.join(self.repodir, subdir, "*.rpm")):
+                relpath = os.path.relpath(fullpath, self.repodir)
+                found.add(relpath)
+                size = os.path.getsize(fullpath)
+                entry = self.rpms.get(relpath)
+                if entry and entry["size"] == size:
+                    continue
+
+                rpm = RPMFile(fullpath)
+                self.rpms[relpath] = {
+                    "name": rpm.tags.get(RPMTAG_NAME),
+                    "nvra": rpm.nvra,
+                    "size": size,
+                    "sha256": file_digest(fullpath),
+                    "header_range": [rpm.header_start, rpm.header_end],
+                }
+                added.append(relpath)
+
+        for relpath in list(self.rpms):
+            if relpath not in found:
+                self.rpms.pop(relpath)
+        return sorted(added)
+
+
+def _add_misc_data(full):
     """
     Add tree stable links, and misc data
+
+    Returns the list of LOCAL_REPO_DIR subdirs whose content changed,
+    and the updated PublishedIndex. The caller saves the index once the
+    repodata for those subdirs is generated
     """
     LOCAL_REPO_DIR = LocalRepo.LOCAL_REPO_DIR
+    index = PublishedIndex(LOCAL_REPO_DIR)
+    if full:
+        index.rpms = {}
+        index.stable = []
+    added = index.scan()
+    changed = []
 
     # Generate stable symlinks
     for stablever in STABLE_RPMS:
+        if stablever in index.stable:
+            continue
         filename = "virtio-win-%s.noarch.rpm" % stablever
         _add_relative_link(LOCAL_REPO_DIR,
                 "rpms/%s" % filename,
                 "stable/%s" % filename)
+        index.stable.append(stablever)
+        changed.append("stable")
 
     # Generate latest symlinks
-    for fullpath in glob.glob(os.path.join(LOCAL_REPO_DIR, "rpms", "*.rpm")):
-        filename = os.path.basename(fullpath)
+    for relpath in added:
+        if relpath.startswith("srpms/"):
+            changed.append("srpms")
+            continue
+        filename = os.path.basename(relpath)
         _add_relative_link(LOCAL_REPO_DIR,
                 "rpms/%s" % filename,
                 "latest/%s" % filename)
+        changed.append("latest")
 
     def cp(srcpath, dstpath):
         # Copy, but not if content is unchanged
@@ -332,80 +523,180 @@ def _add_misc_data():
         shutil.copy(srcpath, dstpath)
 
     # Put the repo file in place
-    cp("data/virtio-win.repo",
+    cp(os.path.join(TOP_DIR, "data", "virtio-win.repo"),
             os.path.join(LocalRepo.LOCAL_ROOT_DIR, "virtio-win.repo"))
     # Use the RPM changelog as a changelog file for the whole tree
-    cp("data/rpm_changelog",
+    cp(os.path.join(TOP_DIR, "data", "rpm_changelog"),
             os.path.join(LocalRepo.LOCAL_ROOT_DIR, "CHANGELOG"))
 
+    return sorted(set(changed)), index
+
 
-def _run_createrepo():
+def _run_createrepo(changed, full):
     """
-    Run yum createrepo
+    Run yum createrepo, but only for repo dirs with new packages.
+    Existing package metadata is reused without re-stat()ing every
+    published RPM, since published RPMs never change.
     """
+    # The repo dirs are independent, so generate them concurrently
+    runner = CommandRunner()
     for rpmdir in ["latest", "stable", "srpms"]:
         #shellcomm("rm -rf %s" %
         #    os.path.join(LOCAL_REPO_DIR, rpmdir, "repodata"))
-        shellcomm("createrepo_c %s --update > /dev/null" %
-            os.path.join(LocalRepo.LOCAL_REPO_DIR, rpmdir))
+        path = os.path.join(LocalRepo.LOCAL_REPO_DIR, rpmdir)
+        if (not full and rpmdir not in changed and
+                os.path.exists(os.path.join(path, "repodata"))):
+            print("No new packages in %s, skipping createrepo" % path)
+            continue
+
+        cmd = "createrepo_c %s --update" % path
+        if not full:
+            cmd += " --skip-stat"
+        runner.add("createrepo-%s" % rpmdir, cmd, echo=False)
+    runner.run()
+
+
+# Manifest of the published mirror content, as of the last push
+PUBLISH_MANIFEST = ".publish-manifest.json"
+# Local bookkeeping files we never publish
+PUBLISH_EXCLUDE = [PUBLISH_MANIFEST,
+                   os.path.join("repo", PublishedIndex.BASENAME)]
+
+
+def _default_remote():
+    return ("%s@fedorapeople.org:/srv/groups/virt/virtio-win" %
+            LocalRepo.HOSTED_USERNAME)
 
 
-def _run_rsync(reverse, dry):
-    def _cmd(opts, src, dst):
-        rsync = "rsync "
-        rsync += "--archive --verbose --compress --progress --omit-link-times --omit-dir-times "
-        if not reverse:
+def _rsync_cmd(opts, src, dst, push=True):
+    """
+    :param push: set the published ownership and permissions, when
+        syncing the local mirror to the remote. The virtmaint-sig group
+        only exists on fedorapeople.org, so a local directory --remote
+        keeps our own group
+    """
+    rsync = "rsync "
+    rsync += "--archive --verbose --progress --omit-link-times --omit-dir-times "
+    rsync += "--compress --skip-compress=%s " % "/".join(
+        publish.INCOMPRESSIBLE_SUFFIXES)
+    if push:
+        if ":" in dst:
             # There is no virtmaint-sig user, so we use our user
             rsync += "--chown=%s:virtmaint-sig " % LocalRepo.HOSTED_USERNAME
-            # Set dirs to 775 and files to 664
-            rsync += "--chmod=D775,F664 "
-        if dry:
-            rsync += "--dry-run "
-        rsync += "%s %s/ %s" % (opts, src, dst)
-        if dry:
-            # Filter out uninteresting repoadata updates
-            rsync += " | grep -Ev 'repodata/.+'"
-        return rsync
-
-    remote = ("%s@fedorapeople.org:/srv/groups/virt/virtio-win" %
-            LocalRepo.HOSTED_USERNAME)
-    local = LocalRepo.LOCAL_ROOT_DIR
+        # Set dirs to 775 and files to 664
+        rsync += "--chmod=D775,F664 "
+    rsync += "%s %s/ %s" % (opts, src, dst)
+    return rsync
 
-    if reverse:
-        src = remote
-        dst = local
-    else:
-        src = local
-        dst = remote
 
-    # Put the RPMs in place. Skip yum repodata until RPMs
-    # are inplace, to prevent users seeing an inconsistent repo
-    shellcomm(_cmd("--exclude repodata", src, dst))
+def _rsync_files(paths, opts, src, dst):
+    """
+    rsync exactly the passed relative paths from src to dst
+    """
+    with tempfile.NamedTemporaryFile("w",
+            prefix="virtio-win-publish-") as listfile:
+        listfile.write("".join(p + "\n" for p in paths))
+        listfile.flush()
+        shellcomm(_rsync_cmd("--files-from=%s %s" % (listfile.name, opts),
+            src, dst))
+
 
-    # Overwrite the repodata and remove stale files
-    args = ""
-    # This says we only want to sync repodata/* and below, so we
-    # avoid possibly deleting anything else
-    args += '--include "*/" --include "repodata/*" --exclude "*" '
-    args += "--delete"
-    shellcomm(_cmd(args, src, dst))
+def _is_repodata(relpath):
+    return "/repodata/" in "/" + relpath
 
 
-def _push_repos(reverse):
+def _resync_repos(remote):
+    """
+    rsync the fedorapeople.org content back to the local mirror
+    """
+    src = remote
+    dst = LocalRepo.LOCAL_ROOT_DIR
+
+    # Content first, then the repodata, deleting stale local repodata.
+    # The include/exclude rules say we only want to sync repodata/* and
+    # below, so we avoid possibly deleting anything else
+    passes = ["--exclude repodata",
+              '--include "*/" --include "repodata/*" --exclude "*" '
+              "--delete"]
+
+    print()
+    print()
+    for opts in passes:
+        shellcomm(_rsync_cmd("--dry-run " + opts, src, dst, push=False))
+    print()
+    print()
+    if not yes_or_no("Review the --dry-run changes. "
+        "Do you want to pull? (y/n): "):
+        sys.exit(1)
+    for opts in passes:
+        shellcomm(_rsync_cmd(opts, src, dst, push=False))
+
+    # The local tree now matches the mirror
+    manifest_path = os.path.join(dst, PUBLISH_MANIFEST)
+    publish.save_manifest(manifest_path, publish.scan_tree(dst,
+        previous=publish.load_manifest(manifest_path),
+        exclude=PUBLISH_EXCLUDE))
+
+
+def _push_repos(remote):
     """
     rsync the changes to fedorapeople.org
     """
+    local = LocalRepo.LOCAL_ROOT_DIR
+    manifest_path = os.path.join(local, PUBLISH_MANIFEST)
+    remote_manifest = publish.load_manifest(manifest_path)
+    if not remote_manifest:
+        print("No %s found, planning a full upload. rsync will still "
+              "skip unchanged files." % manifest_path)
+    local_manifest = publish.scan_tree(local,
+        previous=remote_manifest, exclude=PUBLISH_EXCLUDE)
+    transfers, deletes = publish.plan(local_manifest, remote_manifest)
+
+    content = [p for p in transfers if not _is_repodata(p)]
+    metadata = [p for p in transfers if _is_repodata(p)]
+    stale = [p for p in deletes if _is_repodata(p)]
+    untouched = [p for p in deletes if not _is_repodata(p)]
+
     print()
     print()
-    _run_rsync(reverse=reverse, dry=True)
+    print("Publish plan for %s:" % remote)
+    for path in content:
+        print("  upload  %s (%d bytes)" % (path,
+            local_manifest[path].get("size", 0)))
+    for path in metadata:
+        print("  upload  %s" % path)
+    for path in stale:
+        print("  delete  %s" % path)
+    for path in untouched:
+        print("  (not deleting %s, only stale repodata is removed)" % path)
+    print("Total: %d files, %d bytes to upload, %d to delete" % (
+        len(content) + len(metadata),
+        publish.transfer_size(local_manifest, content + metadata),
+        len(stale)))
+
+    if not content and not metadata and not stale:
+        print("Mirror is already up to date.")
+        publish.save_manifest(manifest_path, local_manifest)
+        return
 
     print()
     print()
-    if not yes_or_no("Review the --dry-run changes. "
+    if not yes_or_no("Review the planned changes. "
         "Do you want to push? (y/n): "):
         sys.exit(1)
 
-    _run_rsync(reverse=reverse, dry=False)
+    # Put the RPMs in place. Skip yum repodata until RPMs
+    # are inplace, to prevent users seeing an inconsistent repo
+    if content:
+        _rsync_files(content, "", local, remote)
+
+    # Overwrite the repodata and remove stale files. Listed files that
+    # no longer exist locally are deleted on the remote
+    if metadata or stale:
+        _rsync_files(metadata + stale, "--delete-missing-args",
+            local, remote)
+
+    publish.save_manifest(manifest_path, local_manifest)
 
 
 ###################
@@ -421,11 +712,22 @@ def parse_args():
         help="Directory containing built virtio-win* RPMs")
     parser.add_argument("--rpm-buildroot",
         help="Directory containing RPM buildroot content")
+    parser.add_argument("--new-builds-dir",
+        help="Build input to publish. Default=the current new-builds/ "
+             "generation")
     parser.add_argument("--regenerate-only", action="store_true",
         help="Only regenerate and push the repo contents")
+    parser.add_argument("--full-regenerate", action="store_true",
+        help="Rescan every published RPM and rerun createrepo on every "
+             "repo dir, rather than only handling newly added RPMs")
     parser.add_argument("--resync", action="store_true",
         help="rsync fedorapeople contents back to the local machine,"
              "to reset the local mirror.")
+    parser.add_argument("--remote",
+        help="rsync destination to publish to, or to --resync from. Can "
+             "be a local directory, files pushed there keep our group "
+             "rather than virtmaint-sig. "
+             "Default=fedorapeople.org virtio-win group dir")
 
     return parser.parse_args()
 
@@ -438,14 +740,22 @@ def main():
             fail("--rpm-output and --rpm-buildroot must both "
                     "be specified, or pass --regenerate-only to "
                     "regen just the repo.")
-        buildversions = BuildVersions()
-        _populate_local_tree(buildversions,
+        new_builds_dir = options.new_builds_dir or newbuilds.pin()
+        _populate_local_tree(new_builds_dir,
                 options.rpm_output, options.rpm_buildroot)
 
     if not options.resync:
-        _add_misc_data()
-        _run_createrepo()
-    _push_repos(reverse=options.resync)
+        _update_release_index()
+        changed, index = _add_misc_data(options.full_regenerate)
+        _run_createrepo(changed, options.full_regenerate)
+        # If createrepo failed, the next run has to see these RPMs as
+        # added again, or their repo dirs keep the stale repodata
+        index.save()
+    remote = options.remote or _default_remote()
+    if options.resync:
+        _resync_repos(remote)
+    else:
+        _push_repos(remote)
 
     return 0
 
@@ -14,6 +14,7 @@
 
 import argparse
 import atexit
+import concurrent.futures
 import configparser
 import glob
 import hashlib
@@ -25,6 +26,8 @@ import sys
 import tempfile
 
 from util import filemap
+from util import instrument
+from util import sourcemap
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -36,10 +39,12 @@ def run(cmd, shell=False):
     """
     Run a command and collect the output and return value
     """
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=shell,
-                            stderr=subprocess.STDOUT, close_fds=True)
-    output, dummy = proc.communicate()
-    ret = proc.wait()
+    cmdstr = cmd if shell else " ".join(cmd)
+    with instrument.span(cmdstr[:80], category="shell", cmd=cmdstr):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=shell,
+                                stderr=subprocess.STDOUT, close_fds=True)
+        output, dummy = proc.communicate()
+        ret = proc.wait()
     if ret != 0:
         print('Command had a bad exit code: %s' % ret)
         print('Command run: %s' % cmd)
@@ -128,12 +133,49 @@ def generate_version_manifest(isodir, datadir):
 # Functional helpers #
 ######################
 
+def _all_drop(variants, relpath):
+    return all(filemap.variant_drops(v, relpath) for v in variants)
+
+
+def copy_driver_dir(driverdir, destdir, variants, exclude=(), link=False):
+    """
+    cp -rpL the driverdir content into destdir, leaving out the driver
+    and OS dirs that every one of variants drops. Those are never copied
+    at all, so they aren't hashed or archived either.
+
+    :param link: hardlink the files instead of copying them
+    """
+    cpargs = ["cp", "-rpl" if link else "-rpL"]
+    sources = []
+    for name in sorted(os.listdir(driverdir)):
+        path = os.path.join(driverdir, name)
+        if name in exclude or _all_drop(variants, name):
+            continue
+        subnames = sorted(os.listdir(path)) if os.path.isdir(path) else []
+        kept = [n for n in subnames if
+                not _all_drop(variants, os.path.join(name, n))]
+        if len(kept) == len(subnames):
+            sources.append(path)
+            continue
+
+        # Only copy the OS dirs the variants keep
+        os.makedirs(os.path.join(destdir, name), exist_ok=True)
+        if kept:
+            run(cpargs + [os.path.join(path, n) for n in kept] +
+                [os.path.join(destdir, name)])
+    if sources:
+        run(cpargs + sources + [destdir])
+
+
 def create_auto_symlinks(isodir):
     """
     Create the autodetectable dir hierarchy. For example, taking
     all content under $ISO/viostor/w10/amd64/* and linking it
     into $ISO/amd64/w10
+
+    Returns a list of (newpath, path) relative to isodir
     """
+    links = []
     for (driver, osname, arch, path) in _find_driver_os_arch_dirs(isodir):
         if osname in filemap.AUTO_OS_BLACKLIST:
             continue
@@ -146,17 +188,55 @@ def create_auto_symlinks(isodir):
                 os.path.basename(path))
         os.makedirs(os.path.dirname(newpath), exist_ok=True)
         os.link(path, newpath)
+        links.append((os.path.relpath(newpath, isodir),
+                      os.path.relpath(path, isodir)))
+    return links
 
 
-def hardlink_identical_files(outdir):
+def update_source_map(isodir, links, variant):
+    """
+    Add the extra copies of driver files to the make-driver-dir.py
+    source map, if the driver dir has one, and drop the files the
+    variant left out.
+
+    :param links: list of (newpath, path), newpath being a copy of the
+        driver dir file at path
+    """
+    path = os.path.join(isodir, sourcemap.MANIFEST_PATH)
+    if not os.path.exists(path):
+        return
+    entries = [(dest, source, origin) for dest, source, origin in
+               sourcemap.read_manifest(path)
+               if not filemap.variant_drops(variant, dest)]
+    bydest = dict((dest, (source, origin))
+                  for dest, source, origin in entries)
+    for newpath, oldpath in links:
+        if oldpath in bydest:
+            entries.append((newpath,) + bydest[oldpath])
+    sourcemap.write_manifest(path, entries)
+
+
+def hardlink_identical_files(outdir, digests=None):
+    """
+    :param digests: {(st_dev, st_ino): md5} of files already hashed,
+        shared between variant trees that hardlink the same content
+    """
     print("Hardlinking identical files...")
+    if digests is None:
+        digests = {}
 
     hashmap = {}
     for root, dirs, files in os.walk(outdir):
         dummy = dirs
         for f in files:
             path = os.path.join(root, f)
-            md5 = hashlib.md5(open(path, 'rb').read()).hexdigest()
+            st = os.stat(path)
+            md5 = digests.get((st.st_dev, st.st_ino))
+            if md5 is None:
+                content = open(path, 'rb').read()
+                instrument.add_bytes("hashed", len(content))
+                md5 = hashlib.md5(content).hexdigest()
+                digests[(st.st_dev, st.st_ino)] = md5
             if md5 not in hashmap:
                 hashmap[md5] = path
                 continue
@@ -166,9 +246,9 @@ def hardlink_identical_files(outdir):
             run(["ln", hashmap[md5], path])
 
 
-def archive(nvr, finaldir):
+def archive(nvr, finaldir, outdir):
     """
-    tar up the working directory
+    tar up the working directory, and copy the result to outdir
     """
 
     # Generate .tar.gz
@@ -178,8 +258,9 @@ def archive(nvr, finaldir):
     run('cd %s && tar -czvf %s %s' %
         (os.path.dirname(finaldir), archivefile, nvr), shell=True)
 
-    # Copy results to cwd
-    newarchive = os.path.join(os.getcwd(), os.path.basename(archivefile))
+    # Copy results to outdir
+    os.makedirs(outdir, exist_ok=True)
+    newarchive = os.path.join(outdir, os.path.basename(archivefile))
     shutil.copy2(archivefile, newarchive)
     print('archive successfully built: %s' % newarchive)
 
@@ -203,13 +284,26 @@ Example: %(prog)s virtio-win-1.2.3 /path/to/built/drivers
         "example=virtio-win-1.2.3")
     parser.add_argument("driverdir",
         help="Directory containing the built drivers.")
+    parser.add_argument("--variant", dest="variants", action="append",
+        choices=sorted(filemap.VARIANTS), default=[],
+        help="Build variant. OS dirs and drivers it drops, see "
+        "'variants' in util/filemap.json, are left out of the archive "
+        "even if driverdir has them. Can be specified multiple times, "
+        "to build every variant's archive concurrently into "
+        "$output_dir/$variant/. Default=%s" % filemap.DEFAULT_VARIANT)
+    parser.add_argument("--output-dir", "--outdir", default=os.getcwd(),
+        help="Directory to write the archive to. Default=%(default)s")
 
     options = parser.parse_args()
+    if not options.variants:
+        options.variants = [filemap.DEFAULT_VARIANT]
+    if len(set(options.variants)) != len(options.variants):
+        parser.error("--variant specified twice")
 
     return options
 
 
-def make_rpm_driver_dirs(driverdir, rpmdriversdir):
+def make_rpm_driver_dirs(driverdir, rpmdriversdir, variant):
     """
     Build the driver dirs that are installed on the host by the RPM.
 
@@ -217,15 +311,21 @@ def make_rpm_driver_dirs(driverdir, rpmdriversdir):
         by-driver/viorng/w10/x86/
     * virtio-win/by-os: Has layout matching windows autodetect arch:
         by-os/i386/w10/
+
+    Returns a list of (by-os path, by-driver path) relative to
+    rpmdriversdir and by-driver respectively
     """
     by_driver = os.path.join(rpmdriversdir, "by-driver")
     by_os = os.path.join(rpmdriversdir, "by-os")
 
-    # Copy driverdir content into the dest by-driver dir
+    # Link driverdir content into the dest by-driver dir. The data dir
+    # is only for the ISO
     os.makedirs(by_driver)
-    run(["cp", "-rpL", "%s/." % driverdir, by_driver])
+    copy_driver_dir(driverdir, by_driver, [variant], exclude=["data"],
+                    link=True)
 
     # Build the by-os tree from the by-driver tree
+    links = []
     for (driver, osname, arch, path) in _find_driver_os_arch_dirs(by_driver):
         if path.endswith(".pdb"):
             # This files take up a ton of space. Skip them
@@ -237,14 +337,17 @@ def make_rpm_driver_dirs(driverdir, rpmdriversdir):
         destpath = os.path.join(destdir, os.path.basename(path))
         if not os.path.exists(destpath):
             os.link(path, os.path.join(destdir, os.path.basename(path)))
+            links.append((os.path.relpath(destpath, rpmdriversdir),
+                          os.path.relpath(path, by_driver)))
+    return links
 
 
-def main():
-    options = get_options()
-
-    rootdir = tempfile.mkdtemp(prefix='virtio-win-archive-')
-    atexit.register(lambda: shutil.rmtree(rootdir))
-    finaldir = os.path.join(rootdir, options.nvr)
+def build_variant(nvr, driverdir, workdir, variant, digests):
+    """
+    Build the variant's tree in workdir from driverdir, hardlinking
+    its files. Returns the tree's top dir, for archive()
+    """
+    finaldir = os.path.join(workdir, nvr)
     isodir = os.path.join(finaldir, "iso-content")
     datadir = os.path.join(isodir, "data")
     rpmdriversdir = os.path.join(finaldir, "rpm-drivers")
@@ -258,20 +361,68 @@ def main():
             os.path.join(script_dir, "data", "virtio-win*.xml")):
         run(["cp", "-rpL", filename, osinfoxmldir])
 
-    # Copy driverdir content into the dest isodir
-    run(["cp", "-rpL", "%s/." % options.driverdir, isodir])
+    # Link driverdir content into the dest isodir
+    copy_driver_dir(driverdir, isodir, [variant], link=True)
 
     # Create version manifest file
-    generate_version_manifest(isodir, datadir)
+    with instrument.span("version manifest", variant=variant):
+        generate_version_manifest(isodir, datadir)
 
     # Create the auto directory naming symlink tree
-    create_auto_symlinks(isodir)
+    links = create_auto_symlinks(isodir)
 
     # Build by-os and by-driver dirs for the RPM
-    make_rpm_driver_dirs(options.driverdir, rpmdriversdir)
+    links += make_rpm_driver_dirs(driverdir, rpmdriversdir, variant)
+    update_source_map(isodir, links, variant)
+
+    with instrument.span("hardlink identical files", variant=variant):
+        hardlink_identical_files(finaldir, digests)
+    return finaldir
+
+
+def archive_variant(nvr, finaldir, variant, outdir):
+    with instrument.span("archive", variant=variant):
+        archive(nvr, finaldir, outdir)
+
+
+def main():
+    options = get_options()
+    variants = options.variants
+
+    rootdir = tempfile.mkdtemp(prefix='virtio-win-archive-')
+    atexit.register(lambda: shutil.rmtree(rootdir))
 
-    hardlink_identical_files(finaldir)
-    archive(options.nvr, finaldir)
+    # Copy the driverdir once. Every variant tree hardlinks to this
+    # copy, so its files are only hashed once too
+    shared = os.path.join(rootdir, "driverdir")
+    os.makedirs(shared)
+    copy_driver_dir(options.driverdir, shared, variants)
+
+    # With several variants, each gets its own output subdir
+    output_dir = os.path.abspath(options.output_dir)
+    outdirs = {variants[0]: output_dir}
+    if len(variants) > 1:
+        outdirs = dict((variant, os.path.join(output_dir, variant))
+                       for variant in variants)
+
+    # Every variant tree links the same inodes, and linking or
+    # unlinking them changes their ctime, which makes a concurrent tar
+    # fail with 'file changed as we read it'. So build all the trees
+    # first, and only archive them concurrently
+    digests = {}
+    finaldirs = {}
+    for variant in variants:
+        finaldirs[variant] = build_variant(options.nvr, shared,
+            os.path.join(rootdir, "variant-" + variant), variant, digests)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(variants)) as pool:
+        futures = [pool.submit(archive_variant, options.nvr,
+                               finaldirs[variant], variant,
+                               outdirs[variant])
+                   for variant in variants]
+        for future in futures:
+            future.result()
 
     return 0
 
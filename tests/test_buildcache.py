@@ -0,0 +1,76 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import glob
+import os
+import shutil
+import sys
+
+import pytest
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+from util import driverinput
+from util.buildcache import BuildCache, script_files
+
+
+# Everything make-driver-dir.py runs, plus the driverinput.py code
+# that picks its arguments
+DRIVER_DIR_FILES = [
+    "make-driver-dir.py",
+    "util/driverinput.py",
+    "util/drivertree.py",
+    "util/filemap.json",
+    "util/filemap.py",
+    "util/fileutils.py",
+    "util/instrument.py",
+    "util/sourcemap.py",
+    "util/utils.py",
+]
+
+
+def _relnames(paths):
+    return sorted(os.path.relpath(p, TOP_DIR) for p in paths)
+
+
+@pytest.mark.parametrize("script,expected", [
+    ("make-installer.py",
+     ["make-installer.py", "util/instrument.py", "util/utils.py"]),
+    ("make-virtio-win-rpm-archive.py",
+     ["make-virtio-win-rpm-archive.py", "util/filemap.py",
+      "util/instrument.py", "util/sourcemap.py", "util/utils.py"]),
+])
+def test_script_files(script, expected):
+    assert _relnames(script_files(os.path.join(TOP_DIR, script))) == expected
+
+
+@pytest.fixture(name="topdir")
+def fixture_topdir(tmp_path, monkeypatch):
+    topdir = str(tmp_path / "top")
+    os.makedirs(os.path.join(topdir, "util"))
+    os.makedirs(os.path.join(topdir, "data", "old-drivers"))
+    shutil.copy(os.path.join(TOP_DIR, "make-driver-dir.py"), topdir)
+    for path in (glob.glob(os.path.join(TOP_DIR, "util", "*.py")) +
+                 [os.path.join(TOP_DIR, "util", "filemap.json")]):
+        shutil.copy(path, os.path.join(topdir, "util"))
+    monkeypatch.setattr(driverinput, "TOP_DIR", topdir)
+    return topdir
+
+
+@pytest.mark.parametrize("relpath", DRIVER_DIR_FILES)
+def test_driver_dir_key(tmp_path, topdir, relpath):
+    cache = BuildCache(str(tmp_path / "cache"))
+    orig = driverinput.cache_key(cache, [])
+
+    with open(os.path.join(topdir, relpath), "a") as fp:
+        fp.write("\n")
+    assert driverinput.cache_key(cache, []) != orig
+
+
+def test_driver_dir_key_unrelated(tmp_path, topdir):
+    cache = BuildCache(str(tmp_path / "cache"))
+    orig = driverinput.cache_key(cache, [])
+
+    with open(os.path.join(topdir, "util", "rpmfile.py"), "a") as fp:
+        fp.write("\n")
+    assert driverinput.cache_key(cache, []) == orig
@@ -0,0 +1,50 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.buildversions import SCHEMA_KEY, SCHEMA_VERSION, BuildVersions
+
+
+BASEURL = "https://example.com/builds"
+DATA = {
+    "mingw-qemu-ga-win": {"version": "109.0.0-1", "urls": [
+        BASEURL + "/mingw-qemu-ga-win-109.0.0-1.el9.src.rpm",
+        BASEURL + "/qemu-ga-win-109.0.0-1.el9.noarch.rpm"]},
+    "qxl": {"version": "0.1-24", "urls": [
+        BASEURL + "/qxl-win-unsigned-0.1-24-sources.zip",
+        BASEURL + "/qxl_w7_x64.zip"]},
+    "qxlwddm": {"version": "0.21-2", "urls": [
+        BASEURL + "/spice-qxl-wddm-dod-0.21-2-sources.zip",
+        BASEURL + "/spice-qxl-wddm-dod.zip"]},
+    "virtio-win-prewhql": {"version": "0.1-285", "urls": [
+        BASEURL + "/virtio-win-prewhql-0.1-285-sources.zip",
+        BASEURL + "/virtio-win-prewhql-0.1.zip"]},
+    "spice-vdagent-win": {"version": "0.10.0-5", "urls": [
+        BASEURL + "/spice-vdagent-win-0.10.0-5-sources.zip",
+        BASEURL + "/spice-vdagent-x64-0.10.0-5.msi"]},
+}
+
+
+def test_roundtrip_writes_schema(tmp_path):
+    path = str(tmp_path / "buildversions.json")
+    BuildVersions.from_data(DATA).write(path)
+
+    written = json.load(open(path))
+    assert written[SCHEMA_KEY] == SCHEMA_VERSION
+
+    loaded = BuildVersions(path)
+    assert loaded.to_data() == written
+    assert loaded.virtio_prewhql_str == "virtio-win-prewhql-0.1-285"
+
+
+def test_load_without_schema():
+    # Files written before SCHEMA_KEY existed are version 1
+    assert SCHEMA_KEY not in DATA
+    data = BuildVersions.from_data(DATA).to_data()
+    assert data[SCHEMA_KEY] == SCHEMA_VERSION
+    del data[SCHEMA_KEY]
+    assert data == DATA
@@ -0,0 +1,171 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import http.server
+import io
+import os
+import re
+import sys
+import threading
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import download
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves server.files. server.honor_ranges and server.truncate (how
+    many responses to cut in half) control misbehaving
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.headers.get("Range"))
+            truncate = server.truncate > 0
+            server.truncate -= 1
+
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = '"%d"' % len(data)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        status = 200
+        start, end = 0, len(data) - 1
+        match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get("Range", ""))
+        if match and server.honor_ranges:
+            status = 206
+            start, end = int(match.group(1)), int(match.group(2))
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        if status == 206:
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, len(data)))
+        self.end_headers()
+        body = data[start:end + 1]
+        if truncate:
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+
+@pytest.fixture(name="server")
+def fixture_server(monkeypatch):
+    # Small enough that the test files are segmented
+    monkeypatch.setattr(download, "SEGMENT_MIN_SIZE", 64 * 1024)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.files = {}
+    server.requests = []
+    server.honor_ranges = True
+    server.truncate = 0
+    server.lock = threading.Lock()
+    server.url = "http://127.0.0.1:%d" % server.server_port
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              kwargs={"poll_interval": 0.05})
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _data(size):
+    return bytes(i % 251 for i in range(size))
+
+
+def test_segmented(tmp_path, server):
+    server.files["/big.bin"] = _data(256 * 1024 + 7)
+    path = str(tmp_path / "big.bin")
+    download.download(server.url + "/big.bin", path, connections=4)
+
+    assert open(path, "rb").read() == server.files["/big.bin"]
+    # The initial GET, then one request per segment
+    assert server.requests[0] is None
+    assert len(server.requests) == 5
+    assert all(r.startswith("bytes=") for r in server.requests[1:])
+    assert not os.path.exists(path + ".part")
+
+
+def test_small_single_request(tmp_path, server):
+    server.files["/small.bin"] = _data(1000)
+    path = str(tmp_path / "small.bin")
+    download.download(server.url + "/small.bin", path, connections=4)
+    assert open(path, "rb").read() == server.files["/small.bin"]
+    assert server.requests == [None]
+
+
+def test_ranges_ignored(tmp_path, server):
+    server.honor_ranges = False
+    server.files["/big.bin"] = _data(256 * 1024)
+    path = str(tmp_path / "big.bin")
+    download.download(server.url + "/big.bin", path, connections=4)
+
+    assert open(path, "rb").read() == server.files["/big.bin"]
+    # The last request is the single stream fallback
+    assert server.requests[-1] is None
+
+
+@pytest.mark.parametrize("name,size", [("small.bin", 1000),
+                                       ("big.bin", 256 * 1024)])
+def test_truncated_retry(tmp_path, server, name, size):
+    server.truncate = 1
+    server.files["/" + name] = _data(size)
+    path = str(tmp_path / name)
+    download.download(server.url + "/" + name, path, connections=4)
+    assert open(path, "rb").read() == server.files["/" + name]
+
+
+def test_truncated_fails(tmp_path, server):
+    server.truncate = 1000
+    server.files["/small.bin"] = _data(1000)
+    path = str(tmp_path / "small.bin")
+    with pytest.raises(SystemExit):
+        download.download(server.url + "/small.bin", path)
+    assert len(server.requests) == download.DOWNLOAD_ATTEMPTS
+    assert not os.path.exists(path)
+
+
+def _zip(content):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("driver.sys", content)
+    return buf.getvalue()
+
+
+def test_zip_crc(tmp_path, server):
+    content = b"A" * 1000
+    server.files["/good.zip"] = _zip(content)
+    data = bytearray(_zip(content))
+    data[data.find(content) + 500] = ord("B")
+    server.files["/bad.zip"] = bytes(data)
+
+    path = str(tmp_path / "good.zip")
+    download.download(server.url + "/good.zip", path)
+    assert open(path, "rb").read() == server.files["/good.zip"]
+
+    path = str(tmp_path / "bad.zip")
+    with pytest.raises(SystemExit):
+        download.download(server.url + "/bad.zip", path)
+    assert not os.path.exists(path)
+
+
+def test_get_text_revalidates(server):
+    download.clear_cache()
+    server.files["/index.html"] = b"<a href=foo.zip>"
+    url = server.url + "/index.html"
+    assert download.get_text(url) == "<a href=foo.zip>"
+    assert download.get_text(url) == "<a href=foo.zip>"
+    assert len(server.requests) == 2
+    download.clear_cache()
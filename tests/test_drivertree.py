@@ -0,0 +1,108 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.drivertree import DriverInputTree
+
+
+def _write_zip(path, files):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return path
+
+
+def _write_dir(path, files):
+    for name, content in files.items():
+        fullpath = os.path.join(path, name)
+        os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+        open(fullpath, "w").write(content)
+    return path
+
+
+def _read(tree, relpath, tmp_path):
+    dest = str(tmp_path / "out")
+    tree.copy(relpath, dest)
+    return open(dest).read()
+
+
+def test_overlay_precedence(tmp_path):
+    tree = DriverInputTree()
+    tree.add_zip(_write_zip(str(tmp_path / "a.zip"), {
+        "viostor/w10/amd64/viostor.sys": "zip-a",
+        "viostor/w10/amd64/viostor.inf": "zip-a",
+        "NetKVM/w10/amd64/netkvm.sys": "zip-a",
+    }))
+    tree.add_zip(_write_zip(str(tmp_path / "b.zip"), {
+        "viostor/w10/amd64/viostor.sys": "zip-b",
+    }))
+    tree.add_dir(_write_dir(str(tmp_path / "overlay"), {
+        "NetKVM/w10/amd64/netkvm.sys": "overlay",
+    }))
+
+    assert tree.files() == [
+        "NetKVM/w10/amd64/netkvm.sys",
+        "viostor/w10/amd64/viostor.inf",
+        "viostor/w10/amd64/viostor.sys",
+    ]
+    assert _read(tree, "viostor/w10/amd64/viostor.sys", tmp_path) == "zip-b"
+    assert _read(tree, "viostor/w10/amd64/viostor.inf", tmp_path) == "zip-a"
+    assert _read(tree, "NetKVM/w10/amd64/netkvm.sys", tmp_path) == "overlay"
+    assert tree.origin("viostor/w10/amd64/viostor.sys") == (
+        "b.zip:viostor/w10/amd64/viostor.sys")
+    assert tree.origin("NetKVM/w10/amd64/netkvm.sys") == (
+        "overlay/NetKVM/w10/amd64/netkvm.sys")
+    assert tree.glob("viostor/w10/amd64/*.sys") == [
+        "viostor/w10/amd64/viostor.sys"]
+    assert tree.leaf_dirs() == ["NetKVM/w10/amd64", "viostor/w10/amd64"]
+
+
+def test_prefix(tmp_path):
+    tree = DriverInputTree()
+    tree.add_zip(_write_zip(str(tmp_path / "qxl_w7_x64.zip"), {
+        "w7/amd64/qxl.sys": "zip",
+    }), prefix="qxl")
+    tree.add_dir(_write_dir(str(tmp_path / "Win7"), {
+        "amd64/qxl.sys": "overlay",
+    }), prefix="qxl/w7")
+
+    assert tree.files() == ["qxl/w7/amd64/qxl.sys"]
+    assert _read(tree, "qxl/w7/amd64/qxl.sys", tmp_path) == "overlay"
+    assert tree.glob("qxl/w7/amd64/*") == ["qxl/w7/amd64/qxl.sys"]
+    assert tree.glob("w7/amd64/*") == []
+
+
+@pytest.mark.parametrize("name,prefix", [
+    ("../escape.sys", ""),
+    ("viostor/../../escape.sys", ""),
+    ("/etc/escape.sys", ""),
+    ("escape.sys", "../outside"),
+    ("../../escape.sys", "qxl"),
+])
+def test_path_traversal(tmp_path, name, prefix):
+    tree = DriverInputTree()
+    path = _write_zip(str(tmp_path / "evil.zip"), {name: "evil"})
+    with pytest.raises(SystemExit):
+        tree.add_zip(path, prefix)
+
+
+def test_dir_prefix_traversal(tmp_path):
+    tree = DriverInputTree()
+    path = _write_dir(str(tmp_path / "overlay"), {"a.sys": "x"})
+    with pytest.raises(SystemExit):
+        tree.add_dir(path, prefix="../..")
+
+
+def test_missing_inputs(tmp_path):
+    tree = DriverInputTree()
+    with pytest.raises(SystemExit):
+        tree.add_dir(str(tmp_path / "missing"))
+    notzip = _write_dir(str(tmp_path), {"notzip.zip": "text"})
+    with pytest.raises(SystemExit):
+        tree.add_zip(os.path.join(notzip, "notzip.zip"))
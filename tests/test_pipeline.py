@@ -0,0 +1,126 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.pipeline import Pipeline
+from util.utils import fail
+
+
+def test_dependency_order():
+    order = []
+    lock = threading.Lock()
+
+    def _stage(name, outputs):
+        def _func(**kwargs):
+            with lock:
+                order.append((name, sorted(kwargs.items())))
+            return dict((o, name + ":" + o) for o in outputs)
+        return _func
+
+    pipeline = Pipeline(jobs=4)
+    pipeline.add_artifact("seed", "S")
+    # Added out of order on purpose
+    pipeline.add_stage("d", _stage("d", []), inputs=["b1", "c1"])
+    pipeline.add_stage("b", _stage("b", ["b1"]), inputs=["a1"],
+                       outputs=["b1"])
+    pipeline.add_stage("c", _stage("c", ["c1"]), inputs=["a1", "seed"],
+                       outputs=["c1"])
+    pipeline.add_stage("a", _stage("a", ["a1"]), inputs=["seed"],
+                       outputs=["a1"])
+    pipeline.run()
+
+    names = [name for name, dummy in order]
+    assert names[0] == "a"
+    assert sorted(names[1:3]) == ["b", "c"]
+    assert names[3] == "d"
+    assert dict(order)["c"] == [("a1", "a:a1"), ("seed", "S")]
+    assert dict(order)["d"] == [("b1", "b:b1"), ("c1", "c:c1")]
+    assert pipeline.artifacts["b1"] == "b:b1"
+    assert [s.name for s in pipeline.critical_path()][0] == "a"
+
+
+def test_error_propagation():
+    ran = []
+
+    def _fail():
+        raise ValueError("stage broke")
+
+    pipeline = Pipeline(jobs=2)
+    pipeline.add_stage("bad", _fail, outputs=["x"])
+    pipeline.add_stage("after", lambda x: ran.append("after"),
+                       inputs=["x"])
+    with pytest.raises(ValueError, match="stage broke"):
+        pipeline.run()
+    assert not ran
+
+    pipeline = Pipeline()
+    pipeline.add_stage("exits", lambda: fail("fatal"))
+    with pytest.raises(SystemExit):
+        pipeline.run()
+
+
+def test_cancellation():
+    """
+    A failure lets running stages finish, but nothing queued starts
+    """
+    started = threading.Event()
+    release = threading.Event()
+    ran = []
+
+    def _slow():
+        started.set()
+        release.wait(10)
+        ran.append("slow")
+
+    def _bad():
+        started.wait(10)
+        release.set()
+        raise ValueError("bad")
+
+    pipeline = Pipeline(jobs=2)
+    pipeline.add_stage("slow", _slow)
+    pipeline.add_stage("bad", _bad)
+    for i in range(5):
+        pipeline.add_stage("queued%d" % i, lambda i=i: ran.append(i))
+    with pytest.raises(ValueError):
+        pipeline.run()
+    assert ran == ["slow"]
+
+
+def test_wrong_outputs():
+    pipeline = Pipeline()
+    pipeline.add_stage("a", lambda: {"y": 1}, outputs=["x"])
+    with pytest.raises(SystemExit):
+        pipeline.run()
+
+
+@pytest.mark.parametrize("stages", [
+    # Cycle
+    [("a", ["y"], ["x"]), ("b", ["x"], ["y"])],
+    # Input nobody produces
+    [("a", ["missing"], ["x"])],
+    # Two producers
+    [("a", [], ["x"]), ("b", [], ["x"])],
+])
+def test_bad_graph(stages):
+    ran = []
+    pipeline = Pipeline()
+    for name, inputs, outputs in stages:
+        pipeline.add_stage(name, lambda **kw: ran.append(kw),
+                           inputs=inputs, outputs=outputs)
+    with pytest.raises(SystemExit):
+        pipeline.run()
+    assert not ran
+
+
+def test_duplicate_stage():
+    pipeline = Pipeline()
+    pipeline.add_stage("a", lambda: None)
+    with pytest.raises(SystemExit):
+        pipeline.add_stage("a", lambda: None)
@@ -0,0 +1,124 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+from util import publish
+
+
+pytestmark = pytest.mark.skipif(not shutil.which("rsync"),
+                                reason="rsync is not installed")
+
+
+@pytest.fixture(name="makerepo")
+def fixture_makerepo(tmp_path, monkeypatch):
+    # make-repo.py finds the local mirror at import time
+    monkeypatch.setenv("FAS_USERNAME", "tester")
+    monkeypatch.setenv("HOME", str(tmp_path))
+    os.makedirs(str(tmp_path / "src/fedora/virt-group-repos/virtio-win"))
+
+    spec = importlib.util.spec_from_file_location("make_repo",
+        os.path.join(TOP_DIR, "make-repo.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "yes_or_no", lambda msg: True)
+    return module
+
+
+def _write(topdir, files):
+    for relpath, content in files.items():
+        path = os.path.join(topdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, "w").write(content)
+
+
+def _read(topdir):
+    ret = {}
+    for root, dummy, files in os.walk(topdir):
+        for f in files:
+            path = os.path.join(root, f)
+            ret[os.path.relpath(path, topdir)] = open(path).read()
+    return ret
+
+
+def _manifest(makerepo):
+    local = makerepo.LocalRepo.LOCAL_ROOT_DIR
+    return publish.load_manifest(
+        os.path.join(local, makerepo.PUBLISH_MANIFEST))
+
+
+def test_push(tmp_path, makerepo):
+    local = makerepo.LocalRepo.LOCAL_ROOT_DIR
+    remote = str(tmp_path / "remote")
+    os.makedirs(remote)
+    _write(local, {
+        "repo/latest/a.rpm": "a",
+        "repo/latest/repodata/repomd.xml": "v1",
+        "repo/latest/repodata/old-primary.xml": "old",
+    })
+
+    makerepo._push_repos(remote)
+    assert _read(remote) == {
+        "repo/latest/a.rpm": "a",
+        "repo/latest/repodata/repomd.xml": "v1",
+        "repo/latest/repodata/old-primary.xml": "old",
+    }
+    assert sorted(_manifest(makerepo)) == sorted(_read(remote))
+
+    # Stale repodata goes, other remote only files stay
+    os.unlink(os.path.join(local, "repo/latest/repodata/old-primary.xml"))
+    _write(local, {
+        "repo/latest/b.rpm": "b",
+        "repo/latest/repodata/repomd.xml": "v2",
+        "repo/latest/repodata/new-primary.xml": "new",
+    })
+    _write(remote, {"repo/remote-only.txt": "keep"})
+
+    makerepo._push_repos(remote)
+    assert _read(remote) == {
+        "repo/latest/a.rpm": "a",
+        "repo/latest/b.rpm": "b",
+        "repo/latest/repodata/repomd.xml": "v2",
+        "repo/latest/repodata/new-primary.xml": "new",
+        "repo/remote-only.txt": "keep",
+    }
+    manifest = _manifest(makerepo)
+    assert sorted(manifest) == sorted(set(_read(remote)) -
+                                      {"repo/remote-only.txt"})
+    assert manifest == publish.scan_tree(local,
+        exclude=makerepo.PUBLISH_EXCLUDE)
+
+
+def test_resync(tmp_path, makerepo):
+    local = makerepo.LocalRepo.LOCAL_ROOT_DIR
+    remote = str(tmp_path / "remote")
+    _write(remote, {
+        "repo/latest/a.rpm": "a",
+        "repo/latest/b.rpm": "b",
+        "repo/latest/repodata/repomd.xml": "v2",
+    })
+    _write(local, {
+        "repo/latest/a.rpm": "a",
+        "repo/latest/local-only.rpm": "local",
+        "repo/latest/repodata/repomd.xml": "v1",
+        "repo/latest/repodata/stale-primary.xml": "stale",
+    })
+
+    makerepo._resync_repos(remote)
+    files = _read(local)
+    files.pop(makerepo.PUBLISH_MANIFEST)
+    assert files == {
+        "repo/latest/a.rpm": "a",
+        "repo/latest/b.rpm": "b",
+        "repo/latest/local-only.rpm": "local",
+        "repo/latest/repodata/repomd.xml": "v2",
+    }
+    assert _manifest(makerepo) == publish.scan_tree(local,
+        exclude=makerepo.PUBLISH_EXCLUDE)
@@ -0,0 +1,227 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import gzip
+import importlib.util
+import io
+import lzma
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import types
+import zipfile
+
+import pytest
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP_DIR)
+from util import rpmfile
+from util.rpmfile import RPMFile
+
+
+def _incompressible(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+# Sized so the payload spans several of the reader's 1MiB input chunks,
+# and the members don't line up with them
+MEMBERS = [
+    ("./usr/share/doc/README", b"readme\n"),
+    ("./usr/i686-w64-mingw32/sys-root/mingw/bin/qemu-ga-i386.msi",
+     _incompressible(1536 * 1024 + 3, 1)),
+    ("./usr/share/empty", b""),
+    ("./usr/x86_64-w64-mingw32/sys-root/mingw/bin/qemu-ga-x86_64.msi",
+     _incompressible(1024 * 1024 + 1, 2)),
+    ("./usr/share/doc/after", b"not reached\n"),
+]
+
+
+def _compress(compressor, data):
+    if compressor == "gzip":
+        return gzip.compress(data)
+    if compressor == "xz":
+        return lzma.compress(data)
+    if not shutil.which("zstd"):
+        pytest.skip("zstd is not installed")
+    return subprocess.run(["zstd", "-c", "-q"], input=data,
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def _pad(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def _cpio(members):
+    out = b""
+    for ino, (name, data) in enumerate(members + [("TRAILER!!!", b"")]):
+        namebytes = name.encode() + b"\0"
+        mode = 0 if name == "TRAILER!!!" else 0o100644
+        fields = [ino, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0,
+                  len(namebytes), 0]
+        header = b"070701" + b"".join(b"%08X" % f for f in fields)
+        out += _pad(header + namebytes) + _pad(data)
+    return out
+
+
+def _header(tags):
+    """
+    :param tags: {tag: string}
+    """
+    entries = b""
+    store = b""
+    for tag, value in sorted(tags.items()):
+        entries += struct.pack(">4L", tag, 6, len(store), 1)
+        store += value.encode() + b"\0"
+    return (b"\x8e\xad\xe8\x01\0\0\0\0" +
+            struct.pack(">LL", len(tags), len(store)) + entries + store)
+
+
+def _write_rpm(path, compressor, members=None):
+    lead = b"\xed\xab\xee\xdb" + b"\0" * 92
+    signature = _header({})
+    header = _header({
+        rpmfile.RPMTAG_NAME: "qemu-ga-win",
+        rpmfile.RPMTAG_VERSION: "109.0.0",
+        rpmfile.RPMTAG_RELEASE: "1.el9",
+        rpmfile.RPMTAG_ARCH: "noarch",
+        rpmfile.RPMTAG_PAYLOADFORMAT: "cpio",
+        rpmfile.RPMTAG_PAYLOADCOMPRESSOR: compressor,
+    })
+    with open(path, "wb") as fp:
+        # The main header starts 8 byte aligned
+        fp.write(lead + signature)
+        fp.write(b"\0" * (-(len(lead) + len(signature)) % 8))
+        fp.write(header)
+        fp.write(_compress(compressor, _cpio(members or MEMBERS)))
+
+
+class _Trickle:
+    """
+    File whose read() returns at most a few bytes at a time
+    """
+    def __init__(self, data):
+        self._fp = io.BytesIO(data)
+        self._random = random.Random(0)
+
+    def read(self, size):
+        return self._fp.read(min(size, self._random.randint(1, 4099)))
+
+
+@pytest.mark.parametrize("compressor", ["gzip", "xz", "zstd"])
+def test_payload_members(tmp_path, compressor):
+    path = str(tmp_path / "test.rpm")
+    _write_rpm(path, compressor)
+    rpm = RPMFile(path)
+    assert rpm.nvra == "qemu-ga-win-109.0.0-1.el9.noarch"
+
+    found = []
+    for name, mode, size, reader in rpm.payload_members():
+        assert mode == 0o100644
+        # Odd sized reads, so they cross the reader's chunk boundaries
+        data = b""
+        while True:
+            buf = reader.read(333331)
+            if not buf:
+                break
+            data += buf
+        assert len(data) == size
+        found.append((name, data))
+    assert found == MEMBERS
+
+
+@pytest.mark.parametrize("compressor", ["gzip", "xz", "zstd"])
+def test_payload_skip_unread(tmp_path, compressor):
+    path = str(tmp_path / "test.rpm")
+    _write_rpm(path, compressor)
+
+    # Data not read is skipped, partially read data too
+    names = []
+    for name, dummy, size, reader in RPMFile(path).payload_members():
+        if size > 1:
+            assert reader.read(1) == dict(MEMBERS)[name][:1]
+        names.append(name)
+    assert names == [m[0] for m in MEMBERS]
+
+
+@pytest.mark.parametrize("decompressor,compress", [
+    (lambda: rpmfile.zlib.decompressobj(16 + rpmfile.zlib.MAX_WBITS),
+     gzip.compress),
+    (lzma.LZMADecompressor, lzma.compress),
+])
+def test_decompress_reader(decompressor, compress):
+    data = _incompressible(3 * 1024 * 1024, 3)
+    reader = rpmfile._DecompressReader(_Trickle(compress(data)),
+                                       decompressor())
+    sizes = random.Random(4)
+    out = []
+    while True:
+        buf = reader.read(sizes.choice([1, 110, 4096, 1024 * 1024 + 1]))
+        if not buf:
+            break
+        out.append(buf)
+    assert b"".join(out) == data
+    assert reader.read(10) == b""
+
+
+def _load_make_fedora_rpm():
+    spec = importlib.util.spec_from_file_location("make_fedora_rpm",
+        os.path.join(TOP_DIR, "make-fedora-rpm.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.parametrize("compressor", ["gzip", "xz", "zstd"])
+def test_extract_qemu_ga_msis(tmp_path, monkeypatch, compressor):
+    module = _load_make_fedora_rpm()
+    builds = tmp_path / "new-builds"
+    msidir = tmp_path / "msis"
+    srcdir = tmp_path / "rpm-src"
+    for path in [builds, msidir, srcdir]:
+        path.mkdir()
+    _write_rpm(str(builds / "qemu-ga-win-109.0.0-1.el9.noarch.rpm"),
+               compressor)
+    monkeypatch.setattr(module, "NEW_BUILDS_DIR", str(builds))
+
+    # Stop reading once both msis are found
+    seen = []
+    orig = RPMFile.payload_members
+
+    def _payload_members(self):
+        for member in orig(self):
+            seen.append(member[0])
+            yield member
+    monkeypatch.setattr(RPMFile, "payload_members", _payload_members)
+
+    buildversions = types.SimpleNamespace(qemu_ga_str="qemu-ga-win-109.0.0")
+    module._extract_qemu_ga_msis(buildversions, str(msidir), str(srcdir))
+
+    members = dict(MEMBERS)
+    x86 = members["./usr/i686-w64-mingw32/sys-root/mingw/bin/"
+                  "qemu-ga-i386.msi"]
+    x64 = members["./usr/x86_64-w64-mingw32/sys-root/mingw/bin/"
+                  "qemu-ga-x86_64.msi"]
+    assert (msidir / "qemu-ga-x86.msi").read_bytes() == x86
+    assert (msidir / "qemu-ga-x64.msi").read_bytes() == x64
+    zippath = str(srcdir / "qemu-ga-win-109.0.0-installers.zip")
+    with zipfile.ZipFile(zippath) as zf:
+        assert zf.read("qemu-ga-win-109.0.0/qemu-ga-x86.msi") == x86
+        assert zf.read("qemu-ga-win-109.0.0/qemu-ga-x64.msi") == x64
+    assert "./usr/share/doc/after" not in seen
+
+
+def test_extract_qemu_ga_msis_missing(tmp_path, monkeypatch):
+    module = _load_make_fedora_rpm()
+    builds = tmp_path / "new-builds"
+    builds.mkdir()
+    _write_rpm(str(builds / "qemu-ga-win-109.0.0-1.el9.noarch.rpm"), "xz",
+               members=MEMBERS[:2])
+    monkeypatch.setattr(module, "NEW_BUILDS_DIR", str(builds))
+
+    buildversions = types.SimpleNamespace(qemu_ga_str="qemu-ga-win-109.0.0")
+    with pytest.raises(SystemExit):
+        module._extract_qemu_ga_msis(buildversions, str(tmp_path),
+                                     str(tmp_path))
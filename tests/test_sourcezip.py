@@ -0,0 +1,90 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import sourcezip
+from util.sourcezip import SourceArchive
+
+
+MEMBERS = {
+    "internal-kvm-guest-drivers-windows/status.txt": b"status\n" * 1000,
+    "spice-qxl-wddm-dod/Changelog": b"changelog\n",
+    "empty": b"",
+}
+
+
+class _Unseekable:
+    """
+    Write-only file, so zipfile has to use data descriptors
+    """
+    def __init__(self, fp):
+        self._fp = fp
+
+    def write(self, data):
+        return self._fp.write(data)
+
+    def flush(self):
+        self._fp.flush()
+
+
+def _write_zip(path, compression, zip64=False, unseekable=False):
+    with open(path, "wb") as fp:
+        out = _Unseekable(fp) if unseekable else fp
+        with zipfile.ZipFile(out, "w", compression) as zf:
+            for name, data in MEMBERS.items():
+                with zf.open(name, "w", force_zip64=zip64) as dest:
+                    dest.write(data)
+
+
+@pytest.mark.parametrize("compression",
+                         [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED,
+                          zipfile.ZIP_BZIP2])
+@pytest.mark.parametrize("zip64", [False, True])
+@pytest.mark.parametrize("unseekable", [False, True])
+def test_read(tmp_path, compression, zip64, unseekable):
+    path = str(tmp_path / "test-sources.zip")
+    _write_zip(path, compression, zip64, unseekable)
+    if unseekable:
+        with zipfile.ZipFile(path) as zf:
+            assert all(i.flag_bits & 0x8 for i in zf.infolist())
+
+    archive = SourceArchive(path)
+    for name, data in MEMBERS.items():
+        assert archive.read(name) == data
+    assert archive.read_text("missing", default="") == ""
+
+
+def test_cached_index(tmp_path):
+    path = str(tmp_path / "test-sources.zip")
+    cachedir = str(tmp_path / "cache")
+    _write_zip(path, zipfile.ZIP_DEFLATED)
+
+    digest = SourceArchive(path, cachedir).digest
+    assert os.path.exists(os.path.join(cachedir, "%s.json" % digest))
+    sourcezip._INDEX_CACHE.clear()
+    assert (SourceArchive(path, cachedir).read_text("empty", default="x")
+            == "")
+
+    # Replacing the archive must not reuse the old index
+    os.rename(path, path + ".old")
+    MEMBERS["new"] = b"new"
+    try:
+        _write_zip(path, zipfile.ZIP_STORED)
+        archive = SourceArchive(path, cachedir)
+    finally:
+        del MEMBERS["new"]
+    assert archive.digest != digest
+    assert archive.read("new") == b"new"
+
+
+def test_missing_member(tmp_path):
+    path = str(tmp_path / "test-sources.zip")
+    _write_zip(path, zipfile.ZIP_STORED)
+    with pytest.raises(SystemExit):
+        SourceArchive(path).read("missing")
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Benchmark make-driver-dir.py, make-virtio-win-rpm-archive.py and
+parsecat against synthetic virtio-win-prewhql build trees, and with
+--fetch the fetch-latest-builds.py scan and download against a local
+mirror simulator (util/mirrorsim.py). See --help.
+
+The synthetic tree has every ostuple and FILELISTS entry from filemap,
+plus the unshipped files make-driver-dir.py expects to see. File sizes
+and the number of extra unshipped files grow with --scale. Results are
+appended to a JSON lines file along with the git commit, so runs from
+different commits can be compared with --compare.
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+UTIL_DIR = os.path.abspath(os.path.dirname(__file__))
+TOP_DIR = os.path.dirname(UTIL_DIR)
+sys.path.insert(0, TOP_DIR)
+from util import download
+from util import filemap
+from util import mirrorsim
+from util.buildversions import BuildVersions
+from util.utils import fail
+
+
+DEFAULT_RESULTS = os.path.join(TOP_DIR, ".benchmarks", "results.jsonl")
+
+# Base file sizes at --scale 1, by extension
+DEFAULT_SIZES = {
+    "sys": 64 * 1024,
+    "pdb": 256 * 1024,
+    "dll": 32 * 1024,
+    "exe": 64 * 1024,
+}
+OTHER_SIZE = 4 * 1024
+
+# Unshipped files that make-driver-dir.py check_remaining_files()
+# insists on seeing in the build output
+UNSHIPPED_FILES = [
+    "Win10/amd64/DVL.XML",
+    "Win10/amd64/DVL-compat.XML",
+    "Win10/amd64/DVL-win10.XML",
+    "Win10/amd64/vioser-test.exe",
+    "Win10/amd64/viorngtest.exe",
+    "spice-qxl-wddm-dod/w10/Changelog",
+    "spice-qxl-wddm-dod-8.1-compatible/Changelog",
+    "spice-qxl-wddm-dod/w10/QxlWddmDod_0.21.2.0_x64.msi",
+    "spice-qxl-wddm-dod/w10/QxlWddmDod_0.21.2.0_x86.msi",
+    "rhel/qemupciserial.cat",
+    "rhel/qemupciserial.inf",
+    "Win10/x86/viomem.cat",
+    "Win10/x86/viomem.sys",
+    "Win10/x86/viomem.inf",
+    "Win10/x86/viomem.pdb",
+]
+
+# Extra unshipped files per --scale, matching the vioser-test whitelist
+# entry, to scale the file count of the input
+EXTRA_FILES_PER_SCALE = 200
+
+# Mirror simulator file sizes at --scale 1
+FETCH_SIZES = {"zip": 1024 * 1024, "msi": 512 * 1024, "rpm": 512 * 1024}
+FETCH_SOURCES_SIZE = 16 * 1024 * 1024
+
+
+###############################
+# Synthetic build tree output #
+###############################
+
+def _content(relpath, size):
+    """
+    Deterministic, incompressible content unique to relpath
+    """
+    seed = int(hashlib.sha256(relpath.encode()).hexdigest()[:16], 16)
+    return random.Random(seed).randbytes(size)
+
+
+def _inf_content(relpath):
+    name = os.path.splitext(os.path.basename(relpath))[0]
+    return ("[Version]\r\n"
+            "DriverVer = 01/01/2024,100.0.0.%d\r\n"
+            "\r\n"
+            "[Strings]\r\n"
+            "%s.DeviceDesc = \"Synthetic %s\"\r\n" %
+            (len(relpath), name, name)).encode()
+
+
+def _input_files():
+    """
+    Return the sorted list of input tree relpaths
+    """
+    files = set(["LICENSE"] + UNSHIPPED_FILES)
+    for (drivername, ostuple), dests in filemap.RESOLUTION_TABLE.items():
+        if drivername == "qemupciserial" and ostuple == "./rhel":
+            continue
+        for dummy, filelist in dests:
+            for pattern in filelist:
+                files.add(os.path.normpath(os.path.join(ostuple, pattern)))
+    return sorted(files)
+
+
+def generate_tree(zippath, scale, sizes):
+    """
+    Write a synthetic build output zip. Returns (nfiles, nbytes)
+    """
+    catfiles = sorted(glob.glob(
+        os.path.join(TOP_DIR, "data", "old-drivers", "**", "*.cat"),
+        recursive=True))
+    files = _input_files()
+    files += ["Win10/amd64/vioser-test-%05d.log" % i
+              for i in range(EXTRA_FILES_PER_SCALE * scale)]
+
+    nbytes = 0
+    tmp = zippath + ".tmp"
+    with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED,
+                         compresslevel=1) as zf:
+        for idx, relpath in enumerate(files):
+            ext = relpath.rsplit(".", 1)[-1].lower()
+            if ext == "inf":
+                content = _inf_content(relpath)
+            elif ext == "cat" and catfiles:
+                # Real catalogs, so parsecat has something to parse
+                content = open(catfiles[idx % len(catfiles)], "rb").read()
+            else:
+                content = _content(relpath,
+                                   sizes.get(ext, OTHER_SIZE) * scale)
+            zf.writestr(relpath, content)
+            nbytes += len(content)
+    os.replace(tmp, zippath)
+    return len(files), nbytes
+
+
+#####################
+# Benchmark helpers #
+#####################
+
+def _peak_rss_kb(pid):
+    """
+    VmHWM of a running process, in KiB. The wait4()/getrusage() peak
+    RSS can't be used: Linux carries the parent's peak over fork and
+    exec, so every step would report at least the benchmark's own size.
+    """
+    try:
+        with open("/proc/%d/status" % pid) as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _run_timed(cmd, cwd):
+    """
+    Run cmd, returning its wall time, CPU time and peak RSS. The peak
+    RSS is sampled while it runs, and doesn't include the commands it
+    runs itself.
+    """
+    with tempfile.TemporaryFile() as log:
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=log,
+                                stderr=subprocess.STDOUT)
+        maxrss = 0
+        while True:
+            maxrss = max(maxrss, _peak_rss_kb(proc.pid))
+            waited, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if waited:
+                break
+            time.sleep(0.02)
+        wall = time.monotonic() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode != 0:
+            log.seek(0)
+            fail("Command failed: %s\n%s" % (" ".join(cmd),
+                 log.read().decode(errors="replace")[-4000:]))
+
+    return {"wall": wall, "cpu": usage.ru_utime + usage.ru_stime,
+            "maxrss_kb": maxrss}
+
+
+def _tree_size(topdir):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, dummy, files in os.walk(topdir) for f in files)
+
+
+def _run_forked(func, setup=None):
+    """
+    Call func in a forked child, so the peak RSS is the step's own and
+    not the benchmark's. Returns func's result and its wall time, CPU
+    time and the child's peak RSS, including the setup.
+
+    :param setup: called in the child before func, untimed, to build
+        state func needs, like warm caches
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        status = 0
+        try:
+            # Reset VmHWM, the fork copied the parent's peak
+            with open("/proc/self/clear_refs", "w") as fp:
+                fp.write("5")
+            if setup:
+                setup()
+            cpustart = time.process_time()
+            start = time.monotonic()
+            ret = func()
+            out = (ret, time.monotonic() - start,
+                   time.process_time() - cpustart,
+                   _peak_rss_kb(os.getpid()))
+        except BaseException as e:  # pylint: disable=broad-except
+            out = e
+            status = 1
+        with os.fdopen(wfd, "wb") as fp:
+            pickle.dump(out, fp)
+        os._exit(status)  # pylint: disable=protected-access
+
+    os.close(wfd)
+    with os.fdopen(rfd, "rb") as fp:
+        out = pickle.load(fp)
+    dummy, status = os.waitpid(pid, 0)
+    if status != 0:
+        fail("Benchmark step failed: %r" % (out,))
+    ret, wall, cpu, maxrss = out
+    return ret, {"wall": wall, "cpu": cpu, "maxrss_kb": maxrss}
+
+
+def _bench_parsecat(driverdir):
+    try:
+        from util import parsecat  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        print("Skipping parsecat: %s" % e)
+        return None
+
+    catfiles = sorted(glob.glob(os.path.join(driverdir, "**", "*.cat"),
+                                recursive=True))
+
+    def _parse_all():
+        for path in catfiles:
+            parsecat.parseCat(path)
+
+    dummy, result = _run_forked(_parse_all)
+    result["count"] = len(catfiles)
+    return result
+
+
+def _load_fetch_module():
+    spec = importlib.util.spec_from_file_location("fetch_latest_builds",
+        os.path.join(TOP_DIR, "fetch-latest-builds.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _bench_fetch(fetch, server, total, keep_best):
+    """
+    Time a cold and a warm scan of the simulated mirror, and a full
+    download of the builds it finds
+    """
+    # Every step runs in a forked child, so caches the parent filled
+    # don't carry over
+    download.clear_cache()
+    requests = server.requests
+    data, result = _run_forked(fetch.find_latest_buildversions)
+    cold_requests = result["requests"] = server.requests - requests
+    keep_best("fetch-discover", result)
+
+    requests = server.requests
+    dummy, result = _run_forked(fetch.find_latest_buildversions,
+                                setup=fetch.find_latest_buildversions)
+    # Don't count the requests of the cold scan in setup
+    result["requests"] = server.requests - requests - cold_requests
+    keep_best("fetch-discover-warm", result)
+
+    destdir = tempfile.mkdtemp(dir=os.path.dirname(server.rootdir),
+                               prefix="fetch-")
+    pipeline = fetch._build_download_pipeline(  # pylint: disable=protected-access
+        BuildVersions.from_data(data), destdir, 4, False,
+        download.DEFAULT_CONNECTIONS)
+    dummy, result = _run_forked(pipeline.run)
+    result["mib_per_s"] = total / (1024.0 * 1024.0) / result["wall"]
+    keep_best("fetch-download", result)
+    shutil.rmtree(destdir)
+
+
+def _driver_zip(workdir, scale, sizes):
+    zippath = os.path.join(workdir, "virtio-win-prewhql-bench-%dx.zip" %
+                           scale)
+    if not os.path.exists(zippath):
+        print("Generating %dx synthetic build tree..." % scale)
+        nfiles, nbytes = generate_tree(zippath, scale, sizes)
+        print("  %d files, %.1f MiB" % (nfiles, nbytes / (1024.0 * 1024.0)))
+    return zippath
+
+
+def run_fetch_scale(workdir, scale, sizes, repeat, latency, bandwidth):
+    """
+    Benchmark the fetch-latest-builds.py steps at one scale, against a
+    mirror simulator. Returns {step: result}
+    """
+    mirrordir = os.path.join(workdir, "mirror-%dx" % scale)
+    total = mirrorsim.generate_tree(mirrordir,
+        sizes={k: v * scale for k, v in FETCH_SIZES.items()},
+        sources_size=FETCH_SOURCES_SIZE * scale,
+        drivers_zip=_driver_zip(workdir, scale, sizes))
+
+    server = mirrorsim.MirrorServer(mirrordir, latency=latency,
+                                    bandwidth=bandwidth)
+    server.start()
+    fetch = _load_fetch_module()
+    fetch.set_urls(argparse.Namespace(**server.urls()))
+
+    results = {}
+
+    def _keep_best(step, result):
+        if step not in results or result["wall"] < results[step]["wall"]:
+            results[step] = result
+
+    try:
+        for dummy in range(repeat):
+            _bench_fetch(fetch, server, total, _keep_best)
+    finally:
+        server.stop()
+    return results
+
+
+def run_scale(workdir, scale, sizes, repeat):
+    """
+    Benchmark every step at one scale. Returns {step: result}, keeping
+    the fastest of the repeated runs.
+    """
+    zippath = _driver_zip(workdir, scale, sizes)
+    results = {}
+
+    def _keep_best(step, result):
+        if result is None:
+            return
+        if step not in results or result["wall"] < results[step]["wall"]:
+            results[step] = result
+
+    for dummy in range(repeat):
+        rundir = tempfile.mkdtemp(dir=workdir, prefix="run-")
+        driverdir = os.path.join(rundir, "driver-dir")
+        result = _run_timed(
+            [sys.executable, os.path.join(TOP_DIR, "make-driver-dir.py"),
+             "--input-zip", zippath, "--output-dir", driverdir],
+            TOP_DIR)
+        result["mib_per_s"] = (_tree_size(driverdir) / (1024.0 * 1024.0) /
+                               result["wall"])
+        _keep_best("make-driver-dir", result)
+        _keep_best("make-virtio-win-rpm-archive", _run_timed(
+            [sys.executable,
+             os.path.join(TOP_DIR, "make-virtio-win-rpm-archive.py"),
+             "virtio-win-bench", driverdir], rundir))
+        _keep_best("parsecat", _bench_parsecat(driverdir))
+        shutil.rmtree(rundir)
+    return results
+
+
+#####################
+# Results reporting #
+#####################
+
+def _git_revision():
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=TOP_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"],
+            cwd=TOP_DIR, stderr=subprocess.DEVNULL) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return rev + ("-dirty" if dirty else "")
+
+
+def save_results(path, records):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def load_results(path, revision):
+    """
+    Return the latest {(scale, step): record} recorded for revision,
+    which may be an abbreviated commit hash
+    """
+    ret = {}
+    if not os.path.exists(path):
+        return ret
+    for line in open(path):
+        record = json.loads(line)
+        if record["revision"].startswith(revision):
+            ret[(record["scale"], record["step"])] = record
+    return ret
+
+
+def print_results(records, baseline):
+    print("\n%-6s %-28s %9s %9s %10s %10s  %s" %
+          ("scale", "step", "wall", "cpu", "maxrss", "MiB/s", "vs baseline"))
+    for record in records:
+        delta = ""
+        old = baseline.get((record["scale"], record["step"]))
+        if old and old["wall"] > 0:
+            delta = "%+.1f%%" % ((record["wall"] / old["wall"] - 1) * 100)
+        rate = ""
+        if "mib_per_s" in record:
+            rate = "%.1f" % record["mib_per_s"]
+        print("%-6s %-28s %8.2fs %8.2fs %8.1fMB %10s  %s" %
+              ("%dx" % record["scale"], record["step"], record["wall"],
+               record["cpu"], record["maxrss_kb"] / 1024.0, rate, delta))
+
+
+###################
+# main() handling #
+###################
+
+def _size_arg(value):
+    try:
+        ext, size = value.split("=", 1)
+        return ext.lower(), int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected EXT=BYTES, got '%s'" % value) from None
+
+
+def parse_args():
+    desc = ("Time make-driver-dir.py, make-virtio-win-rpm-archive.py and "
+            "parsecat over synthetic build trees, and record the results "
+            "for comparison across commits.")
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--scale", type=int, action="append",
+        help="Size multiplier for the synthetic tree, 1-20. Can be "
+             "passed multiple times. Default: 1 5 10 20")
+    parser.add_argument("--size", type=_size_arg, action="append",
+        default=[], metavar="EXT=BYTES",
+        help="Base size at --scale 1 of files with extension EXT")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="Runs per scale, the fastest is kept (default: 3)")
+    parser.add_argument("--workdir",
+        help="Where to keep generated trees. Reusing it skips "
+             "regenerating them. Default: a temporary dir")
+    parser.add_argument("--results", default=DEFAULT_RESULTS,
+        help="JSON lines file results are appended to "
+             "(default: %(default)s)")
+    parser.add_argument("--compare", metavar="REVISION",
+        help="Compare against results recorded for this git commit")
+    parser.add_argument("--no-save", action="store_true",
+        help="Don't record the results")
+    parser.add_argument("--fetch", action="store_true",
+        help="Also time fetch-latest-builds.py build discovery and "
+             "download against a local mirror simulator")
+    parser.add_argument("--fetch-only", action="store_true",
+        help="Only run the --fetch benchmarks")
+    parser.add_argument("--latency", type=float, default=20,
+        help="Mirror simulator latency per request in ms (default: 20)")
+    parser.add_argument("--bandwidth", type=float, default=0,
+        help="Mirror simulator MiB/s per connection, 0 for unlimited "
+             "(default: 0)")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    scales = options.scale or [1, 5, 10, 20]
+    for scale in scales:
+        if scale < 1 or scale > 20:
+            fail("--scale must be between 1 and 20")
+    sizes = dict(DEFAULT_SIZES)
+    sizes.update(dict(options.size))
+
+    workdir = options.workdir
+    if not workdir:
+        workdir = tempfile.mkdtemp(prefix="virtio-win-bench-")
+    os.makedirs(workdir, exist_ok=True)
+
+    revision = _git_revision()
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+    records = []
+    try:
+        for scale in scales:
+            results = {}
+            if not options.fetch_only:
+                results.update(run_scale(workdir, scale, sizes,
+                                         options.repeat))
+            if options.fetch or options.fetch_only:
+                results.update(run_fetch_scale(workdir, scale, sizes,
+                    options.repeat, options.latency / 1000.0,
+                    options.bandwidth * 1024 * 1024))
+            for step, result in results.items():
+                record = {"revision": revision, "date": timestamp,
+                          "scale": scale, "step": step}
+                record.update(result)
+                records.append(record)
+    finally:
+        if not options.workdir:
+            shutil.rmtree(workdir)
+
+    baseline = {}
+    if options.compare:
+        baseline = load_results(options.results, options.compare)
+        if not baseline:
+            print("No results recorded for %s in %s" %
+                  (options.compare, options.results))
+    print_results(records, baseline)
+
+    if not options.no_save:
+        save_results(options.results, records)
+        print("\nResults for %s appended to %s" % (revision, options.results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Output cache for pipeline stages, keyed by a digest of the stage inputs.
+
+A stage computes its key from the content of its input files and trees
+plus any extra strings that influence the output (version strings, spec
+or filemap content, ...). If a previous run stored output under the same
+key, it is copied into place instead of rebuilding it.
+"""
+
+import ast
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from .fileutils import file_digest
+from .utils import fail
+
+
+def _imported_util_modules(path):
+    """
+    Names of the util/ modules the python file at path imports
+    """
+    names = set()
+    tree = ast.parse(open(path).read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(a.name[len("util."):] for a in node.names
+                         if a.name.startswith("util."))
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 1 and node.module:
+                names.add(node.module)
+            elif node.level == 1 or node.module == "util":
+                names.update(a.name for a in node.names)
+            elif node.module and node.module.startswith("util."):
+                names.add(node.module[len("util."):])
+    return names
+
+
+def script_files(script):
+    """
+    Return script plus every util/ module it imports, directly or
+    through other util/ modules. Passing them all as key() files means
+    any change to the code the script runs invalidates its output
+    """
+    utildir = os.path.dirname(os.path.abspath(script))
+    if os.path.basename(utildir) != "util":
+        utildir = os.path.join(utildir, "util")
+    ret = [script]
+    todo = [script]
+    while todo:
+        for name in sorted(_imported_util_modules(todo.pop())):
+            path = os.path.join(utildir, name.split(".")[0] + ".py")
+            if os.path.exists(path) and path not in ret:
+                ret.append(path)
+                todo.append(path)
+    return ret
+
+
+class BuildCache:
+    """
+    Stage output cache stored under cachedir, laid out like:
+
+        $cachedir/digests.json: memoized file digests, by (size, mtime)
+        $cachedir/$stage/$key/: stored output for a single stage run
+    """
+    # How many outputs to keep around per stage
+    KEEP = 3
+
+    def __init__(self, cachedir, enabled=True):
+        self.cachedir = cachedir
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._digests_path = os.path.join(cachedir, "digests.json")
+        self._digests = {}
+
+        if not self.enabled:
+            return
+        os.makedirs(cachedir, exist_ok=True)
+        if os.path.exists(self._digests_path):
+            try:
+                self._digests = json.load(open(self._digests_path))
+            except ValueError:
+                self._digests = {}
+
+
+    ####################
+    # Internal helpers #
+    ####################
+
+    def _file_digest(self, path):
+        """
+        sha256 of path, memoized across runs for unchanged files, since
+        the build inputs are hundreds of MB
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            cached = self._digests.get(path)
+        if cached and cached[:2] == stamp:
+            return cached[2]
+
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[path] = stamp + [digest]
+        return digest
+
+    def _tree_digest(self, topdir):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(topdir):
+            dirs.sort()
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                relpath = os.path.relpath(path, topdir)
+                if os.path.islink(path):
+                    content = "link:" + os.readlink(path)
+                else:
+                    content = self._file_digest(path)
+                h.update(("%s\0%s\0" % (relpath, content)).encode())
+        return h.hexdigest()
+
+    def _save_digests(self):
+        with self._lock:
+            tmp = self._digests_path + ".tmp-%s-%s" % (os.getpid(),
+                                                       threading.get_ident())
+            open(tmp, "w").write(json.dumps(self._digests, sort_keys=True))
+            os.replace(tmp, self._digests_path)
+
+    def _stage_dir(self, stage):
+        return os.path.join(self.cachedir, stage)
+
+    def _prune(self, stage):
+        stagedir = self._stage_dir(stage)
+        entries = [os.path.join(stagedir, e) for e in os.listdir(stagedir)
+                   if not e.startswith(".")]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path in entries[self.KEEP:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+    ##################
+    # Public helpers #
+    ##################
+
+    def key(self, stage, files=None, trees=None, extra=None):
+        """
+        Build the cache key for a stage run.
+
+        :param files: input files. Only their basename and content
+            contribute to the key, not their location.
+        :param trees: input directories, walked recursively
+        :param extra: list of strings that affect the stage output
+        """
+        h = hashlib.sha256()
+        h.update(("stage:%s\0" % stage).encode())
+        for path in sorted(files or [], key=os.path.basename):
+            h.update(("file:%s:%s\0" % (os.path.basename(path),
+                self._file_digest(path))).encode())
+        for path in trees or []:
+            h.update(("tree:%s\0" % self._tree_digest(path)).encode())
+        for value in extra or []:
+            h.update(("extra:%s\0" % value).encode())
+
+        if self.enabled:
+            self._save_digests()
+        return h.hexdigest()
+
+    def restore(self, stage, key, outdir):
+        """
+        If there's cached output for stage+key, copy its content into
+        outdir and return True
+        """
+        if not self.enabled:
+            return False
+        cached = os.path.join(self._stage_dir(stage), key)
+        if not os.path.isdir(cached):
+            print("build cache miss: stage=%s key=%s" % (stage, key[:12]))
+            return False
+
+        print("build cache hit: stage=%s key=%s" % (stage, key[:12]))
+        shutil.copytree(cached, outdir, symlinks=True, dirs_exist_ok=True)
+        # Bump mtime so pruning keeps recently used entries
+        os.utime(cached)
+        return True
+
+    def store(self, stage, key, outdir):
+        """
+        Save the content of outdir as the output of stage+key
+        """
+        if not self.enabled:
+            return
+        stagedir = self._stage_dir(stage)
+        os.makedirs(stagedir, exist_ok=True)
+        cached = os.path.join(stagedir, key)
+        if os.path.exists(cached):
+            return
+
+        tmp = os.path.join(stagedir,
+            ".tmp-%s-%s-%s" % (key, os.getpid(), time.time()))
+        shutil.copytree(outdir, tmp, symlinks=True)
+        try:
+            os.rename(tmp, cached)
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(cached):
+                fail("Failed to store build cache entry %s: %s" %
+                     (cached, e))
+        self._prune(stage)
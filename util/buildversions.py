@@ -1,3 +1,5 @@
+import collections
+import hashlib
 import json
 import os
 import re
@@ -5,65 +7,171 @@ import re
 from .utils import fail
 
 
-class BuildVersions:
+# Bump when the buildversions.json layout changes. Files may record it as
+# SCHEMA_KEY, files without it are version 1.
+SCHEMA_VERSION = 1
+SCHEMA_KEY = "_schema"
+
+# The components buildversions.json describes. Each has a version string
+# and a list of urls, one of which is the source file matching the
+# pattern; its basename minus the suffix is the component version string.
+#   json key: (source filename pattern, attribute name)
+_COMPONENTS = collections.OrderedDict([
+    ("mingw-qemu-ga-win", ("mingw-qemu-ga-win.*src.rpm",
+                           "mingw_qemu_ga_str")),
+    ("qxl", ("qxl-win-unsigned.*sources.zip", "qxl_str")),
+    ("qxlwddm", ("spice-qxl-wddm-dod.*sources.zip", "qxlwddm_str")),
+    ("virtio-win-prewhql", ("virtio-win-prewhql.*sources.zip",
+                            "virtio_prewhql_str")),
+    ("spice-vdagent-win", ("spice-vdagent-win.*sources.zip",
+                           "spice_vda_str")),
+])
+_PATTERNS = {key: re.compile(pattern)
+             for key, (pattern, dummy) in _COMPONENTS.items()}
+_SUFFIXES = ["-sources.zip", ".src.rpm"]
+
+# BuildVersions already loaded, by sha256 of the json content
+_LOADED = {}
+
+
+Component = collections.namedtuple("Component", ["version", "urls"])
+
+_BuildVersionsBase = collections.namedtuple("_BuildVersionsBase",
+    ["components"] + [attr for dummy, attr in _COMPONENTS.values()] +
+    ["qemu_ga_str", "virtio_rpm_str"])
+
+
+def _verstr_from_urls(key, urls):
+    """
+    Find the component version string by parsing json url names
+    """
+    pattern = _PATTERNS[key]
+    paths = [b for b in (u.rsplit("/", 1)[-1] for u in urls)
+             if pattern.match(b)]
+    if not paths:
+        fail("Didn't find any matches for %s\n"
+            "That directory should contain the downloaded output "
+            "from fetch-latest-builds.py" % pattern.pattern)
+
+    if len(paths) > 1:
+        fail("Unexpectedly found multiple matches: %s" % paths)
+
+    base = paths[0]
+    for suffix in _SUFFIXES:
+        if base.endswith(suffix):
+            return base[:-len(suffix)]
+    fail("Didn't find any known suffix on %s: %s\nExtend the list!" %
+        (base, _SUFFIXES))
+
+
+def _validate(data):
+    """
+    Check data has the buildversions.json layout, fail() if not
+    """
+    if not isinstance(data, dict):
+        fail("buildversions: expected a JSON object, got %s" %
+             type(data).__name__)
+    schema = data.get(SCHEMA_KEY, 1)
+    if schema != SCHEMA_VERSION:
+        fail("buildversions: unsupported schema version %s, expected %s" %
+             (schema, SCHEMA_VERSION))
+
+    unknown = sorted(set(data) - set(_COMPONENTS) - set([SCHEMA_KEY]))
+    if unknown:
+        fail("buildversions: unknown components %s" % unknown)
+    for key in _COMPONENTS:
+        entry = data.get(key)
+        if not isinstance(entry, dict):
+            fail("buildversions: missing component %s" % key)
+        if not isinstance(entry.get("version"), str):
+            fail("buildversions: %s: 'version' must be a string" % key)
+        urls = entry.get("urls")
+        if (not isinstance(urls, list) or
+                not all(isinstance(u, str) for u in urls)):
+            fail("buildversions: %s: 'urls' must be a list of strings" % key)
+
+
+class BuildVersions(_BuildVersionsBase):
     """
     Helper class for inspecting NEW_BUILDS_DIR json content and parsing
-    out various version strings we need to know
+    out various version strings we need to know.
+
+    Instances are immutable and all version strings are computed up
+    front. BuildVersions() loads NEW_BUILDS_JSON, and repeated loads of
+    the same content return the same instance.
     """
+    __slots__ = ()
+
     TOP_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
     NEW_BUILDS_DIR = os.path.join(TOP_DIR, "new-builds")
     JSON_BASENAME = "buildversions.json"
     NEW_BUILDS_JSON = os.path.join(NEW_BUILDS_DIR, JSON_BASENAME)
 
-    @staticmethod
-    def dump(data):
-        return json.dumps(data, sort_keys=True, indent=2)
-
-    @staticmethod
-    def write(data):
-        datastr = BuildVersions.dump(data)
-        open(BuildVersions.NEW_BUILDS_JSON, "w").write(datastr)
-
-    def __init__(self):
-        self._data = json.load(open(self.NEW_BUILDS_JSON))
-
-        self.virtio_prewhql_str = self._verstr_from_filename(
-                "virtio-win-prewhql", "virtio-win-prewhql.*sources.zip")
-        self.qxl_str = self._verstr_from_filename(
-                "qxl", "qxl-win-unsigned.*sources.zip")
-        self.qxlwddm_str = self._verstr_from_filename(
-                "qxlwddm", "spice-qxl-wddm-dod.*sources.zip")
-        self.mingw_qemu_ga_str = self._verstr_from_filename(
-                "mingw-qemu-ga-win", "mingw-qemu-ga-win.*src.rpm")
-        self.qemu_ga_str = self.mingw_qemu_ga_str[len("mingw-"):]
-        self.spice_vda_str = self._verstr_from_filename(
-                "spice-vdagent-win", "spice-vdagent-win.*sources.zip")
+    def __new__(cls, path=None):
+        return cls.load(path or cls.NEW_BUILDS_JSON)
+
+    @classmethod
+    def load(cls, path):
+        content = open(path, "rb").read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest not in _LOADED:
+            try:
+                data = json.loads(content)
+            except ValueError as e:
+                fail("Error parsing %s: %s" % (path, e))
+            _LOADED[digest] = cls.from_data(data)
+        return _LOADED[digest]
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Build an instance from the buildversions.json dict content:
+
+        { $packagename : { "version": $version, "urls": [...] }, ... }
+        """
+        _validate(data)
+        components = tuple(
+            (key, Component(data[key]["version"], tuple(data[key]["urls"])))
+            for key in _COMPONENTS)
+
+        verstrs = {attr: _verstr_from_urls(key, data[key]["urls"])
+                   for key, (dummy, attr) in _COMPONENTS.items()}
+        verstrs["qemu_ga_str"] = (
+            verstrs["mingw_qemu_ga_str"][len("mingw-"):])
 
         # Change virtio-win-prewhql-0.1-100 to virtio-win-0.1.100, since it's
         # what we want for making RPM version happy
-        self.virtio_rpm_str = (
-            self.virtio_prewhql_str.rsplit(".", 1)[0] + "." +
-            self.virtio_prewhql_str.rsplit(".", 1)[1].replace("-", ".")
+        prewhql = verstrs["virtio_prewhql_str"]
+        verstrs["virtio_rpm_str"] = (
+            prewhql.rsplit(".", 1)[0] + "." +
+            prewhql.rsplit(".", 1)[1].replace("-", ".")
             ).replace("-prewhql", "")
 
-    def _verstr_from_filename(self, key, pattern):
+        return _BuildVersionsBase.__new__(cls, components=components,
+                                          **verstrs)
+
+    def __reduce__(self):
+        # __new__ loads from a path, so rebuild from the data instead
+        return (type(self).from_data, (self.to_data(),))
+
+    @classmethod
+    def from_json(cls, jsonstr):
+        return cls.from_data(json.loads(jsonstr))
+
+    def to_data(self):
+        ret = {key: {"version": comp.version, "urls": list(comp.urls)}
+               for key, comp in self.components}
+        ret[SCHEMA_KEY] = SCHEMA_VERSION
+        return ret
+
+    def to_json(self):
+        return json.dumps(self.to_data(), sort_keys=True, indent=2)
+
+    def write(self, path=None):
+        open(path or self.NEW_BUILDS_JSON, "w").write(self.to_json())
+
+    def urls(self):
         """
-        Find the latest version strings by parsing json url names
+        Return every url, in component order
         """
-        files = [os.path.basename(u) for u in self._data[key]["urls"]]
-        paths = [f for f in files if re.match(pattern, f)]
-        if not paths:
-            fail("Didn't find any matches for %s\n"
-                "That directory should contain the downloaded output "
-                "from fetch-latest-builds.py" % pattern)
-
-        if len(paths) > 1:
-            fail("Unexpectedly found multiple matches: %s" % paths)
-
-        base = os.path.basename(paths[0])
-        suffixes = ["-sources.zip", ".src.rpm"]
-        for suffix in suffixes:
-            if base.endswith(suffix):
-                return base[:-len(suffix)]
-        fail("Didn't find any known suffix on %s: %s\nExtend the list!" %
-            (base, suffixes))
+        return [url for dummy, comp in self.components for url in comp.urls]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Sanity check util/filemap.json, and optionally time driver file lookups
+or compare it against another copy
+"""
+
+import argparse
+import os
+import sys
+import time
+
+UTIL_DIR = os.path.abspath(os.path.dirname(__file__))
+TOP_DIR = os.path.dirname(UTIL_DIR)
+sys.path.insert(0, TOP_DIR)
+from util import filemap
+from util.utils import fail
+
+
+######################
+# Functional helpers #
+######################
+
+def _lookup_uncompiled(drivername, ostuple):
+    # The lookup make-driver-dir.py used to do for every driver/ostuple
+    ret = []
+    for destdir in filemap.DRIVER_OS_MAP[drivername][ostuple]:
+        dest_os = destdir.split("/")[0]
+        filelist = filemap.FILELISTS.get(drivername + ":" + dest_os, None)
+        if filelist is None:
+            filelist = filemap.FILELISTS.get(drivername)
+        ret.append((destdir, filelist))
+    return ret
+
+
+def _time_lookups(func, keys, rounds):
+    start = time.perf_counter()
+    for dummy in range(rounds):
+        for drivername, ostuple in keys:
+            func(drivername, ostuple)
+    return time.perf_counter() - start
+
+
+def benchmark(rounds):
+    keys = sorted(filemap.RESOLUTION_TABLE)
+    for key in keys:
+        if _lookup_uncompiled(*key) != filemap.resolve(*key):
+            fail("Compiled lookup for %s doesn't match FILELISTS" % (key,))
+
+    nlookups = len(keys) * rounds
+    for label, func in [("uncompiled", _lookup_uncompiled),
+                        ("compiled", filemap.resolve)]:
+        elapsed = _time_lookups(func, keys, rounds)
+        print("%-10s %d lookups in %.3fs (%.2f usec/lookup)" %
+              (label, nlookups, elapsed, elapsed * 1000000 / nlookups))
+
+
+def compare(otherpath):
+    """
+    Report the differences between our filemap.json and otherpath,
+    like a copy used by the internal RHEL scripts
+    """
+    digest, other = filemap.load(otherpath, use_cache=False)
+    print("%s: %s" % (otherpath, digest))
+    if digest == filemap.DIGEST:
+        return 0
+
+    ndiffs = 0
+    for name in sorted(other):
+        if name in ["RESOLUTION_TABLE", "VARIANT_RESOLUTION_TABLES"]:
+            # Derived from FILELISTS, DRIVER_OS_MAP and VARIANTS
+            continue
+        ours = getattr(filemap, name)
+        theirs = other[name]
+        if ours == theirs:
+            continue
+        if not isinstance(ours, dict):
+            print("%s differs" % name)
+            ndiffs += 1
+            continue
+        for key in sorted(set(ours) | set(theirs), key=str):
+            if key not in theirs:
+                print("%s[%s]: only in %s" % (name, key, filemap.DATA_PATH))
+            elif key not in ours:
+                print("%s[%s]: only in %s" % (name, key, otherpath))
+            elif ours[key] != theirs[key]:
+                print("%s[%s]: differs" % (name, key))
+            else:
+                continue
+            ndiffs += 1
+    if not ndiffs:
+        print("Content is equivalent, only formatting or comments differ")
+    return ndiffs
+
+
+###################
+# main() handling #
+###################
+
+def parse_args():
+    desc = ("Check that every DRIVER_OS_MAP destination in filemap.json "
+            "has a FILELISTS entry and a supported OS and arch.")
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--benchmark", action="store_true",
+        help="Time compiled vs uncompiled driver file lookups")
+    parser.add_argument("--rounds", type=int, default=1000,
+        help="Benchmark rounds over every driver/ostuple (default: 1000)")
+    parser.add_argument("--compare", metavar="FILEMAP_JSON",
+        help="Report differences against another copy of filemap.json")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+
+    for key in filemap.unused_filelists():
+        print("WARNING: FILELISTS[%s] is not used by any destination" % key)
+
+    errors = filemap.check_consistency()
+    if errors:
+        fail("filemap.json is inconsistent:\n    %s" % "\n    ".join(errors))
+    print("%s: %s" % (filemap.DATA_PATH, filemap.DIGEST))
+    print("%d driver/ostuple entries OK" % len(filemap.RESOLUTION_TABLE))
+    for variant in sorted(filemap.VARIANTS):
+        ndests = sum(len(dests) for dests in
+                     filemap.VARIANT_RESOLUTION_TABLES[variant].values())
+        print("variant %s: %d destinations" % (variant, ndests))
+
+    if options.benchmark:
+        benchmark(options.rounds)
+    if options.compare:
+        return 1 if compare(options.compare) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
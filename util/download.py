@@ -0,0 +1,241 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+HTTP downloads, with large files fetched over several connections.
+
+Every download starts as a plain GET. If its headers show a file larger
+than SEGMENT_MIN_SIZE and Accept-Ranges: bytes, that response is dropped
+and the file is split into byte ranges that are fetched in parallel,
+each written at its offset in a preallocated .part file. Every range
+request carries If-Range with the ETag or Last-Modified from the first
+response, so if the file changes mid-download the server sends the full
+file instead, which is detected. Other files are streamed from the
+first response, so they cost a single request.
+
+Before the .part file is renamed into place its size is checked against
+Content-Length, and for zip files every member CRC is verified. A
+truncated download is retried once.
+
+get_text() is for the small index pages we scrape for new builds. It
+revalidates pages it fetched before with If-None-Match/If-Modified-Since,
+so polling an unchanged page only costs a 304.
+
+Like wget, everything honors $http_proxy/$https_proxy/$no_proxy.
+"""
+
+import concurrent.futures
+import os
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+
+from . import instrument
+from .fileutils import BUFSIZE
+from .utils import fail
+
+
+# Files smaller than this are always fetched with a single request
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+DEFAULT_CONNECTIONS = 4
+TIMEOUT = 60
+# Tries per download, when the transfer comes up short
+DOWNLOAD_ATTEMPTS = 2
+
+
+class _RangeNotHonored(Exception):
+    pass
+
+
+class _Truncated(Exception):
+    pass
+
+
+# get_text() state: {url: (etag, last_modified, text)} for revalidating
+# pages
+_page_cache = {}
+_page_cache_lock = threading.Lock()
+
+
+####################
+# Internal helpers #
+####################
+
+def _open(url, headers=None):
+    req = urllib.request.Request(url, headers=headers or {})
+    try:
+        return urllib.request.urlopen(req, timeout=TIMEOUT)
+    except (urllib.error.URLError, OSError) as e:
+        fail("Failed to download %s: %s" % (url, e))
+
+
+def _content_length(resp):
+    length = resp.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def _copy_stream(resp, fp):
+    nbytes = 0
+    while True:
+        buf = resp.read(BUFSIZE)
+        if not buf:
+            break
+        fp.write(buf)
+        nbytes += len(buf)
+    instrument.add_bytes("downloaded", nbytes)
+    return nbytes
+
+
+def _fetch_single(resp, partpath):
+    """
+    Stream the open response to partpath
+    """
+    with resp, open(partpath, "wb") as fp:
+        _copy_stream(resp, fp)
+
+
+def _fetch_range(url, partpath, start, end, validator):
+    headers = {"Range": "bytes=%d-%d" % (start, end)}
+    if validator:
+        headers["If-Range"] = validator
+    with _open(url, headers) as resp:
+        expect = "bytes %d-%d/" % (start, end)
+        if (resp.status != 206 or
+                not resp.headers.get("Content-Range", "").startswith(expect)):
+            raise _RangeNotHonored()
+        with open(partpath, "r+b") as fp:
+            fp.seek(start)
+            nbytes = _copy_stream(resp, fp)
+    if nbytes != end - start + 1:
+        raise _Truncated("bytes %d-%d: got %d bytes" % (start, end, nbytes))
+
+
+def _fetch_segmented(url, partpath, size, validator, connections):
+    """
+    Fetch url in parallel byte ranges. Returns False if the server
+    stopped honoring the ranges, like when the file changed.
+    """
+    with open(partpath, "wb") as fp:
+        fp.truncate(size)
+
+    segsize = -(-size // connections)
+    ranges = [(start, min(start + segsize, size) - 1)
+              for start in range(0, size, segsize)]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(ranges)) as pool:
+        futures = [pool.submit(_fetch_range, url, partpath, start, end,
+                               validator)
+                   for start, end in ranges]
+        try:
+            for future in futures:
+                future.result()
+        except _RangeNotHonored:
+            return False
+    return True
+
+
+def _verify(url, partpath, size):
+    if size is not None and os.path.getsize(partpath) != size:
+        raise _Truncated("expected %d bytes, got %d" %
+                         (size, os.path.getsize(partpath)))
+    if partpath.endswith(".zip.part"):
+        try:
+            with zipfile.ZipFile(partpath) as zf:
+                bad = zf.testzip()
+        except zipfile.BadZipFile as e:
+            fail("%s: corrupt zip file: %s" % (url, e))
+        if bad:
+            fail("%s: CRC mismatch for zip member %s" % (url, bad))
+
+
+def _fetch(url, partpath, connections):
+    """
+    Download url to partpath. Returns the expected size, if known
+    """
+    resp = _open(url)
+    size = _content_length(resp)
+    validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+    basename = os.path.basename(partpath[:-len(".part")])
+
+    if (connections > 1 and size is not None and size >= SEGMENT_MIN_SIZE
+            and resp.headers.get("Accept-Ranges") == "bytes"):
+        resp.close()
+        nsegs = min(connections, size // (SEGMENT_MIN_SIZE // 4))
+        print("+ download %s: %d bytes over %d connections" %
+              (basename, size, nsegs))
+        if _fetch_segmented(url, partpath, size, validator, nsegs):
+            return size
+        print("+ download %s: server stopped honoring ranges, "
+              "retrying as a single stream" % basename)
+        resp = _open(url)
+        size = _content_length(resp)
+
+    _fetch_single(resp, partpath)
+    return size
+
+
+##################
+# Public helpers #
+##################
+
+def clear_cache():
+    """
+    Forget the get_text() cached pages
+    """
+    with _page_cache_lock:
+        _page_cache.clear()
+
+
+def get_text(url):
+    """
+    Return the content of url as text, like `wget -qO-`
+    """
+    with _page_cache_lock:
+        cached = _page_cache.get(url)
+    headers = {}
+    if cached and cached[0]:
+        headers["If-None-Match"] = cached[0]
+    if cached and cached[1]:
+        headers["If-Modified-Since"] = cached[1]
+
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as resp:
+            body = resp.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            return cached[2]
+        fail("Failed to fetch %s: HTTP %d %s" % (url, e.code, e.reason))
+    except (urllib.error.URLError, OSError) as e:
+        fail("Failed to fetch %s: %s" % (url, e))
+
+    charset = resp.headers.get_content_charset() or "utf-8"
+    text = body.decode(charset, errors="replace")
+    etag = resp.headers.get("ETag")
+    modified = resp.headers.get("Last-Modified")
+    if etag or modified:
+        with _page_cache_lock:
+            _page_cache[url] = (etag, modified, text)
+    return text
+
+
+def download(url, path, connections=DEFAULT_CONNECTIONS):
+    """
+    Download url to path, replacing it only once the download is
+    complete and verified.
+
+    :param connections: max parallel range requests for large files
+    """
+    partpath = path + ".part"
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        try:
+            size = _fetch(url, partpath, connections)
+            _verify(url, partpath, size)
+            break
+        except _Truncated as e:
+            if attempt == DOWNLOAD_ATTEMPTS - 1:
+                fail("Failed to download %s: %s" % (url, e))
+            print("+ download %s: %s, retrying" %
+                  (os.path.basename(path), e))
+    os.replace(partpath, path)
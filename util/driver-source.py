@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Look up where shipped driver files came from, or where build input
+files were shipped to, using the make-driver-dir.py source map
+"""
+
+import argparse
+import os
+import sys
+
+UTIL_DIR = os.path.abspath(os.path.dirname(__file__))
+TOP_DIR = os.path.dirname(UTIL_DIR)
+sys.path.insert(0, TOP_DIR)
+from util import sourcemap
+from util.utils import fail
+
+
+###################
+# main() handling #
+###################
+
+def parse_args():
+    desc = ("Look up a file in the driver source map. PATH can be a "
+            "shipped path like viostor/w11/amd64/viostor.sys, "
+            "amd64/w11/viostor.sys, by-os/amd64/w11/viostor.sys, or a "
+            "make-driver-dir.py input path like Win11/amd64/viostor.sys")
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("manifest",
+        help="Source map file, or a driver dir, mounted ISO or "
+             "iso-content dir containing %s" % sourcemap.MANIFEST_PATH)
+    parser.add_argument("paths", nargs="+", metavar="PATH",
+        help="Files to look up")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    manifest = options.manifest
+    if os.path.isdir(manifest):
+        manifest = os.path.join(manifest, sourcemap.MANIFEST_PATH)
+    if not os.path.exists(manifest):
+        fail("No source map found at %s" % manifest)
+
+    ret = 0
+    for path in options.paths:
+        path = os.path.normpath(path)
+        found = False
+        for source, origin in sourcemap.lookup_dest(manifest, path):
+            print("%s <- %s (%s)" % (path, source, origin))
+            found = True
+        for dest in sourcemap.lookup_source(manifest, path):
+            print("%s -> %s" % (path, dest))
+            found = True
+        if not found:
+            print("%s: not found" % path)
+            ret = 1
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
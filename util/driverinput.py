@@ -0,0 +1,97 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Turn NEW_BUILDS_DIR build zips into a make-driver-dir.py run.
+
+make-fedora-rpm.py uses this for its driver-dir stage. So does
+fetch-latest-builds.py --prepare, which builds the driver dir into the
+same build cache entry as soon as the driver build zips are downloaded,
+so make-fedora-rpm.py finds it ready.
+"""
+
+import glob
+import os
+import re
+
+from .buildcache import script_files
+from .utils import shellcomm
+
+
+TOP_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+DEFAULT_CACHE_DIR = os.path.join(TOP_DIR, ".build-cache")
+SOURCEZIP_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "sourcezip")
+CACHE_STAGE = "driver-dir"
+
+
+def is_driver_build_zip(path):
+    """
+    True if the NEW_BUILDS_DIR file path contains driver build output
+    """
+    return path.endswith(".zip") and not path.endswith("-sources.zip")
+
+
+def driver_build_zips(builds_dir):
+    """
+    Return the builds_dir zip files containing driver build output
+    """
+    return sorted(z for z in glob.glob(os.path.join(builds_dir, "*.zip"))
+                  if is_driver_build_zip(z))
+
+
+def input_args(zips):
+    """
+    Build the make-driver-dir.py input arguments for the build zips,
+    with some fix ups. The zips are read in place, and static
+    data/old-drivers/ content is layered over them
+    """
+    args = []
+    for zippath in sorted(zips):
+        zipbasename = os.path.basename(zippath)
+        is_qxl_old = bool(re.match(r"^qxl_.*$", zipbasename))
+        is_qxl_dod = bool(re.match(
+            r"^spice-qxl-wddm-dod.zip$", zipbasename))
+
+        # Map qxl_* to $dir/qxl/
+        # Map latest qxlwddm to $dir/spice-qxl-wddm-dod/
+        # Map 8.1 compat qxlwddm to $dir/, which because of the
+        #   .zip layout becomes $dir/spice-qxl-wddm-dod-8.1-compatible/
+
+        prefix = ""
+        if is_qxl_old:
+            prefix = "qxl="
+        elif is_qxl_dod:
+            prefix = "spice-qxl-wddm-dod="
+        args.append("--input-zip %s%s" % (prefix, zippath))
+
+    olddir = os.path.join(TOP_DIR, "data", "old-drivers")
+    args.append("--input-overlay %s/xp-viostor" % olddir)
+    args.append("--input-overlay qxl=%s/xp-qxl" % olddir)
+    for dirname in ["Win8.1", "Win8", "Win7", "Wlh", "Wnet", "Wxp"]:
+        args.append("--input-overlay %s=%s/%s" % (dirname, olddir, dirname))
+    return " ".join(args)
+
+
+def cache_key(cache, zips):
+    # This module too, input_args() decides how the inputs are layered
+    return cache.key(CACHE_STAGE,
+        files=list(zips) +
+              script_files(os.path.join(TOP_DIR, "make-driver-dir.py")) + [
+            os.path.join(TOP_DIR, "util", "driverinput.py"),
+            os.path.join(TOP_DIR, "util", "filemap.json")],
+        trees=[os.path.join(TOP_DIR, "data", "old-drivers")])
+
+
+def make_driver_dir(cache, zips, output_dir):
+    """
+    Fill output_dir with the make-driver-dir.py output for the build
+    zips, from the build cache if possible
+    """
+    key = cache_key(cache, zips)
+    if cache.restore(CACHE_STAGE, key, output_dir):
+        return
+
+    shellcomm("%s %s --output-dir %s" %
+        (os.path.join(TOP_DIR, "make-driver-dir.py"), input_args(zips),
+         output_dir))
+    cache.store(CACHE_STAGE, key, output_dir)
@@ -0,0 +1,182 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Read-only layered view of the driver build input.
+
+make-driver-dir.py only needs to list the input files and copy a subset
+of them. Rather than unpacking every build zip to disk first, the zip
+central directories and any overlay directories are indexed into a
+single virtual tree, and only the shipped files are ever extracted.
+"""
+
+import fnmatch
+import os
+import posixpath
+import shutil
+import zipfile
+
+from . import instrument
+from .fileutils import extract_zip_member
+from .utils import fail
+
+
+class _DirLayer:
+    def __init__(self, path, prefix):
+        self.path = os.path.abspath(path)
+        self.prefix = prefix
+
+    def __str__(self):
+        return self.path
+
+    def scan(self):
+        """
+        Yield (relpath, member) for every file, and (reldir, None) for
+        every directory in the layer
+        """
+        for root, dummy, files in os.walk(self.path):
+            reldir = os.path.relpath(root, self.path)
+            if reldir != ".":
+                yield _join(self.prefix, reldir), None
+            for f in files:
+                yield (_join(self.prefix, reldir, f),
+                       os.path.join(root, f))
+
+    def origin(self, member):
+        return "%s/%s" % (os.path.basename(self.path),
+                          os.path.relpath(member, self.path))
+
+    def copy(self, member, destpath):
+        shutil.copy2(member, destpath)
+        nbytes = os.path.getsize(destpath)
+        instrument.add_bytes("written", nbytes)
+        return nbytes
+
+
+class _ZipLayer:
+    def __init__(self, path, prefix):
+        self.path = os.path.abspath(path)
+        self.prefix = prefix
+        self._zf = None
+
+    def __str__(self):
+        return self.path
+
+    def _zipfile(self):
+        if self._zf is None:
+            self._zf = zipfile.ZipFile(self.path)
+        return self._zf
+
+    def scan(self):
+        for info in self._zipfile().infolist():
+            if info.is_dir():
+                yield _join(self.prefix, info.filename), None
+            else:
+                yield _join(self.prefix, info.filename), info
+
+    def origin(self, member):
+        return "%s:%s" % (os.path.basename(self.path), member.filename)
+
+    def copy(self, member, destpath):
+        extract_zip_member(self._zipfile(), member, destpath)
+        return member.file_size
+
+
+def _join(*parts):
+    return posixpath.normpath(posixpath.join(*[p for p in parts if p]))
+
+
+class DriverInputTree:
+    """
+    Layers are added in order, files in later layers replace files at
+    the same relative path in earlier layers, like copying one dir
+    over the other. All paths are '/' separated and relative to the
+    tree root.
+    """
+    def __init__(self):
+        self._layers = []
+        self._files = {}
+        self._dirs = {}
+
+    def __str__(self):
+        return " + ".join(str(layer) for layer in self._layers)
+
+    def _add_layer(self, layer):
+        self._layers.append(layer)
+        for relpath, member in layer.scan():
+            # Paths are later joined to the output dir, never let a
+            # zip member or prefix point outside it
+            if (relpath == ".." or relpath.startswith("../") or
+                    posixpath.isabs(relpath)):
+                fail("%s: path is outside the input tree: %s" %
+                     (layer, relpath))
+            if member is None:
+                self._add_dir(relpath)
+                continue
+            reldir, basename = posixpath.split(relpath)
+            self._add_dir(reldir or ".")
+            self._files[relpath] = (layer, member)
+            self._dirs[reldir or "."].add(basename)
+
+    def _add_dir(self, reldir):
+        while reldir not in self._dirs:
+            self._dirs[reldir] = set()
+            if reldir == ".":
+                break
+            reldir = posixpath.dirname(reldir) or "."
+
+    def add_dir(self, path, prefix=""):
+        if not os.path.isdir(path):
+            fail("Input directory does not exist: %s" % path)
+        self._add_layer(_DirLayer(path, prefix))
+
+    def add_zip(self, path, prefix=""):
+        if not zipfile.is_zipfile(path):
+            fail("Input is not a zip file: %s" % path)
+        self._add_layer(_ZipLayer(path, prefix))
+
+
+    ##################
+    # Query helpers  #
+    ##################
+
+    def files(self):
+        return sorted(self._files)
+
+    def leaf_dirs(self):
+        """
+        Return every directory that has no subdirectories, like the
+        os.walk() entries with empty dirnames
+        """
+        parents = set()
+        for reldir in self._dirs:
+            if reldir != ".":
+                parents.add(posixpath.dirname(reldir) or ".")
+        return sorted(d for d in self._dirs
+                      if d not in parents and d != ".")
+
+    def glob(self, pattern):
+        """
+        Match a relative pattern against the index. Only the basename
+        may contain wildcards, which is all FILELISTS needs.
+        """
+        pattern = _join(pattern)
+        reldir, basepattern = posixpath.split(pattern)
+        names = self._dirs.get(reldir or ".", set())
+        return sorted(_join(reldir, n) for n in
+                      fnmatch.filter(names, basepattern))
+
+    def origin(self, relpath):
+        """
+        Return the input zip or overlay dir name and member relpath
+        comes from, without its location on this machine
+        """
+        layer, member = self._files[relpath]
+        return layer.origin(member)
+
+    def copy(self, relpath, destpath):
+        """
+        Copy a single file out of the tree. Returns the bytes written.
+        """
+        layer, member = self._files[relpath]
+        return layer.copy(member, destpath)
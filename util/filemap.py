@@ -3,680 +3,300 @@
 # This work is licensed under the terms of the GNU GPL, version 2 or later.
 # See the COPYING file in the top-level directory.
 
-# NOTE: This file is copied internally and used with some RHEL virtio-win
-#       build scripts. We should find a way to share it so they don't diverge.
-
-SUPPORTED_OSES = ['xp', '2k3', '2k8', '2k8R2', 'w7', 'w8', 'w8.1', '2k12',
-                  '2k12R2', 'w10', '2k16', '2k19', 'w11', '2k22', '2k25']
-SUPPORTED_ARCHES = ['x86', 'amd64']
-
+# NOTE: filemap.json is copied internally and used with some RHEL virtio-win
+#       build scripts. Compare DIGEST (printed by util/check-filemap.py)
+#       to detect when the copies diverge.
+
+"""
+Driver file layout tables, loaded from filemap.json.
+
+The JSON is compiled into the lookup structures below. The compiled form
+is cached in util/__pycache__, keyed by the digest of the JSON content,
+so most imports only need to hash the file and unpickle the result.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+from .utils import fail
+
+
+UTIL_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.path.join(UTIL_DIR, "filemap.json")
+
+# Bump this if the compiled layout changes
+_COMPILED_VERSION = 2
+
+
+####################
+# Internal helpers #
+####################
+
+def _strip_comments(value):
+    """
+    Drop any object keys starting with #, which are comments
+    """
+    if isinstance(value, dict):
+        return {k: _strip_comments(v) for k, v in value.items()
+                if not k.startswith("#")}
+    if isinstance(value, list):
+        return [_strip_comments(v) for v in value]
+    return value
+
+
+def _expand_filelists(filesets, rawlists):
+    """
+    Resolve @name references in filelists. @name includes either a
+    fileset or another filelist.
+    """
+    for name in filesets:
+        if name in rawlists:
+            fail("filemap: %s is both a fileset and a filelist" % name)
+
+    filelists = {}
+
+    def _expand(name, stack):
+        if name in filesets:
+            return filesets[name]
+        if name in filelists:
+            return filelists[name]
+        if name not in rawlists:
+            fail("filemap: unknown reference @%s in %s" % (name, stack[-1]))
+        if name in stack:
+            fail("filemap: reference loop: %s" % " -> ".join(stack + [name]))
+
+        ret = []
+        for item in rawlists[name]:
+            if item.startswith("@"):
+                ret += _expand(item[1:], stack + [name])
+            else:
+                ret.append(item)
+        filelists[name] = ret
+        return ret
+
+    for name in rawlists:
+        _expand(name, [])
+    return {name: filelists[name] for name in rawlists}
+
+
+def _resolve_filelist(filelists, drivername, destdir):
+    """
+    FILELISTS entry for copying drivername to destdir: the os specific
+    driver:os list if there is one, otherwise the generic driver list
+    """
+    dest_os = destdir.split("/")[0]
+    filelist = filelists.get(drivername + ":" + dest_os)
+    if filelist is None:
+        filelist = filelists.get(drivername)
+    return filelist
+
+
+def _build_resolution_table(filelists, driver_os_map):
+    table = {}
+    for drivername, osmap in driver_os_map.items():
+        for ostuple, destdirs in osmap.items():
+            table[(drivername, ostuple)] = [
+                (destdir, _resolve_filelist(filelists, drivername, destdir))
+                for destdir in destdirs]
+    return table
+
+
+def _build_variant_tables(table, variants):
+    ret = {}
+    for variant, profile in variants.items():
+        ret[variant] = {}
+        for (drivername, ostuple), dests in table.items():
+            if drivername in profile["drop_drivers"]:
+                dests = []
+            ret[variant][(drivername, ostuple)] = [
+                (destdir, filelist) for destdir, filelist in dests
+                if destdir.split("/")[0] not in profile["drop_oses"]]
+    return ret
+
+
+def _compile(data):
+    data = _strip_comments(data)
+    filelists = _expand_filelists(data["filesets"], data["filelists"])
+    table = _build_resolution_table(filelists, data["driver_os_map"])
+    return {
+        "SUPPORTED_OSES": data["supported_oses"],
+        "SUPPORTED_ARCHES": data["supported_arches"],
+        "AUTO_DRIVERS": data["auto_drivers"],
+        "AUTO_OS_BLACKLIST": data["auto_os_blacklist"],
+        "AUTO_ARCHES": data["auto_arches"],
+        "SUPPORTED_PLATFORM_DIGITAL_SIG":
+            data["supported_platform_digital_sig"],
+        "DRIVER_TO_CAT": data["driver_to_cat"],
+        "FILELISTS": filelists,
+        "DRIVER_OS_MAP": data["driver_os_map"],
+        "RESOLUTION_TABLE": table,
+        "VARIANTS": data["variants"],
+        "VARIANT_RESOLUTION_TABLES": _build_variant_tables(table,
+            data["variants"]),
+    }
+
+
+def _cache_path(digest):
+    return os.path.join(UTIL_DIR, "__pycache__",
+        "filemap.%s.%d.pickle" % (digest[:16], _COMPILED_VERSION))
+
+
+def _read_cache(digest):
+    try:
+        with open(_cache_path(digest), "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_cache(digest, compiled):
+    # The source tree may be read-only, the cache is optional
+    path = _cache_path(digest)
+    tmp = path + ".tmp-%s" % os.getpid()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "wb") as f:
+            pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+##################
+# Public helpers #
+##################
+
+def load(path=DATA_PATH, use_cache=True):
+    """
+    Load and compile a filemap.json. Returns (digest, compiled) where
+    compiled is a dict of the module level tables, by name.
+    """
+    content = open(path, "rb").read()
+    digest = hashlib.sha256(content).hexdigest()
+    compiled = None
+    if use_cache:
+        compiled = _read_cache(digest)
+    if compiled is None:
+        compiled = _compile(json.loads(content))
+        if use_cache:
+            _write_cache(digest, compiled)
+    return digest, compiled
+
+
+# sha256 of filemap.json
+DIGEST, _COMPILED = load()
+
+SUPPORTED_OSES = _COMPILED["SUPPORTED_OSES"]
+SUPPORTED_ARCHES = _COMPILED["SUPPORTED_ARCHES"]
 
 # List of drivers and windows versions we want to add to the
 # autodetectable $arch/$os/$driver symlink tree on the iso
-AUTO_DRIVERS = ["viostor", "vioscsi"]
-AUTO_OS_BLACKLIST = ['xp', '2k3', '2k8', 'w7', '2k8R2', 'w8', 'w8.1', '2k12', '2k12R2']
-AUTO_ARCHES = {
-    # pairs of: (iso arch naming, auto arch naming)
-    "x86": "i386",
-    "amd64": "amd64",
-}
-
-
-
-# These are strings that can be grepped from the .cat files,
-# to determine what windows OS they are intended for. This is used for
-# the internal RHEL process.
-SUPPORTED_PLATFORM_DIGITAL_SIG = {
-    'xp/x86' : 'X.P.X.8.6',
-    '2k3/x86' : 'S.e.r.v.e.r.2.0.0.3.X.8.6',
-    '2k3/amd64' : 'S.e.r.v.e.r.2.0.0.3.X.6.4',
-    '2k8/x86' : 'S.e.r.v.e.r.2.0.0.8.X.8.6',
-    '2k8/amd64' : 'S.e.r.v.e.r.2.0.0.8.X.6.4',
-    'w7/x86' : '7.X.8.6',
-    'w7/amd64' : '7.X.6.4',
-    '2k8R2/amd64' : 'S.e.r.v.e.r.2.0.0.8.R.2.X.6.4',
-    'w8/x86' : '8.X.8.6',
-    'w8/amd64' : '8.X.6.4',
-    'w8.1/x86' : 'v.6.3.\0',
-    'w8.1/amd64' : 'v.6.3._.X.6.4',
-    '2k12/amd64' : 'S.e.r.v.e.r.2.0.1.2.X.6.4',
-    '2k12R2/amd64' : 'v.6.3._.S.e.r.v.e.r._.X.6.4',
-    'w10/amd64' : 'v.1.0.0._.X.6.4._.V.b',
-    'w10/x86' : 'v.1.0.0._.V.b',
-    '2k16/amd64': 'S.e.r.v.e.r._.v.1.0.0._.X.6.4._.R.S',
-    '2k19/amd64': 'S.e.r.v.e.r._.v.1.0.0._.X.6.4._.R.S.5',
-    'w11/amd64' : 'v.1.0.0._.X.6.4._.2.4.H.2',
-    '2k22/amd64': 'S.e.r.v.e.r._.v.1.0.0._.X.6.4._.2.1.H.2',
-    '2k25/amd64': 'S.e.r.v.e.r._.v.1.0.0._.X.6.4._.2.4.H.2',
-}
-
-# This is used to map the driver name to the name of the
-# Microsoft catalog file. Normally the driver name and the
-# catalog file name are identical, so this table contains
-# entries for when they happen to be different.
-# This is used for internal RHEL processes.
-DRIVER_TO_CAT = {
-    'vioserial' : 'vioser',
-    'sriov' : 'vioprot',
-}
+AUTO_DRIVERS = _COMPILED["AUTO_DRIVERS"]
+AUTO_OS_BLACKLIST = _COMPILED["AUTO_OS_BLACKLIST"]
+AUTO_ARCHES = _COMPILED["AUTO_ARCHES"]
+
+# .cat file grep strings per OS, and driver name to .cat name exceptions.
+# These are used for internal RHEL processes.
+SUPPORTED_PLATFORM_DIGITAL_SIG = _COMPILED["SUPPORTED_PLATFORM_DIGITAL_SIG"]
+DRIVER_TO_CAT = _COMPILED["DRIVER_TO_CAT"]
 
 # FILELISTS: Describes what files from the virtio-win output belong to each
 # driver and arch combo
-FILELISTS = {}
-
-_balloonfiles = [
-    'balloon.cat',
-    'balloon.inf',
-    'balloon.pdb',
-    'balloon.sys',
-    'blnsvr.exe',
-    'blnsvr.pdb',
-]
-FILELISTS['Balloon'] = _balloonfiles + ['WdfCoInstaller01011.dll']
-FILELISTS['Balloon:xp'] = _balloonfiles + ['WdfCoInstaller01009.dll']
-FILELISTS['Balloon:2k3'] = FILELISTS['Balloon:xp']
-FILELISTS['Balloon:2k8'] = FILELISTS['Balloon:xp']
-FILELISTS['Balloon:2k8R2'] = FILELISTS['Balloon:xp']
-FILELISTS['Balloon:w7'] = FILELISTS['Balloon:xp']
-FILELISTS['Balloon:w8.1'] = _balloonfiles
-FILELISTS['Balloon:2k12R2'] = FILELISTS['Balloon:w8.1']
-FILELISTS['Balloon:w10'] = _balloonfiles
-FILELISTS['Balloon:2k16'] = FILELISTS['Balloon:w10']
-FILELISTS['Balloon:2k19'] = FILELISTS['Balloon:w10']
-FILELISTS['Balloon:w11'] = _balloonfiles
-FILELISTS['Balloon:2k22'] = FILELISTS['Balloon:w10']
-FILELISTS['Balloon:2k25'] = FILELISTS['Balloon:w11']
-
-_netkvmfiles = [
-    'netkvm.cat',
-    'netkvm.inf',
-    'netkvm.pdb',
-    'netkvm.sys',
-]
-
-FILELISTS['NetKVM:xp'] = _netkvmfiles
-FILELISTS['NetKVM:2k3'] = FILELISTS['NetKVM:xp']
-FILELISTS['NetKVM:w7'] = FILELISTS['NetKVM:xp'] + ['netkvmco.dll', 'netkvmco.pdb', 'readme.doc']
-FILELISTS['NetKVM:2k8'] = FILELISTS['NetKVM:w7']
-FILELISTS['NetKVM:2k8R2'] = FILELISTS['NetKVM:w7']
-FILELISTS['NetKVM:w8'] = FILELISTS['NetKVM:xp'] + ['netkvmco.dll', 'netkvmco.pdb', 'Readme.md']
-FILELISTS['NetKVM:w8.1'] = FILELISTS['NetKVM:w8']
-FILELISTS['NetKVM:2k12'] = FILELISTS['NetKVM:w8']
-FILELISTS['NetKVM:2k12R2'] = FILELISTS['NetKVM:w8.1']
-FILELISTS['NetKVM:w10'] = FILELISTS['NetKVM:xp'] + ['netkvmco.exe', 'netkvmco.pdb', 'netkvmp.exe', 'netkvmp.pdb','Readme.md']
-FILELISTS['NetKVM:2k16'] = FILELISTS['NetKVM:w10']
-FILELISTS['NetKVM:2k19'] = FILELISTS['NetKVM:w10']
-FILELISTS['NetKVM:w11'] = FILELISTS['NetKVM:w10']
-FILELISTS['NetKVM:2k22'] = FILELISTS['NetKVM:w10']
-FILELISTS['NetKVM:2k25'] = FILELISTS['NetKVM:w11']
-
-_pvpanicfiles = [
-    "pvpanic.cat",
-    "pvpanic.inf",
-    "pvpanic.pdb",
-    "pvpanic.sys",
-]
-
-FILELISTS['pvpanic:w7'] = _pvpanicfiles + ['WdfCoInstaller01009.dll']
-FILELISTS['pvpanic:2k8'] = FILELISTS['pvpanic:w7']
-FILELISTS['pvpanic:2k8R2'] = FILELISTS['pvpanic:w7']
-FILELISTS['pvpanic:w8'] = _pvpanicfiles + ['WdfCoInstaller01011.dll', 'pvpanic-pci.cat', 'pvpanic-pci.inf']
-FILELISTS['pvpanic:w8.1'] = _pvpanicfiles + ['pvpanic-pci.cat', 'pvpanic-pci.inf']
-FILELISTS['pvpanic:2k12'] = FILELISTS['pvpanic:w8']
-FILELISTS['pvpanic:2k12R2'] = FILELISTS["pvpanic:w8.1"]
-FILELISTS['pvpanic:w10'] = _pvpanicfiles + ['pvpanic-pci.cat', 'pvpanic-pci.inf']
-FILELISTS['pvpanic:2k16'] = FILELISTS['pvpanic:w10']
-FILELISTS['pvpanic:2k19'] = FILELISTS['pvpanic:w10']
-FILELISTS['pvpanic:w11'] = _pvpanicfiles + ['pvpanic-pci.cat', 'pvpanic-pci.inf']
-FILELISTS['pvpanic:2k22'] = FILELISTS['pvpanic:w10']
-FILELISTS['pvpanic:2k25'] = FILELISTS['pvpanic:w11']
-
-
-FILELISTS['qxl'] = [
-    "qxl.cat",
-    "qxl.inf",
-    "qxl.sys",
-    "qxldd.dll",
-]
-
-
-FILELISTS['qxldod'] = [
-    "qxldod.cat",
-    "qxldod.inf",
-    "qxldod.pdb",
-    "qxldod.sys",
-]
-
-
-_vioinputfiles = [
-    'vioinput.cat',
-    'vioinput.inf',
-    'vioinput.pdb',
-    'vioinput.sys',
-    'viohidkmdf.pdb',
-    'viohidkmdf.sys',
-]
-FILELISTS['vioinput:w7'] = _vioinputfiles + ['WdfCoInstaller01009.dll']
-FILELISTS['vioinput:2k8R2'] = FILELISTS["vioinput:w7"]
-FILELISTS['vioinput:w8'] = _vioinputfiles + ['WdfCoInstaller01011.dll']
-FILELISTS['vioinput:w8.1'] = _vioinputfiles
-FILELISTS['vioinput:2k12'] = FILELISTS["vioinput:w8"]
-FILELISTS['vioinput:2k12R2'] = FILELISTS["vioinput:w8.1"]
-# win10+ doesn't need .dll
-FILELISTS['vioinput'] = _vioinputfiles
-
-
-_viorngfiles = [
-    'viorng.cat',
-    'viorng.inf',
-    'viorng.pdb',
-    'viorng.sys',
-    'viorngum.dll',
-    'viorngum.pdb',
-]
-FILELISTS['viorng'] = _viorngfiles + ['WdfCoInstaller01011.dll']
-FILELISTS['viorng:xp'] = _viorngfiles + ['WdfCoInstaller01009.dll'] + ['viorngci.dll'] + ['viorngci.pdb']
-FILELISTS['viorng:2k3'] = FILELISTS['viorng:xp']
-FILELISTS['viorng:2k8R2'] = FILELISTS['viorng:xp']
-FILELISTS['viorng:2k8'] = FILELISTS['viorng:xp']
-FILELISTS['viorng:w7'] = FILELISTS['viorng:xp']
-FILELISTS['viorng:w8.1'] = _viorngfiles
-FILELISTS['viorng:2k12R2'] = FILELISTS['viorng:w8.1']
-FILELISTS['viorng:w10'] = _viorngfiles
-FILELISTS['viorng:2k16'] = FILELISTS['viorng:w10']
-FILELISTS['viorng:2k19'] = FILELISTS['viorng:w10']
-FILELISTS['viorng:w11'] = _viorngfiles
-FILELISTS['viorng:2k22'] = FILELISTS['viorng:w10']
-FILELISTS['viorng:2k25'] = FILELISTS['viorng:w11']
-
-
-FILELISTS['vioscsi'] = [
-    'vioscsi.cat',
-    'vioscsi.inf',
-    'vioscsi.pdb',
-    'vioscsi.sys',
-]
-
-
-_vioserialfiles = [
-    'vioser.cat',
-    'vioser.inf',
-    'vioser.pdb',
-    'vioser.sys',
-]
-FILELISTS['vioserial'] = _vioserialfiles + ['WdfCoInstaller01011.dll']
-FILELISTS['vioserial:xp'] = _vioserialfiles + ['WdfCoInstaller01009.dll']
-FILELISTS['vioserial:2k3'] = FILELISTS['vioserial:xp']
-FILELISTS['vioserial:2k8'] = FILELISTS['vioserial:xp']
-FILELISTS['vioserial:2k8R2'] = FILELISTS['vioserial:xp']
-FILELISTS['vioserial:w7'] = FILELISTS['vioserial:xp']
-FILELISTS['vioserial:w8.1'] = _vioserialfiles
-FILELISTS['vioserial:2k12R2'] = FILELISTS['vioserial:w8.1']
-FILELISTS['vioserial:w10'] = _vioserialfiles
-FILELISTS['vioserial:2k16'] = FILELISTS['vioserial:w10']
-FILELISTS['vioserial:2k19'] = FILELISTS['vioserial:w10']
-FILELISTS['vioserial:w11'] = _vioserialfiles
-FILELISTS['vioserial:2k22'] = FILELISTS['vioserial:w10']
-FILELISTS['vioserial:2k25'] = FILELISTS['vioserial:w11']
-
-
-FILELISTS['viostor'] = [
-    'viostor.cat',
-    'viostor.inf',
-    'viostor.pdb',
-    'viostor.sys',
-]
-
-_qemupciserialfiles = [
-    'qemupciserial.cat',
-    'qemupciserial.inf',
-]
-FILELISTS['qemupciserial'] = _qemupciserialfiles
-
-_qemufwcfgfiles = [
-    'qemufwcfg.cat',
-    'qemufwcfg.inf',
-]
-FILELISTS['qemufwcfg'] = _qemufwcfgfiles
-
-_smbusfiles = [
-    'smbus.cat',
-    'smbus.inf',
-]
-FILELISTS['smbus'] = _smbusfiles
-
-_certfiles = [
-    'Virtio_Win_Red_Hat_CA.cer',
-]
-FILELISTS['cert'] = _certfiles
-
-_debugfiles = [
-    'debug/CollectSystemInfo.ps1',
-    'debug/LICENSE',
-    'debug/README.md',
-]
-FILELISTS['debug'] = _debugfiles
-
-_viofsfiles = [
-    'viofs.cat',
-    'viofs.inf',
-    'viofs.pdb',
-    'viofs.sys',
-    'virtiofs.exe',
-    'virtiofs.pdb',
-]
-FILELISTS['viofs'] = _viofsfiles
-FILELISTS['viofs:w8'] = _viofsfiles + ['WdfCoInstaller01011.dll']
-FILELISTS['viofs:w8.1'] = _viofsfiles
-FILELISTS['viofs:2k12'] = FILELISTS['viofs:w8']
-FILELISTS['viofs:2k12R2'] = FILELISTS['viofs:w8.1']
-FILELISTS['viofs:w10'] = _viofsfiles
-FILELISTS['viofs:2k16'] = FILELISTS['viofs:w10']
-FILELISTS['viofs:2k19'] = FILELISTS['viofs:w10']
-FILELISTS['viofs:w11'] = _viofsfiles
-FILELISTS['viofs:2k22'] = FILELISTS['viofs:w10']
-FILELISTS['viofs:2k25'] = FILELISTS['viofs:w11']
-
-_viosriov = [
-    'vioprot.cat',
-    'vioprot.inf',
-]
-FILELISTS['sriov'] = _viosriov
-FILELISTS['sriov:w8'] = _viosriov + ['netkvmno.dll', 'netkvmno.pdb', 'netkvmp.exe', 'netkvmp.pdb']
-FILELISTS['sriov:w8.1'] = FILELISTS['sriov:w8']
-FILELISTS['sriov:2k12'] = FILELISTS['sriov:w8']
-FILELISTS['sriov:2k12R2'] = FILELISTS['sriov:w8.1']
-FILELISTS['sriov:w10'] = _viosriov
-FILELISTS['sriov:2k16'] = FILELISTS['sriov:w10']
-FILELISTS['sriov:2k19'] = FILELISTS['sriov:w10']
-FILELISTS['sriov:2k22'] = FILELISTS['sriov:w10']
-FILELISTS['sriov:w11'] = _viosriov
-FILELISTS['sriov:2k25'] = FILELISTS['sriov:w11']
-
-_viogpudofiles = [
-    'viogpudo.cat',
-    'viogpudo.inf',
-    'viogpudo.pdb',
-    'viogpudo.sys',
-    'vgpusrv.exe',
-    'vgpusrv.pdb',
-    'viogpuap.exe',
-    'viogpuap.pdb',
-]
-FILELISTS['viogpudo'] = _viogpudofiles
-
-_fwcfgfiles = [
-    'fwcfg.cat',
-    'fwcfg.inf',
-    'fwcfg.pdb',
-    'fwcfg.sys',
-]
-FILELISTS['fwcfg'] = _fwcfgfiles
-FILELISTS['fwcfg:w8'] = _fwcfgfiles + ['WdfCoInstaller01011.dll']
-FILELISTS['fwcfg:2k12'] = FILELISTS['fwcfg:w8']
-FILELISTS['fwcfg:w8.1'] = _fwcfgfiles
-FILELISTS['fwcfg:2k12R2'] = FILELISTS['fwcfg:w8.1']
-FILELISTS['fwcfg:w10'] = _fwcfgfiles
-FILELISTS['fwcfg:2k16'] = FILELISTS['fwcfg:w10']
-FILELISTS['fwcfg:2k19'] = FILELISTS['fwcfg:w10']
-FILELISTS['fwcfg:w11'] = _fwcfgfiles
-FILELISTS['fwcfg:2k22'] = FILELISTS['fwcfg:w10']
-FILELISTS['fwcfg:2k25'] = FILELISTS['fwcfg:w11']
-
-FILELISTS['viomem'] = [
-    'viomem.cat',
-    'viomem.inf',
-    'viomem.pdb',
-    'viomem.sys',
-]
-
-_viosockfiles = [
-    'viosock.cat',
-    'viosock.inf',
-    'viosock.pdb',
-    'viosock.sys',
-    'viosocklib_x64.dll',
-    'viosocklib_x64.pdb',
-    'viosocklib_x86.dll',
-    'viosocklib_x86.pdb',
-    'viosockwspsvc.exe',
-    'viosockwspsvc.pdb',
-    'viosock-test.exe',
-    'viosock-test.pdb',
-    'viosocklib-test.exe',
-    'viosocklib-test.pdb',
-    'vstbridge.exe',
-    'vstbridge.pdb',
-
-]
-FILELISTS['viosock'] = _viosockfiles
-FILELISTS['viosock:w10'] = _viosockfiles + ['viosocklib.dll']
-FILELISTS['viosock:2k16'] = FILELISTS['viosock:w10']
-FILELISTS['viosock:2k19'] = FILELISTS['viosock:w10']
-FILELISTS['viosock:w11'] = _viosockfiles
-FILELISTS['viosock:2k22'] = FILELISTS['viosock:w10']
-FILELISTS['viosock:2k25'] = FILELISTS['viosock:w11']
+FILELISTS = _COMPILED["FILELISTS"]
 
 # Describes what windows arch the virtio-win build output maps to.
 #
 # Example: Balloon: {"Wxp/x86": ["2k3/x86"]}
 # Means: all Balloon files in virtio-win/Wxp/x86 should be copied to
 #        output-dir/2k3/x86
-DRIVER_OS_MAP = {
-    'Balloon': {
-        'Wxp/x86': ['xp/x86'],
-
-        'Wnet/x86' : ['2k3/x86'],
-        'Wnet/amd64': ['2k3/amd64', 'xp/amd64'],
-
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'NetKVM': {
-        'Wxp/x86': ['xp/x86'],
-
-        'Wnet/x86' : ['2k3/x86'],
-        'Wnet/amd64': ['2k3/amd64', 'xp/amd64'],
-
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['2k8R2/amd64', 'w7/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'pvpanic': {
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'vioinput': {
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'viorng': {
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'vioscsi': {
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'vioserial': {
-        'Wxp/x86': ['xp/x86'],
-
-        'Wnet/x86' : ['2k3/x86'],
-        'Wnet/amd64': ['2k3/amd64', 'xp/amd64'],
-
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-
-    'viostor': {
-        'Wxp/x86': ['xp/x86'],
-
-        'Wnet/x86': ['2k3/x86'],
-        'Wnet/amd64': ['2k3/amd64', 'xp/amd64'],
-
-        'Wlh/x86': ['2k8/x86'],
-        'Wlh/amd64': ['2k8/amd64'],
-
-        'Win7/x86': ['w7/x86'],
-        'Win7/amd64': ['w7/amd64', '2k8R2/amd64'],
-
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-    'qemupciserial': {
-        './rhel': [
-            '2k8/x86', '2k8/amd64', 'w7/x86', 'w7/amd64', '2k8R2/amd64',
-            'w8/x86', 'w8.1/x86', 'w8/amd64', 'w8.1/amd64', '2k12/amd64',
-            '2k12R2/amd64', 'w10/x86', 'w10/amd64', '2k16/amd64', '2k19/amd64',
-            'w11/amd64', '2k22/amd64', '2k25/amd64'
-        ],
-        './': [
-            '2k8/x86', '2k8/amd64', 'w7/x86', 'w7/amd64', '2k8R2/amd64',
-            'w8/x86', 'w8.1/x86', 'w8/amd64', 'w8.1/amd64', '2k12/amd64',
-            '2k12R2/amd64', 'w10/x86', 'w10/amd64', '2k16/amd64', '2k19/amd64',
-            'w11/amd64', '2k22/amd64', '2k25/amd64'
-        ],
-    },
-
-    'qemufwcfg': {
-        './': ['w10/x86', 'w10/amd64', '2k16/amd64', '2k19/amd64', 'w11/amd64', '2k22/amd64', '2k25/amd64'],
-    },
-
-    'smbus': {
-        './': ['2k8/x86', '2k8/amd64', 'w11/amd64', '2k22/amd64', '2k25/amd64'],
-    },
-
-
-    # qxl and qxldod mappings are only used by fedora scripts. if the
-    # internal scripts every programmatically consume qxl/qxldod, this stuff
-    # likely needs to be adjusted
-    'qxl': {
-        'qxl/xp/x86': ['xp/x86'],
-        'qxl/w7/x86': ['w7/x86'],
-        'qxl/w7/amd64': ['w7/amd64'],
-        'qxl/2k8R2/amd64': ['2k8R2/amd64'],
-    },
-    'qxldod': {
-        # The 8.1-compatible archive has cat sig OS=10X86, but it's only
-        # supposed to be for win8 era stuff, and has osAttr kernel=6.4
-        "spice-qxl-wddm-dod-8.1-compatible/x86": [
-            "w8/x86", "w8.1/x86"],
-        'spice-qxl-wddm-dod-8.1-compatible/amd64': [
-            'w8/amd64', 'w8.1/amd64', '2k12/amd64', '2k12R2/amd64'],
-        'spice-qxl-wddm-dod/w10/x86': ['w10/x86'],
-        'spice-qxl-wddm-dod/w10/amd64': [
-            'w10/amd64', '2k16/amd64', '2k19/amd64'],
-    },
-
-    'viofs': {
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64'],
-  },
-
-    'sriov': {
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-#        'Win11/ARM64': ['w11/ARM64'],
-     },
-
-    'viogpudo': {
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-    'cert': {
-        './': ['./'],
-    },
-
-    'debug': {
-        './': ['./'],
-    },
-
-    'fwcfg': {
-        'Win8/x86': ['w8/x86'],
-        'Win8/amd64': ['w8/amd64', '2k12/amd64'],
-
-        'Win8.1/x86': ['w8.1/x86'],
-        'Win8.1/amd64': ['w8.1/amd64', '2k12R2/amd64'],
-
-        'Win10/x86': ['w10/x86'],
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-    },
-
-    'viomem': {
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-        'Win10/ARM64': ['w10/ARM64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-        'Win11/ARM64': ['w11/ARM64', '2k25/ARM64'],
-    },
-
-    'viosock': {
-        'Win10/amd64': ['w10/amd64', '2k16/amd64', '2k19/amd64', '2k22/amd64'],
-
-        'Win11/amd64': ['w11/amd64', '2k25/amd64'],
-    },
-
-}
+DRIVER_OS_MAP = _COMPILED["DRIVER_OS_MAP"]
+
+# {(drivername, ostuple): [(destdir, filelist), ...]}, computed once from
+# DRIVER_OS_MAP and FILELISTS. A filelist is None if there's no
+# FILELISTS entry for that destination, see check_consistency()
+RESOLUTION_TABLE = _COMPILED["RESOLUTION_TABLE"]
+
+# Build variants: {name: {"drop_oses": [...], "drop_drivers": [...]}}.
+# Dropped OS dirs and drivers are left out of the variant's output
+# entirely, see resolve() and variant_drops()
+VARIANTS = _COMPILED["VARIANTS"]
+DEFAULT_VARIANT = "fedora"
+
+# {variant: RESOLUTION_TABLE minus the variant's dropped destinations}
+VARIANT_RESOLUTION_TABLES = _COMPILED["VARIANT_RESOLUTION_TABLES"]
+
+
+def resolve(drivername, ostuple, variant=None):
+    """
+    Return [(destdir, filelist), ...] for the build output of drivername
+    in the ostuple input dir. With variant, only the destinations that
+    variant ships.
+    """
+    if variant is None:
+        return RESOLUTION_TABLE[(drivername, ostuple)]
+    return VARIANT_RESOLUTION_TABLES[variant][(drivername, ostuple)]
+
+
+def variant_drops(variant, relpath):
+    """
+    Whether relpath, relative to a make-driver-dir.py output dir like
+    $driver/$os/$arch/$file, is left out of variant
+    """
+    profile = VARIANTS[variant]
+    parts = os.path.normpath(relpath).split(os.sep)
+    if parts[0] in profile["drop_drivers"]:
+        return True
+    return len(parts) > 1 and parts[1] in profile["drop_oses"]
+
+
+def check_consistency():
+    """
+    Sanity check the tables above. Returns a list of error strings,
+    empty if everything is fine.
+    """
+    errors = []
+    for (drivername, ostuple), dests in sorted(RESOLUTION_TABLE.items()):
+        for destdir, filelist in dests:
+            if filelist is None:
+                errors.append("%s %s -> %s: no FILELISTS entry" %
+                              (drivername, ostuple, destdir))
+            if destdir == "./":
+                continue
+
+            dest_os, dest_arch = destdir.split("/")
+            if dest_os not in SUPPORTED_OSES:
+                errors.append("%s %s -> %s: %s not in SUPPORTED_OSES" %
+                              (drivername, ostuple, destdir, dest_os))
+            if dest_arch not in SUPPORTED_ARCHES:
+                errors.append("%s %s -> %s: %s not in SUPPORTED_ARCHES" %
+                              (drivername, ostuple, destdir, dest_arch))
+
+    if DEFAULT_VARIANT not in VARIANTS:
+        errors.append("variants: no %s entry" % DEFAULT_VARIANT)
+    for variant, profile in sorted(VARIANTS.items()):
+        for dest_os in profile["drop_oses"]:
+            if dest_os not in SUPPORTED_OSES:
+                errors.append("variant %s: drops %s, not in SUPPORTED_OSES" %
+                              (variant, dest_os))
+        for drivername in profile["drop_drivers"]:
+            if drivername not in DRIVER_OS_MAP:
+                errors.append("variant %s: drops %s, not in DRIVER_OS_MAP" %
+                              (variant, drivername))
+    return errors
+
+
+def unused_filelists():
+    """
+    Return FILELISTS keys that no DRIVER_OS_MAP destination resolves to
+    """
+    used = set()
+    for (drivername, dummy), dests in RESOLUTION_TABLE.items():
+        for destdir, dummy in dests:
+            dest_os = destdir.split("/")[0]
+            if drivername + ":" + dest_os in FILELISTS:
+                used.add(drivername + ":" + dest_os)
+            else:
+                used.add(drivername)
+    return sorted(set(FILELISTS) - used)
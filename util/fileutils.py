@@ -0,0 +1,124 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+In-process file copying and archive extraction helpers
+"""
+
+import hashlib
+import os
+import shutil
+import time
+
+from . import instrument
+
+
+# Buffer size for file copies and archive extraction
+BUFSIZE = 1024 * 1024
+
+
+def extract_zip_member(zf, info, destpath):
+    """
+    Extract a single ZipInfo from the open ZipFile to destpath, keeping
+    the archived mtime the way `unzip` does. Returns the bytes written.
+    """
+    with zf.open(info) as src, \
+            open(destpath, "wb", buffering=BUFSIZE) as dst:
+        shutil.copyfileobj(src, dst, BUFSIZE)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(destpath, (mtime, mtime))
+    instrument.add_bytes("written", info.file_size)
+    return info.file_size
+
+
+# linux/fs.h FICLONE ioctl, to reflink a file on btrfs/xfs
+_FICLONE = 0x40049409
+
+
+def _reflink(srcpath, dstpath):
+    try:
+        import fcntl  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return False
+
+    with open(srcpath, "rb") as src, open(dstpath, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return True
+        except OSError:
+            pass
+    os.unlink(dstpath)
+    return False
+
+
+def transfer(srcpath, dstpath):
+    """
+    Put srcpath content at dstpath as cheaply as possible: hardlink,
+    then reflink, then a buffered copy. The sha256 of the content is
+    returned, computed while copying when a real copy is needed.
+    Like `cp`, if dstpath is a directory the file is put inside it,
+    and an existing dstpath is replaced.
+    """
+    if os.path.isdir(dstpath):
+        dstpath = os.path.join(dstpath, os.path.basename(srcpath))
+    if os.path.lexists(dstpath):
+        os.unlink(dstpath)
+
+    try:
+        os.link(srcpath, dstpath)
+        print("+ link %s %s" % (srcpath, dstpath))
+        return file_digest(srcpath)
+    except OSError:
+        pass
+
+    if _reflink(srcpath, dstpath):
+        print("+ reflink %s %s" % (srcpath, dstpath))
+        return file_digest(srcpath)
+
+    print("+ copy %s %s" % (srcpath, dstpath))
+    h = hashlib.sha256()
+    with open(srcpath, "rb") as src, open(dstpath, "wb") as dst:
+        while True:
+            buf = src.read(BUFSIZE)
+            if not buf:
+                break
+            h.update(buf)
+            dst.write(buf)
+            instrument.add_bytes("written", len(buf))
+    shutil.copystat(srcpath, dstpath)
+    return h.hexdigest()
+
+
+def write_checksums(dirpath, digests):
+    """
+    Write a `sha256sum -c` compatible SHA256SUMS file into dirpath.
+
+    :param digests: dict of {filename: sha256}
+    """
+    content = "".join("%s  %s\n" % (digests[name], name)
+                      for name in sorted(digests))
+    open(os.path.join(dirpath, "SHA256SUMS"), "w").write(content)
+
+
+def file_digest(path):
+    """
+    Return the sha256 hexdigest of path
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(BUFSIZE)
+            if not buf:
+                break
+            h.update(buf)
+            instrument.add_bytes("hashed", len(buf))
+    return h.hexdigest()
+
+
+def format_rate(nbytes, seconds):
+    """
+    Return a human readable '$size in $time ($rate/s)' string
+    """
+    mbytes = nbytes / (1024.0 * 1024.0)
+    rate = mbytes / seconds if seconds > 0 else 0.0
+    return "%.1f MiB in %.1fs (%.1f MiB/s)" % (mbytes, seconds, rate)
@@ -0,0 +1,251 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Lightweight tracing of where build time, CPU, memory and I/O go.
+
+Code wraps interesting steps in `with span("name"):`, and the file
+helpers report bytes they move with add_bytes(). When tracing is off,
+which is the default, both are close to free.
+
+Tracing is turned on with enable(path), or by setting $VIRTIO_WIN_TRACE
+to the trace path. enable() exports that variable, so python scripts we
+run via shellcomm() trace themselves too; each process writes its own
+part file, and the process that called enable() merges them into a
+single Chrome trace JSON at exit. Load it in chrome://tracing or
+https://ui.perfetto.dev.
+
+Per span we record wall time, CPU time of the calling thread and of
+finished child processes, the process peak RSS, and the process I/O
+counters from /proc/self/io. Everything but the thread CPU time is
+process wide, so for concurrently running spans it's only approximate;
+the add_bytes() counters are exact per span.
+"""
+
+import atexit
+import contextlib
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+TRACE_ENV = "VIRTIO_WIN_TRACE"
+# pid of the process that merges the trace parts
+_OWNER_ENV = "VIRTIO_WIN_TRACE_OWNER"
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = {
+    "path": None,
+    "owner": False,
+    "events": [],
+}
+
+
+####################
+# Internal helpers #
+####################
+
+def _now_us():
+    return int(time.time() * 1000000)
+
+
+def _proc_io():
+    """
+    Return {rchar, wchar, read_bytes, write_bytes} for this process,
+    empty if /proc/self/io isn't available
+    """
+    ret = {}
+    try:
+        for line in open("/proc/self/io"):
+            key, value = line.split(":")
+            ret[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return ret
+
+
+def _part_path():
+    return "%s.%d.part" % (_state["path"], os.getpid())
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _write():
+    """
+    atexit handler: write this process' events, and merge in the child
+    process part files if we own the trace
+    """
+    events = list(_state["events"])
+    events.insert(0, {
+        "name": "process_name", "ph": "M", "pid": os.getpid(),
+        "args": {"name": os.path.basename(sys.argv[0] or "python")},
+    })
+
+    if not _state["owner"]:
+        tmp = _part_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(events, f)
+        os.replace(tmp, _part_path())
+        return
+
+    for part in sorted(glob.glob(glob.escape(_state["path"]) + ".*.part")):
+        try:
+            events += json.load(open(part))
+        except ValueError:
+            pass
+        os.unlink(part)
+
+    with open(_state["path"], "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print_summary(events)
+    print("Wrote trace to %s" % _state["path"])
+
+
+def _start(path, owner):
+    _state["path"] = os.path.abspath(path)
+    _state["owner"] = owner
+    os.environ[TRACE_ENV] = _state["path"]
+    if owner:
+        os.environ[_OWNER_ENV] = str(os.getpid())
+    atexit.register(_write)
+
+
+##################
+# Public helpers #
+##################
+
+def enabled():
+    return _state["path"] is not None
+
+
+def enable(path):
+    """
+    Start tracing this process, and any child processes we run, to the
+    Chrome trace file path
+    """
+    if enabled():
+        return
+    for part in glob.glob(glob.escape(os.path.abspath(path)) + ".*.part"):
+        os.unlink(part)
+    _start(path, True)
+
+
+def add_bytes(kind, nbytes):
+    """
+    Count nbytes of kind (like 'read', 'written', 'hashed') against the
+    innermost span running in this thread
+    """
+    stack = _stack() if enabled() else None
+    if not stack:
+        return
+    counters = stack[-1]
+    counters[kind] = counters.get(kind, 0) + nbytes
+
+
+@contextlib.contextmanager
+def span(name, category="step", **args):
+    """
+    Record the duration and resource usage of the with block
+    """
+    if not enabled():
+        yield
+        return
+
+    counters = {}
+    _stack().append(counters)
+    start = _now_us()
+    cpu0 = time.thread_time()
+    io0 = _proc_io()
+    children0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        yield
+    finally:
+        _stack().pop()
+        end = _now_us()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io1 = _proc_io()
+
+        eventargs = dict(args)
+        eventargs.update({
+            "cpu_s": round(time.thread_time() - cpu0, 3),
+            "child_cpu_s": round(
+                (children.ru_utime + children.ru_stime) -
+                (children0.ru_utime + children0.ru_stime), 3),
+            "maxrss_kb": usage.ru_maxrss,
+        })
+        if children.ru_maxrss:
+            eventargs["child_maxrss_kb"] = children.ru_maxrss
+        for key in ["rchar", "wchar", "read_bytes", "write_bytes"]:
+            if key in io1 and key in io0:
+                eventargs["io_" + key] = io1[key] - io0[key]
+        for kind, value in counters.items():
+            eventargs["bytes_" + kind] = value
+
+        event = {
+            "name": name, "cat": category, "ph": "X",
+            "ts": start, "dur": end - start,
+            "pid": os.getpid(), "tid": threading.get_ident(),
+            "args": eventargs,
+        }
+        with _lock:
+            _state["events"].append(event)
+
+
+def _summary_key(event):
+    if event.get("cat") != "shell":
+        return event["name"]
+    # Group commands by program, skipping any leading 'cd DIR &&'
+    cmd = event["args"].get("cmd", event["name"])
+    program = cmd.split("&&")[-1].split()[0] if cmd.strip() else cmd
+    return "shell: %s" % os.path.basename(program)
+
+
+def print_summary(events, limit=20):
+    """
+    Print a summary of trace events, grouped by span name, or by program
+    for shell commands. Only the limit slowest are shown.
+    """
+    totals = {}
+    for event in events:
+        if event.get("ph") != "X":
+            continue
+        entry = totals.setdefault(_summary_key(event),
+            {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0})
+        entry["count"] += 1
+        entry["wall"] += event["dur"] / 1000000.0
+        entry["cpu"] += (event["args"].get("cpu_s", 0) +
+                         event["args"].get("child_cpu_s", 0))
+        entry["bytes"] += sum(v for k, v in event["args"].items()
+                              if k.startswith("bytes_"))
+    if not totals:
+        return
+
+    print()
+    print("Trace summary (wall time includes nested spans):")
+    names = sorted(totals, key=lambda n: -totals[n]["wall"])[:limit]
+    width = min(max(len(n) for n in names), 60)
+    for name in names:
+        entry = totals[name]
+        print("  %-*s  n=%-4d wall=%7.1fs  cpu=%7.1fs  moved=%7.1fMiB" %
+              (width, name[:width], entry["count"], entry["wall"],
+               entry["cpu"], entry["bytes"] / (1024.0 * 1024.0)))
+    print()
+
+
+# Child processes of a traced run pick the trace up from the environment.
+# If $VIRTIO_WIN_TRACE was set by hand, this process owns the trace.
+if os.environ.get(TRACE_ENV) and not enabled():
+    if os.environ.get(_OWNER_ENV):
+        _start(os.environ[TRACE_ENV], False)
+    else:
+        enable(os.environ[TRACE_ENV])
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Local stand-in for the servers fetch-latest-builds.py scrapes.
+
+generate_tree() writes a synthetic directory tree with the layout the
+fetch-latest-builds.py _check_* and _get_*_urls functions expect, for
+the internal build system, the spice-space.org downloads and the
+published latest-build input. MirrorServer serves it over HTTP/1.1 with
+directory listings, ETag/Last-Modified revalidation and byte ranges,
+adding a configurable per-request latency and per-connection bandwidth
+limit.
+
+Run it standalone to point fetch-latest-builds.py at it:
+
+    ./util/mirrorsim.py --root /tmp/mirror --port 8000
+    ./fetch-latest-builds.py --redownload \\
+        --internal-url http://localhost:8000/internal \\
+        --spice-url http://localhost:8000/spice \\
+        --published-url http://localhost:8000/published
+"""
+
+import argparse
+import email.utils
+import http.server
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zipfile
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+from util.utils import fail  # pylint: disable=wrong-import-position
+
+
+# Versions of every package in the generated tree
+VIRTIO_VERSION = ("0.1", "240")
+QEMU_GA_VERSION = ("105.0.2", "1.el9")
+VDAGENT_VERSION = ("0.10.0", "5")
+QXL_VERSION = "0.1-24"
+QXLWDDM_VERSION = "0.21"
+
+# Older version dirs listed next to the latest ones, so the scrapers
+# have to pick the newest
+_OLD_VERSIONS = {
+    "virtio": ("0.1", "239"),
+    "qemu-ga": ("104.0.0", "1.el9"),
+    "vdagent": ("0.9.0", "3"),
+    "qxl": "0.1-23",
+    "qxlwddm": "0.20",
+}
+
+# Default file sizes, by extension. -sources.zip files get
+# SOURCES_SIZE instead
+DEFAULT_SIZES = {
+    "zip": 4 * 1024 * 1024,
+    "msi": 2 * 1024 * 1024,
+    "rpm": 2 * 1024 * 1024,
+}
+SOURCES_SIZE = 32 * 1024 * 1024
+
+
+##################
+# Tree generator #
+##################
+
+def _mirror_files():
+    """
+    Return {relpath: kind} for every file in the generated tree. kind is
+    None for plain files, otherwise the json or zip content type
+    """
+    files = {}
+    ver, rel = VIRTIO_VERSION
+    base = "internal/virtio-win-prewhql/%s/%s/win/" % (ver, rel)
+    files[base + "virtio-win-prewhql-%s.zip" % ver] = "drivers"
+    files[base + "virtio-win-prewhql-%s-%s-sources.zip" % (ver, rel)] = "zip"
+    files[base + "virtio-win-prewhql-%s-%s-spec.zip" % (ver, rel)] = "zip"
+
+    ver, rel = QEMU_GA_VERSION
+    base = "internal/mingw-qemu-ga-win/%s/%s/" % (ver, rel)
+    files[base + "noarch/qemu-ga-win-%s-%s.noarch.rpm" % (ver, rel)] = None
+    files[base + "src/mingw-qemu-ga-win-%s-%s.src.rpm" % (ver, rel)] = None
+
+    ver, rel = VDAGENT_VERSION
+    base = "internal/spice-vdagent-win/%s/%s/win/" % (ver, rel)
+    verrel = "%s-%s" % (ver, rel)
+    files[base + "spice-vdagent-x64-%s.msi" % verrel] = None
+    files[base + "spice-vdagent-x86-%s.msi" % verrel] = None
+    files[base + "spice-vdagent-win-%s-sources.zip" % verrel] = "zip"
+    files[base + "spice-vdagent-win-%s-spec.zip" % verrel] = "zip"
+    files[base + "spice_vdagent_x64.zip"] = "zip"
+    files[base + "spice_vdagent_x86.zip"] = "zip"
+
+    base = "spice/qxl/qxl-%s/" % QXL_VERSION
+    for name in ["qxl_w7_x64.zip", "qxl_w7_x86.zip", "qxl_8k2R2_x64.zip",
+                 "qxl-win-unsigned-%s-sources.zip" % QXL_VERSION,
+                 "qxl-win-unsigned-%s-spec.zip" % QXL_VERSION]:
+        files[base + name] = "zip"
+
+    base = "spice/qxl-wddm-dod/qxl-wddm-dod-%s/" % QXLWDDM_VERSION
+    for name in ["spice-qxl-wddm-dod-%s-0-sources.zip" % QXLWDDM_VERSION,
+                 "spice-qxl-wddm-dod-%s.zip" % QXLWDDM_VERSION,
+                 "spice-qxl-wddm-dod-%s-8.1-compatible.zip" %
+                 QXLWDDM_VERSION]:
+        files[base + name] = "zip"
+
+    files["published/buildversions.json"] = "json"
+    return files
+
+
+def _old_version_dirs():
+    ver, rel = _OLD_VERSIONS["virtio"]
+    qver, qrel = _OLD_VERSIONS["qemu-ga"]
+    sver, srel = _OLD_VERSIONS["vdagent"]
+    return [
+        "internal/virtio-win-prewhql/%s/%s" % (ver, rel),
+        "internal/mingw-qemu-ga-win/%s/%s" % (qver, qrel),
+        "internal/spice-vdagent-win/%s/%s" % (sver, srel),
+        "spice/qxl/qxl-%s" % _OLD_VERSIONS["qxl"],
+        "spice/qxl-wddm-dod/qxl-wddm-dod-%s" % _OLD_VERSIONS["qxlwddm"],
+    ]
+
+
+def _random_bytes(relpath, size):
+    return random.Random(relpath).randbytes(size)
+
+
+def _write_zip(path, relpath, size):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+        zf.writestr("content.bin", _random_bytes(relpath, size))
+
+
+def _published_buildversions():
+    """
+    buildversions.json as published for an older virtio-win build
+    """
+    ver, rel = _OLD_VERSIONS["virtio"]
+    return {"virtio-win-prewhql": {"version": "%s-%s" % (ver, rel),
+                                   "urls": []}}
+
+
+def generate_tree(rootdir, sizes=None, sources_size=SOURCES_SIZE,
+                  drivers_zip=None):
+    """
+    Write the synthetic mirror tree to rootdir, skipping files that
+    already exist.
+
+    :param sizes: {extension: bytes} overriding DEFAULT_SIZES
+    :param drivers_zip: file used as the virtio-win-prewhql build zip,
+        for example from util/benchmark.py generate_tree(). Otherwise
+        it's a zip like the others
+    Returns the total size of the files served for a full download.
+    """
+    allsizes = dict(DEFAULT_SIZES)
+    allsizes.update(sizes or {})
+
+    for relpath in _old_version_dirs():
+        os.makedirs(os.path.join(rootdir, relpath), exist_ok=True)
+
+    total = 0
+    for relpath, kind in sorted(_mirror_files().items()):
+        path = os.path.join(rootdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ext = relpath.rsplit(".", 1)[-1]
+        size = (sources_size if relpath.endswith("-sources.zip") else
+                allsizes.get(ext, DEFAULT_SIZES["zip"]))
+
+        if not os.path.exists(path):
+            if kind == "json":
+                open(path, "w").write(json.dumps(_published_buildversions(),
+                    sort_keys=True, indent=2))
+            elif kind == "drivers" and drivers_zip:
+                os.link(drivers_zip, path)
+            elif kind in ["zip", "drivers"]:
+                _write_zip(path, relpath, size)
+            else:
+                open(path, "wb").write(_random_bytes(relpath, size))
+        if kind != "json" and not relpath.endswith("-spec.zip"):
+            total += os.path.getsize(path)
+    return total
+
+
+##########
+# Server #
+##########
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "virtio-win-mirrorsim"
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        if self.server.verbose:
+            super().log_message(*args)
+
+    def _send(self, status, body, headers=None, length=None):
+        """
+        Send a response. body is bytes, or a file object to send length
+        bytes from, throttled to the server bandwidth
+        """
+        if length is None:
+            length = len(body)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        if isinstance(body, bytes):
+            self.wfile.write(body)
+            return
+
+        bandwidth = self.server.bandwidth
+        while length > 0:
+            buf = body.read(min(length, 64 * 1024))
+            if not buf:
+                break
+            try:
+                self.wfile.write(buf)
+            except (BrokenPipeError, ConnectionResetError):
+                # Client dropped the response, like util/download.py
+                # does before switching to byte ranges
+                self.close_connection = True
+                return
+            length -= len(buf)
+            if bandwidth:
+                time.sleep(len(buf) / bandwidth)
+
+    def _listing(self, dirpath):
+        names = []
+        for name in sorted(os.listdir(dirpath)):
+            if os.path.isdir(os.path.join(dirpath, name)):
+                name += "/"
+            names.append('<a href="%s">%s</a>' % (name, name))
+        return ("<html><body>\n%s\n</body></html>\n" %
+                "\n".join(names)).encode()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        relpath = os.path.normpath(self.path.split("?")[0].lstrip("/"))
+        path = os.path.join(self.server.rootdir, relpath)
+        if relpath.startswith("..") or not os.path.exists(path):
+            self._send(404, b"Not found\n")
+            return
+
+        if os.path.isdir(path):
+            if not self.path.endswith("/"):
+                self._send(301, b"", {"Location": self.path + "/"})
+                return
+            self._send(200, self._listing(path),
+                       {"Content-Type": "text/html"})
+            return
+
+        stat = os.stat(path)
+        etag = '"%x-%x"' % (stat.st_size, int(stat.st_mtime))
+        modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        headers = {"ETag": etag, "Last-Modified": modified,
+                   "Accept-Ranges": "bytes"}
+        if (self.headers.get("If-None-Match") == etag or
+                self.headers.get("If-Modified-Since") == modified):
+            self._send(304, b"", headers)
+            return
+
+        size = stat.st_size
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        with open(path, "rb") as fp:
+            if match and (not if_range or if_range in (etag, modified)):
+                start = int(match.group(1))
+                end = min(int(match.group(2) or size - 1), size - 1)
+                headers["Content-Range"] = "bytes %d-%d/%d" % (
+                    start, end, size)
+                fp.seek(start)
+                self._send(206, fp, headers, end - start + 1)
+                return
+            self._send(200, fp, headers, size)
+
+    do_HEAD = do_GET
+
+
+class MirrorServer(http.server.ThreadingHTTPServer):
+    """
+    Serve rootdir on localhost.
+
+    :param latency: seconds added to every request
+    :param bandwidth: bytes per second per connection, 0 for unlimited
+    """
+    daemon_threads = True
+
+    def __init__(self, rootdir, port=0, latency=0, bandwidth=0,
+                 verbose=False):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.rootdir = os.path.abspath(rootdir)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.verbose = verbose
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def urls(self):
+        """
+        Return {option: url} for the fetch-latest-builds.py URL options
+        """
+        return {"internal_url": self.url + "/internal",
+                "spice_url": self.url + "/spice",
+                "published_url": self.url + "/published"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+###################
+# main() handling #
+###################
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve a synthetic copy "
+        "of the build servers fetch-latest-builds.py scrapes.")
+    parser.add_argument("--root", required=True,
+        help="Directory to generate the tree in, and serve")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0,
+        help="Milliseconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=0,
+        help="MiB/s per connection, 0 for unlimited")
+    parser.add_argument("--sources-size", type=int, default=SOURCES_SIZE,
+        help="Size of the -sources.zip files in bytes")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    if options.port <= 0:
+        fail("--port must be a positive number")
+    total = generate_tree(options.root, sources_size=options.sources_size)
+    server = MirrorServer(options.root, options.port,
+        latency=options.latency / 1000.0,
+        bandwidth=options.bandwidth * 1024 * 1024, verbose=True)
+    print("Serving %s (%.1f MiB of builds) at %s" %
+          (options.root, total / (1024.0 * 1024.0), server.url))
+    for key, url in server.urls().items():
+        print("  --%s %s" % (key.replace("_", "-"), url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Generations of NEW_BUILDS_DIR content, so fetching and building can
+overlap.
+
+NEW_BUILDS_DIR is a symlink to $GENERATIONS_DIR/$generation.
+fetch-latest-builds.py downloads into a staging dir there, and once
+everything is verified publish() renames it to a new generation and
+atomically repoints the symlink.
+
+Readers call pin(), which resolves the symlink and holds a shared flock
+on that generation until the process exits, and then only read from the
+returned path. Old generations are deleted once an exclusive lock can be
+taken on them, meaning no reader uses them any more.
+"""
+
+import datetime
+import fcntl
+import os
+import shutil
+import tempfile
+
+from .buildversions import BuildVersions
+from .utils import fail
+
+
+NEW_BUILDS_DIR = BuildVersions.NEW_BUILDS_DIR
+GENERATIONS_DIR = os.path.join(BuildVersions.TOP_DIR, ".new-builds")
+LOCK_BASENAME = ".lock"
+
+# Open lock files, kept for the lifetime of the process
+_held_locks = []
+# Exclusive locks on our staging dirs, by path
+_staging_locks = {}
+
+
+####################
+# Internal helpers #
+####################
+
+def _lock(dirpath, mode):
+    """
+    flock dirpath's lock file. Returns the open file, or None if the
+    dir is gone, or if mode has LOCK_NB and the lock is held elsewhere
+    """
+    try:
+        fp = open(os.path.join(dirpath, LOCK_BASENAME), "a")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fp, mode)
+    except BlockingIOError:
+        fp.close()
+        return None
+    if not os.path.exists(fp.name):
+        # Deleted by prune() while we waited for the lock
+        fp.close()
+        return None
+    return fp
+
+
+def _new_generation_name():
+    return datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+
+
+def _switch_symlink(target):
+    tmp = NEW_BUILDS_DIR + ".tmp-%d" % os.getpid()
+    os.symlink(os.path.relpath(target, os.path.dirname(NEW_BUILDS_DIR)), tmp)
+    os.replace(tmp, NEW_BUILDS_DIR)
+
+
+def _adopt_legacy_dir():
+    """
+    Turn a plain NEW_BUILDS_DIR directory into a generation
+    """
+    if not os.path.isdir(NEW_BUILDS_DIR) or os.path.islink(NEW_BUILDS_DIR):
+        return
+    gendir = os.path.join(GENERATIONS_DIR, _new_generation_name())
+    print("Moving %s to %s" % (NEW_BUILDS_DIR, gendir))
+    os.makedirs(GENERATIONS_DIR, exist_ok=True)
+    os.rename(NEW_BUILDS_DIR, gendir)
+    _switch_symlink(gendir)
+
+
+##################
+# Public helpers #
+##################
+
+def pin():
+    """
+    Return the real path of the current NEW_BUILDS_DIR generation, and
+    keep it from being deleted until this process exits
+    """
+    for dummy in range(10):
+        # A plain directory could be moved away while we use it
+        try:
+            _adopt_legacy_dir()
+        except FileNotFoundError:
+            continue
+        path = os.path.realpath(NEW_BUILDS_DIR)
+        if not os.path.isdir(path):
+            fail("%s doesn't exist. Run fetch-latest-builds.py first." %
+                 NEW_BUILDS_DIR)
+        fp = _lock(path, fcntl.LOCK_SH)
+        if fp:
+            _held_locks.append(fp)
+            return path
+    fail("Couldn't pin a %s generation, it keeps changing" % NEW_BUILDS_DIR)
+
+
+def create_staging():
+    """
+    Create and return a new staging dir for downloads. It is locked,
+    so prune() won't delete it while we're filling it
+    """
+    os.makedirs(GENERATIONS_DIR, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix="staging-", dir=GENERATIONS_DIR)
+    _staging_locks[staging] = _lock(staging, fcntl.LOCK_EX)
+    return staging
+
+
+def discard(staging):
+    """
+    Unlock and delete a staging dir that won't be published, like after
+    a failed download
+    """
+    fp = _staging_locks.pop(staging, None)
+    if fp:
+        fp.close()
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def publish(staging):
+    """
+    Make the staging dir the current NEW_BUILDS_DIR generation, and
+    prune unused old ones. Returns the new generation path
+    """
+    _adopt_legacy_dir()
+    gendir = os.path.join(GENERATIONS_DIR, _new_generation_name())
+    os.rename(staging, gendir)
+    # mkdtemp() creates it private
+    os.chmod(gendir, 0o755)
+    _switch_symlink(gendir)
+    # Readers can pin it now
+    _staging_locks.pop(staging).close()
+    print("%s now points at %s" % (NEW_BUILDS_DIR, gendir))
+    prune()
+    return gendir
+
+
+def prune():
+    """
+    Delete every generation and leftover staging dir that isn't current
+    and isn't locked by a reader or a running fetch
+    """
+    if not os.path.isdir(GENERATIONS_DIR):
+        return
+    current = os.path.realpath(NEW_BUILDS_DIR)
+    for name in sorted(os.listdir(GENERATIONS_DIR)):
+        path = os.path.join(GENERATIONS_DIR, name)
+        if path == current or not os.path.isdir(path):
+            continue
+        fp = _lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not fp:
+            print("Keeping %s, it is still in use" % path)
+            continue
+        shutil.rmtree(path)
+        fp.close()
@@ -0,0 +1,203 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Small in-process stage graph runner.
+
+Each stage declares the named artifacts it consumes and produces. Stage
+dependencies are derived from those declarations, and every stage whose
+inputs are available is run concurrently on a thread pool. Stage functions
+are called with their inputs as keyword arguments and must return a dict
+containing exactly their declared outputs.
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+from . import instrument
+from .utils import fail
+
+
+class Stage:
+    def __init__(self, name, func, inputs, outputs):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs or [])
+        self.outputs = list(outputs or [])
+        self.deps = []
+
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class Pipeline:
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.artifacts = {}
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._t0 = None
+        self._t1 = None
+
+    def add_artifact(self, name, value):
+        """
+        Seed an artifact that is available before any stage runs
+        """
+        self.artifacts[name] = value
+
+    def add_stage(self, name, func, inputs=None, outputs=None):
+        if name in self._stages:
+            fail("Duplicate pipeline stage name: %s" % name)
+        self._stages[name] = Stage(name, func, inputs, outputs)
+
+    def _resolve_deps(self):
+        producers = {}
+        for stage in self._stages.values():
+            for output in stage.outputs:
+                if output in producers or output in self.artifacts:
+                    fail("Pipeline artifact '%s' has multiple producers" %
+                         output)
+                producers[output] = stage.name
+
+        for stage in self._stages.values():
+            stage.deps = []
+            for inp in stage.inputs:
+                if inp in self.artifacts:
+                    continue
+                if inp not in producers:
+                    fail("Pipeline stage '%s' input '%s' is not produced "
+                         "by any stage" % (stage.name, inp))
+                if producers[inp] not in stage.deps:
+                    stage.deps.append(producers[inp])
+
+        # Kahn's algorithm, only to reject cycles up front
+        remaining = {s.name: set(s.deps) for s in self._stages.values()}
+        while remaining:
+            ready = [n for n, deps in remaining.items() if not deps]
+            if not ready:
+                fail("Pipeline stages have a dependency cycle: %s" %
+                     ", ".join(sorted(remaining)))
+            for name in ready:
+                remaining.pop(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def _run_stage(self, stage):
+        kwargs = {name: self.artifacts[name] for name in stage.inputs}
+        stage.start = time.monotonic()
+        try:
+            with instrument.span(stage.name, category="stage"):
+                ret = stage.func(**kwargs) or {}
+        finally:
+            stage.end = time.monotonic()
+
+        if sorted(ret) != sorted(stage.outputs):
+            fail("Pipeline stage '%s' returned %s, but declared %s" %
+                 (stage.name, sorted(ret), sorted(stage.outputs)))
+        with self._lock:
+            self.artifacts.update(ret)
+
+    def run(self):
+        """
+        Run all stages, as concurrently as their dependencies allow.
+        The first stage failure stops any new stages from being scheduled,
+        and is re-raised once the already running stages finish.
+        """
+        self._resolve_deps()
+        self._t0 = time.monotonic()
+
+        done = set()
+        pending = dict(self._stages)
+        running = {}
+        error = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs) as pool:
+            while pending or running:
+                if error is None:
+                    for stage in list(pending.values()):
+                        # Don't queue more than the pool runs, so a
+                        # failure leaves nothing queued to start after
+                        if len(running) >= self.jobs:
+                            break
+                        if not all(d in done for d in stage.deps):
+                            continue
+                        pending.pop(stage.name)
+                        print("=== stage start: %s" % stage.name)
+                        running[pool.submit(self._run_stage, stage)] = stage
+                if not running:
+                    break
+
+                finished, dummy = concurrent.futures.wait(running,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException as e:  # pylint: disable=broad-except
+                        print("=== stage FAILED: %s" % stage.name)
+                        if error is None:
+                            error = e
+                        continue
+                    print("=== stage done: %s (%.1fs)" %
+                          (stage.name, stage.duration))
+                    done.add(stage.name)
+
+        self._t1 = time.monotonic()
+        if error is not None:
+            self.print_summary()
+            raise error
+
+    def critical_path(self):
+        """
+        Return the list of finished stages forming the longest dependency
+        chain, ending with the stage that finished last.
+        """
+        finished = [s for s in self._stages.values() if s.end is not None]
+        if not finished:
+            return []
+
+        stage = max(finished, key=lambda s: s.end)
+        path = [stage]
+        while stage.deps:
+            deps = [self._stages[d] for d in stage.deps
+                    if self._stages[d].end is not None]
+            if not deps:
+                break
+            stage = max(deps, key=lambda s: s.end)
+            path.insert(0, stage)
+        return path
+
+    def print_summary(self):
+        if self._t0 is None:
+            return
+        end = self._t1 or time.monotonic()
+
+        print()
+        print("Pipeline stage timings:")
+        stages = sorted(self._stages.values(),
+                        key=lambda s: (s.start is None, s.start or 0))
+        width = max([len(s.name) for s in stages] + [5])
+        for stage in stages:
+            if stage.start is None:
+                print("  %-*s  (not run)" % (width, stage.name))
+                continue
+            print("  %-*s  start=%7.1fs  duration=%7.1fs" %
+                  (width, stage.name, stage.start - self._t0,
+                   stage.duration))
+
+        path = self.critical_path()
+        if path:
+            print("Critical path: %s (%.1fs)" % (
+                " -> ".join(s.name for s in path),
+                sum(s.duration for s in path)))
+        print("Total wall time: %.1fs" % (end - self._t0))
+        print()
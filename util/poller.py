@@ -0,0 +1,101 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+asyncio loop polling several checks on independent schedules.
+
+Each check is a blocking function run in a worker thread. Successful
+checks repeat every interval seconds, failing ones back off
+exponentially up to max_backoff, and every delay is jittered so the
+checks don't line up. Once every check has a result, on_change(results)
+runs whenever the combined results differ from the last ones handled.
+"""
+
+import asyncio
+import random
+import time
+
+
+class Poller:
+    """
+    :param checks: {name: func}, func() returning a comparable result
+    :param on_change: called with {name: result}, in a worker thread.
+        If it raises, the same results are handled again next time.
+    :param initial: {name: result} already handled, if known
+    """
+    def __init__(self, checks, on_change, interval, jitter=0.1,
+                 max_backoff=None, initial=None):
+        self.checks = checks
+        self.on_change = on_change
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff or interval * 8
+        self.results = {}
+        self._handled = initial
+        self._lock = None
+
+
+    ####################
+    # Internal helpers #
+    ####################
+
+    def _jittered(self, delay):
+        return max(0, delay * random.uniform(1 - self.jitter,
+                                             1 + self.jitter))
+
+    def _log(self, msg):
+        print("%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg),
+              flush=True)
+
+    async def _handle_results(self):
+        async with self._lock:
+            if set(self.results) != set(self.checks):
+                return
+            results = dict(self.results)
+            if results == self._handled:
+                return
+
+            self._log("Change detected, running handler")
+            try:
+                await asyncio.to_thread(self.on_change, results)
+            except (Exception, SystemExit) as e:  # pylint: disable=broad-except
+                self._log("Handler failed, will retry: %s" % e)
+                return
+            self._handled = results
+
+    async def _poll(self, name, func):
+        # Spread out the first round of checks
+        await asyncio.sleep(random.uniform(0, self.interval * self.jitter))
+        failures = 0
+        while True:
+            try:
+                result = await asyncio.to_thread(func)
+            except (Exception, SystemExit) as e:  # pylint: disable=broad-except
+                failures += 1
+                delay = min(self.interval * 2 ** failures, self.max_backoff)
+                self._log("%s: check failed (%d in a row), retrying in "
+                          "~%ds: %s" % (name, failures, delay, e))
+            else:
+                failures = 0
+                delay = self.interval
+                if self.results.get(name) != result:
+                    self._log("%s: new result" % name)
+                self.results[name] = result
+                await self._handle_results()
+            await asyncio.sleep(self._jittered(delay))
+
+    async def _main(self):
+        self._lock = asyncio.Lock()
+        await asyncio.gather(*[self._poll(name, func)
+                               for name, func in self.checks.items()])
+
+
+    ##################
+    # Public helpers #
+    ##################
+
+    def run(self):
+        """
+        Poll forever
+        """
+        asyncio.run(self._main())
@@ -0,0 +1,96 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Plan the minimal upload needed to bring the published mirror in sync
+with the local tree.
+
+We keep a manifest of what the mirror contains as of the last successful
+push (path, size, sha256, or symlink target). Diffing that against a
+scan of the local tree gives the exact list of files to transfer, so
+rsync doesn't need to walk and checksum the whole remote tree to
+figure it out.
+"""
+
+import json
+import os
+
+from .fileutils import file_digest
+
+
+# File types that are already compressed, not worth compressing in transit
+INCOMPRESSIBLE_SUFFIXES = ["iso", "rpm", "zip", "msi", "exe", "gz", "xz",
+                           "bz2", "zst", "zck", "cab"]
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    return json.load(open(path))
+
+
+def save_manifest(path, manifest):
+    tmp = path + ".tmp"
+    open(tmp, "w").write(json.dumps(manifest, sort_keys=True, indent=1))
+    os.replace(tmp, path)
+
+
+def scan_tree(topdir, previous=None, exclude=None):
+    """
+    Build a manifest of topdir: {relpath: entry}. File digests from the
+    previous manifest are reused when size and mtime didn't change.
+    """
+    previous = previous or {}
+    exclude = exclude or []
+    manifest = {}
+    for root, dirs, files in os.walk(topdir):
+        dirs.sort()
+        # os.walk doesn't descend into dir symlinks, but we need to
+        # record them as links
+        names = files + [d for d in dirs
+                         if os.path.islink(os.path.join(root, d))]
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, topdir)
+            if relpath in exclude:
+                continue
+
+            if os.path.islink(path):
+                manifest[relpath] = {"link": os.readlink(path)}
+                continue
+
+            st = os.stat(path)
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+            old = previous.get(relpath, {})
+            if (old.get("size") == entry["size"] and
+                    old.get("mtime_ns") == entry["mtime_ns"] and
+                    "sha256" in old):
+                entry["sha256"] = old["sha256"]
+            else:
+                entry["sha256"] = file_digest(path)
+            manifest[relpath] = entry
+    return manifest
+
+
+def _same(old, new):
+    if "link" in new or "link" in old:
+        return old.get("link") == new.get("link")
+    return (old.get("size") == new.get("size") and
+            old.get("sha256") == new.get("sha256"))
+
+
+def plan(local, remote):
+    """
+    Compare the local manifest with the remote one.
+
+    Returns (transfers, deletes): sorted lists of relpaths that are new
+    or changed locally, and that only exist remotely.
+    """
+    transfers = [p for p in sorted(local)
+                 if p not in remote or not _same(remote[p], local[p])]
+    deletes = [p for p in sorted(remote) if p not in local]
+    return transfers, deletes
+
+
+def transfer_size(manifest, paths):
+    return sum(manifest[p].get("size", 0) for p in paths)
@@ -0,0 +1,240 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Minimal RPM reader: parse the header and stream the cpio payload,
+without rpm2cpio/cpio and without extracting anything to disk.
+
+File format reference:
+https://rpm-software-management.github.io/rpm/manual/format.html
+"""
+
+import bz2
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+from .utils import fail
+
+
+_LEAD_SIZE = 96
+_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+_HEADER_INTRO = struct.Struct(">4s4xLL")
+_HEADER_ENTRY = struct.Struct(">4L")
+
+_CPIO_HEADER_SIZE = 110
+_CPIO_MAGICS = [b"070701", b"070702"]
+_CPIO_TRAILER = "TRAILER!!!"
+
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_ARCH = 1022
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+
+_TYPE_INT32 = 4
+_TYPE_STRING = 6
+_TYPE_STRING_ARRAY = 8
+_TYPE_I18NSTRING = 9
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class _DecompressReader:
+    """
+    File-like read() wrapper around a streaming decompressor object
+    """
+    def __init__(self, fp, decompressor):
+        self._fp = fp
+        self._decompressor = decompressor
+        # Decompressed data, read() consumes it from self._pos. The
+        # consumed head is only dropped once it's most of the buffer,
+        # so small reads don't copy the rest every time
+        self._buf = bytearray()
+        self._pos = 0
+        self._eof = False
+
+    def read(self, size):
+        while len(self._buf) - self._pos < size and not self._eof:
+            chunk = self._fp.read(1024 * 1024)
+            if not chunk:
+                self._eof = True
+                break
+            if self._pos > len(self._buf) // 2:
+                del self._buf[:self._pos]
+                self._pos = 0
+            self._buf += self._decompressor.decompress(chunk)
+        ret = bytes(self._buf[self._pos:self._pos + size])
+        self._pos += len(ret)
+        return ret
+
+    def close(self):
+        pass
+
+
+class _ZstdProcessReader:
+    """
+    Fallback zstd reader piping the payload through the zstd binary
+    """
+    def __init__(self, path, offset):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            self._proc = subprocess.Popen(["zstd", "-dc"], stdin=fd,
+                stdout=subprocess.PIPE)
+        finally:
+            os.close(fd)
+
+    def read(self, size):
+        return self._proc.stdout.read(size)
+
+    def close(self):
+        self._proc.stdout.close()
+        self._proc.wait()
+
+
+class _MemberReader:
+    """
+    read() access limited to a single cpio member's data
+    """
+    def __init__(self, stream, size):
+        self._stream = stream
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._stream.read(size)
+        if len(data) != size:
+            fail("Truncated RPM payload")
+        self.remaining -= size
+        return data
+
+
+class RPMFile:
+    """
+    :ivar header_start: byte offset of the main header
+    :ivar header_end: byte offset where the main header ends and the
+        payload starts. This is the rpm:header-range of repo metadata.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tags = {}
+        with open(path, "rb") as fp:
+            lead = fp.read(_LEAD_SIZE)
+            if len(lead) != _LEAD_SIZE or lead[:4] != _LEAD_MAGIC:
+                fail("%s is not an RPM file" % path)
+
+            # Signature header, padded to 8 bytes
+            sigend = self._read_header(fp, _LEAD_SIZE, {})
+            self.header_start = _align(sigend, 8)
+            self.header_end = self._read_header(fp, self.header_start,
+                self.tags)
+
+    def _read_header(self, fp, offset, tags):
+        fp.seek(offset)
+        magic, nindex, hsize = _HEADER_INTRO.unpack(
+            fp.read(_HEADER_INTRO.size))
+        if magic != _HEADER_MAGIC:
+            fail("%s: bad RPM header magic at offset %d" %
+                 (self.path, offset))
+        entries = [_HEADER_ENTRY.unpack(fp.read(_HEADER_ENTRY.size))
+                   for dummy in range(nindex)]
+        store = fp.read(hsize)
+
+        for tag, tagtype, dataoff, count in entries:
+            if tagtype in [_TYPE_STRING, _TYPE_I18NSTRING]:
+                end = store.index(b"\0", dataoff)
+                tags[tag] = store[dataoff:end].decode("utf-8", "replace")
+            elif tagtype == _TYPE_STRING_ARRAY:
+                values = []
+                for dummy in range(count):
+                    end = store.index(b"\0", dataoff)
+                    values.append(store[dataoff:end].decode("utf-8",
+                                                            "replace"))
+                    dataoff = end + 1
+                tags[tag] = values
+            elif tagtype == _TYPE_INT32:
+                tags[tag] = list(struct.unpack(">%dl" % count,
+                    store[dataoff:dataoff + 4 * count]))
+
+        return (offset + _HEADER_INTRO.size +
+                _HEADER_ENTRY.size * nindex + hsize)
+
+    @property
+    def nvra(self):
+        return "%s-%s-%s.%s" % (self.tags.get(RPMTAG_NAME),
+            self.tags.get(RPMTAG_VERSION), self.tags.get(RPMTAG_RELEASE),
+            self.tags.get(RPMTAG_ARCH))
+
+    def _open_payload(self, fp):
+        compressor = self.tags.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")
+        if compressor == "gzip":
+            return _DecompressReader(fp,
+                zlib.decompressobj(16 + zlib.MAX_WBITS))
+        if compressor in ["xz", "lzma"]:
+            return _DecompressReader(fp, lzma.LZMADecompressor())
+        if compressor == "bzip2":
+            return _DecompressReader(fp, bz2.BZ2Decompressor())
+        if compressor == "zstd":
+            try:
+                import zstandard  # pylint: disable=import-outside-toplevel
+                return _DecompressReader(fp,
+                    zstandard.ZstdDecompressor().decompressobj())
+            except ImportError:
+                if not shutil.which("zstd"):
+                    fail("%s: zstd payload needs python3-zstandard or "
+                         "the zstd binary" % self.path)
+                return _ZstdProcessReader(self.path, self.header_end)
+        fail("%s: unsupported payload compressor: %s" %
+             (self.path, compressor))
+
+    def payload_members(self):
+        """
+        Stream the cpio payload, yielding (name, mode, size, reader) for
+        every archive member. Names look like ./usr/bin/foo. Data not
+        read from reader before the next iteration is skipped.
+        """
+        payloadformat = self.tags.get(RPMTAG_PAYLOADFORMAT, "cpio")
+        if payloadformat != "cpio":
+            fail("%s: unsupported payload format: %s" %
+                 (self.path, payloadformat))
+
+        with open(self.path, "rb") as fp:
+            fp.seek(self.header_end)
+            stream = self._open_payload(fp)
+            try:
+                yield from self._iter_cpio(stream)
+            finally:
+                stream.close()
+
+    def _iter_cpio(self, stream):
+        while True:
+            header = stream.read(_CPIO_HEADER_SIZE)
+            if len(header) != _CPIO_HEADER_SIZE:
+                fail("%s: truncated cpio payload" % self.path)
+            if header[:6] not in _CPIO_MAGICS:
+                fail("%s: unsupported cpio header: %r" %
+                     (self.path, header[:6]))
+            fields = [int(header[6 + i * 8:14 + i * 8], 16)
+                      for i in range(13)]
+            mode, filesize, namesize = fields[1], fields[6], fields[11]
+
+            name = stream.read(namesize)[:-1].decode("utf-8", "replace")
+            stream.read(_align(_CPIO_HEADER_SIZE + namesize, 4) -
+                        _CPIO_HEADER_SIZE - namesize)
+            if name == _CPIO_TRAILER:
+                return
+
+            reader = _MemberReader(stream, filesize)
+            yield name, mode, filesize, reader
+            while reader.remaining:
+                reader.read(min(reader.remaining, 1024 * 1024))
+            stream.read(_align(filesize, 4) - filesize)
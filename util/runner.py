@@ -0,0 +1,78 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Run a batch of shell commands concurrently, respecting dependencies.
+
+This is shellcomm() for more than one command at a time. Scheduling,
+the job limit and the timing summary come from util/pipeline.py, every
+command being a stage. Command output is captured and printed line by
+line with a [name] prefix, and if a command fails the last lines of its
+output are repeated in the error.
+"""
+
+import collections
+import functools
+import subprocess
+import threading
+
+from . import instrument
+from .pipeline import Pipeline
+from .utils import fail
+
+
+class CommandRunner:
+    # Output lines repeated when a command fails
+    TAIL_LINES = 40
+
+    def __init__(self, jobs=None):
+        self._pipeline = Pipeline(jobs)
+        self._print_lock = threading.Lock()
+        self.returncodes = {}
+
+    def _print(self, msg):
+        with self._print_lock:
+            print(msg, flush=True)
+
+    def _run_command(self, name, cmd, cwd, echo, **dummy):
+        self._print("+ [%s] %s" % (name, cmd))
+        tail = collections.deque(maxlen=self.TAIL_LINES)
+        with instrument.span(name, category="shell", cmd=cmd):
+            proc = subprocess.Popen(cmd, shell=True, cwd=cwd,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, errors="replace")
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                tail.append(line)
+                if echo:
+                    self._print("[%s] %s" % (name, line))
+            proc.stdout.close()
+            returncode = proc.wait()
+
+        self.returncodes[name] = returncode
+        if returncode != 0:
+            fail("[%s] command failed with exit code %d: %s\n"
+                 "Last %d lines of output:\n    %s" %
+                 (name, returncode, cmd, len(tail), "\n    ".join(tail)))
+        return {name: returncode}
+
+    def add(self, name, cmd, deps=None, cwd=None, echo=True):
+        """
+        Queue the shell command cmd.
+
+        :param deps: names of commands that must finish successfully first
+        :param echo: print the output as it arrives. Otherwise it's only
+            printed if the command fails.
+        """
+        func = functools.partial(self._run_command, name, cmd, cwd, echo)
+        self._pipeline.add_stage(name, func, inputs=deps, outputs=[name])
+
+    def run(self):
+        """
+        Run every queued command. The first failure stops any new
+        commands from starting, and exits once the running ones finish.
+        """
+        self._pipeline.run()
+
+    def print_summary(self):
+        self._pipeline.print_summary()
@@ -0,0 +1,120 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Manifest mapping every shipped driver file back to the build input it
+was copied from, and every build input file to all its destinations.
+
+It's a plain sorted text file, with a line per direction:
+
+    D <dest>\t<source>\t<origin>
+    S <source>\t<dest>
+
+dest is relative to the driver dir/ISO root, source is the path in the
+make-driver-dir.py input tree, and origin names the build zip member or
+overlay file it actually came from. Since lines are sorted, a lookup is
+a binary search over file offsets, reading only a handful of lines.
+"""
+
+import os
+
+from .utils import fail
+
+
+# Manifest location, relative to the driver dir/ISO root
+MANIFEST_PATH = "data/driver-sources.txt"
+
+_HEADER = "# virtio-win driver source map, version 1\n"
+
+
+def write_manifest(path, entries):
+    """
+    :param entries: list of (dest, source, origin)
+    """
+    lines = set()
+    for dest, source, origin in entries:
+        lines.add(("D %s\t%s\t%s\n" % (dest, source, origin)).encode())
+        lines.add(("S %s\t%s\n" % (source, dest)).encode())
+
+    # Replace rather than rewrite path, it may be hardlinked elsewhere
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.encode())
+        f.writelines(sorted(lines))
+    os.replace(tmp, path)
+
+
+def read_manifest(path):
+    """
+    Return the list of (dest, source, origin) entries in the manifest
+    """
+    entries = []
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b"D "):
+                dest, source, origin = line[2:-1].decode().split("\t")
+                entries.append((dest, source, origin))
+    return entries
+
+
+def _check_header(fp, path):
+    if fp.readline() != _HEADER.encode():
+        fail("%s is not a driver source map" % path)
+
+
+def _line_at(fp, offset):
+    """
+    Return (start, line) for the first line starting at or after offset
+    """
+    if offset:
+        fp.seek(offset - 1)
+        fp.readline()
+    else:
+        fp.seek(0)
+    start = fp.tell()
+    return start, fp.readline()
+
+
+def _bisect(fp, size, target):
+    """
+    Offset of the first line that sorts >= target
+    """
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        dummy, line = _line_at(fp, mid)
+        if line and line < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return _line_at(fp, lo)[0]
+
+
+def _lookup(path, prefix):
+    target = prefix.encode()
+    ret = []
+    with open(path, "rb") as fp:
+        _check_header(fp, path)
+        fp.seek(0, os.SEEK_END)
+        fp.seek(_bisect(fp, fp.tell(), target))
+        for line in fp:
+            if not line.startswith(target):
+                break
+            ret.append(line[len(target):-1].decode().split("\t"))
+    return ret
+
+
+def lookup_dest(path, dest):
+    """
+    Return [(source, origin)] for the shipped file dest. Empty if dest
+    isn't in the manifest.
+    """
+    return [tuple(fields) for fields in _lookup(path, "D %s\t" % dest)]
+
+
+def lookup_source(path, source):
+    """
+    Return the list of destinations the input file source was copied to
+    """
+    return [fields[0] for fields in _lookup(path, "S %s\t" % source)]
@@ -0,0 +1,147 @@
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+"""
+Random access reader for members of the large *-sources.zip archives.
+
+The member index comes from zipfile's parsed central directory, so
+zip64 archives and members written with data descriptors work as
+zipfile handles them. It is cached per archive, in memory and
+optionally on disk, so later lookups only need to seek to the wanted
+member.
+"""
+
+import bz2
+import hashlib
+import json
+import os
+import struct
+import zipfile
+import zlib
+
+from .utils import fail
+
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_LOCAL_HEADER_SIG = b"PK\x03\x04"
+
+# In-process index cache: {digest: {name: [offset, method, csize, size,
+#                                       crc, flags]}}
+_INDEX_CACHE = {}
+
+
+class SourceArchive:
+    """
+    Read arbitrary members of a zip archive by name.
+
+    :param cachedir: if set, persist the member index there as
+        $digest.json, so later processes can skip parsing it
+    """
+    def __init__(self, path, cachedir=None):
+        self.path = path
+        self.cachedir = cachedir
+        self.digest = self._read_digest()
+        self._index = self._load_index()
+
+
+    ####################
+    # Internal helpers #
+    ####################
+
+    def _read_digest(self):
+        # Archives are only ever replaced, never rewritten in place, and
+        # the rename out of the staging dir keeps all of these
+        st = os.stat(self.path)
+        key = "%s-%s-%s-%s" % (st.st_dev, st.st_ino, st.st_size,
+                               st.st_mtime_ns)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _cache_path(self):
+        return os.path.join(self.cachedir, "%s.json" % self.digest)
+
+    def _load_index(self):
+        if self.digest in _INDEX_CACHE:
+            return _INDEX_CACHE[self.digest]
+
+        index = None
+        if self.cachedir and os.path.exists(self._cache_path()):
+            try:
+                index = json.load(open(self._cache_path()))
+            except ValueError:
+                index = None
+
+        if index is None:
+            index = {}
+            with zipfile.ZipFile(self.path) as zf:
+                for info in zf.infolist():
+                    if info.is_dir():
+                        continue
+                    index[info.filename] = [
+                        info.header_offset, info.compress_type,
+                        info.compress_size, info.file_size,
+                        info.CRC, info.flag_bits]
+            if self.cachedir:
+                os.makedirs(self.cachedir, exist_ok=True)
+                tmp = self._cache_path() + ".tmp-%s" % os.getpid()
+                open(tmp, "w").write(json.dumps(index))
+                os.replace(tmp, self._cache_path())
+
+        _INDEX_CACHE[self.digest] = index
+        return index
+
+    def _read_raw(self, fp, offset, csize):
+        # The sizes in the local header may be zero (data descriptor)
+        # or 0xFFFFFFFF (zip64), csize from the central directory isn't
+        fp.seek(offset)
+        header = fp.read(_LOCAL_HEADER.size)
+        if len(header) != _LOCAL_HEADER.size:
+            fail("%s: truncated local header at offset %d" %
+                 (self.path, offset))
+        header = _LOCAL_HEADER.unpack(header)
+        if header[0] != _LOCAL_HEADER_SIG:
+            fail("%s: bad local header at offset %d" % (self.path, offset))
+        namelen, extralen = header[10], header[11]
+        fp.seek(namelen + extralen, os.SEEK_CUR)
+        return fp.read(csize)
+
+
+    ##################
+    # Public helpers #
+    ##################
+
+    def has(self, name):
+        return name in self._index
+
+    def read(self, name):
+        if name not in self._index:
+            fail("%s: no member named %s" % (self.path, name))
+        offset, method, csize, size, crc, flags = self._index[name]
+        if flags & 0x1:
+            fail("%s: member %s is encrypted" % (self.path, name))
+
+        with open(self.path, "rb") as fp:
+            if method == zipfile.ZIP_STORED:
+                data = self._read_raw(fp, offset, csize)
+            elif method == zipfile.ZIP_DEFLATED:
+                data = zlib.decompressobj(-15).decompress(
+                    self._read_raw(fp, offset, csize))
+            elif method == zipfile.ZIP_BZIP2:
+                data = bz2.decompress(self._read_raw(fp, offset, csize))
+            else:
+                # Let zipfile deal with anything more exotic
+                with zipfile.ZipFile(self.path) as zf:
+                    data = zf.read(name)
+
+        if len(data) != size or zlib.crc32(data) != crc:
+            fail("%s: member %s failed the size/CRC check" %
+                 (self.path, name))
+        return data
+
+    def read_text(self, name, default=None):
+        """
+        Read name as text. If default is not None, return it when
+        the member doesn't exist.
+        """
+        if default is not None and not self.has(name):
+            return default
+        return self.read(name).decode("utf-8", errors="replace")
@@ -1,6 +1,8 @@
 import subprocess
 import sys
 
+from . import instrument
+
 
 def yes_or_no(msg):
     while 1:
@@ -14,7 +16,8 @@ def yes_or_no(msg):
 
 def shellcomm(cmd):
     print("+ %s" % cmd)
-    return subprocess.check_call(cmd, shell=True)
+    with instrument.span(cmd[:80], category="shell", cmd=cmd):
+        return subprocess.check_call(cmd, shell=True)
 
 
 def fail(msg):
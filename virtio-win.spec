@@ -95,10 +95,10 @@ Windows(R) guests.
 %prep
 %setup -q -T -b 1 -n %{name}-%{version}
 
-# Extract qemu-ga RPM
+# Extract the qemu-ga .msi files from the RPM, nothing else is used
 mkdir -p iso-content/guest-agent
 mkdir -p %{qemu_ga_win_build}
-pushd %{qemu_ga_win_build}/ && rpm2cpio %{SOURCE2} | cpio -idmv
+pushd %{qemu_ga_win_build}/ && rpm2cpio %{SOURCE2} | cpio -idmv '*/qemu-ga-*.msi'
 popd
 
 %{__mv} %{qemu_ga_win_build}/usr/i686-w64-mingw32/sys-root/mingw/bin/qemu-ga-i386.msi iso-content/guest-agent/